@@ -0,0 +1,117 @@
+'''
+Monitor database compression benchmark.
+
+Builds a monitor database with realistic sized Dryad JSON for each
+compression codec and reports database size, backup (file copy) time
+and the latency of reading and parsing the latest version of a study,
+as Monitor.status does when no fingerprint is available.
+
+Usage:
+
+`python bench_compression.py [-n STUDIES] [-v VERSIONS] [-f FILES] [-l LOOKUPS]`
+
+zstd is only benchmarked if the zstandard package is installed.
+'''
+import argparse
+import json
+import pathlib
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from dryad2dataverse import monitor
+
+WORDS = ('species temperature community warming algal freshwater data '
+         'mortality forest growth sample analysis model climate').split()
+
+def fake_study(rand, num, ver)->dict:
+    '''
+    Returns Dryad-like study JSON of roughly 5-10 KB
+    '''
+    text = lambda n: ' '.join(rand.choice(WORDS) for _ in range(n))
+    return {'identifier': f'doi:10.5061/dryad.{num}',
+            'id': num, 'storageSize': rand.randrange(10**9),
+            'lastModificationDate': f'2020-01-{ver+1:02d}',
+            'title': text(12), 'abstract': text(300), 'methods': text(200),
+            'authors': [{'firstName': text(1), 'lastName': text(1),
+                         'email': 'a@b.ca', 'affiliation': text(5),
+                         'affiliationROR': 'https://ror.org/03rmrcq20'}
+                        for _ in range(rand.randrange(1, 8))],
+            'keywords': [text(2) for _ in range(6)],
+            'versionChanges': 'files_changed', 'visibility': 'public'}
+
+def build(path, codec, args):
+    '''
+    Builds a database using codec
+    '''
+    rand = random.Random(1)
+    conn = sqlite3.connect(path)
+    for line in monitor.SCHEMA:
+        conn.execute(line)
+    monitor.migrate(conn)
+    uid = 0
+    for ver in range(args.versions):
+        for num in range(args.studies):
+            uid += 1
+            study = fake_study(rand, num, ver)
+            files = [{'_embedded': {'stash:files': [
+                {'path': f'file_{f}.csv', 'size': rand.randrange(10**6),
+                 'mimeType': 'text/csv', 'digestType': 'md5',
+                 'digest': f'{rand.getrandbits(128):032x}',
+                 '_links': {'stash:download': {'href': f'/api/v2/files/{f}/download'}}}
+                for f in range(args.files)]}}]
+            conn.execute('INSERT INTO dryadStudy VALUES (?, ?, ?, ?, ?)',
+                         (uid, study['identifier'], study['lastModificationDate'],
+                          monitor.pack(json.dumps(study), codec),
+                          monitor.pack(json.dumps({'datasetVersion': study}), codec)))
+            conn.execute('INSERT INTO dryadFiles VALUES (?, ?)',
+                         (uid, monitor.pack(json.dumps(files), codec)))
+            conn.executemany('INSERT INTO dvFiles VALUES (?, ?, ?, ?, ?, ?)',
+                             [(uid, f, 'md5', str(f), 'md5',
+                               monitor.pack(json.dumps({'data': {'files': [f]}}), codec))
+                              for f in range(args.files)])
+    conn.commit()
+    conn.execute('VACUUM')
+    return conn
+
+def argp():
+    '''
+    Parses arguments
+    '''
+    parser = argparse.ArgumentParser(description='Monitor compression benchmark')
+    parser.add_argument('-n', '--studies', type=int, default=2000)
+    parser.add_argument('-v', '--versions', type=int, default=5)
+    parser.add_argument('-f', '--files', type=int, default=5)
+    parser.add_argument('-l', '--lookups', type=int, default=500)
+    return parser
+
+def main():
+    '''
+    Main benchmark
+    '''
+    args = argp().parse_args()
+    codecs = ['none', 'zlib'] + (['zstd'] if monitor.zstandard else [])
+    rand = random.Random(2)
+    print(f'{"codec":<6}{"size MB":>10}{"backup s":>10}{"status ms":>11}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec in codecs:
+            path = pathlib.Path(tmp, f'{codec}.sqlite3')
+            conn = build(path, codec, args)
+            start = time.perf_counter()
+            shutil.copy2(path, pathlib.Path(tmp, f'{codec}_backup.sqlite3'))
+            backup = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(args.lookups):
+                doi = f'doi:10.5061/dryad.{rand.randrange(args.studies)}'
+                row = conn.execute('SELECT dryadjson FROM dryadStudyLatest WHERE doi = ?',
+                                   (doi,)).fetchone()
+                json.loads(monitor.unpack(row[0]))
+            lookup = (time.perf_counter() - start) / args.lookups * 1000
+            print(f'{codec:<6}{path.stat().st_size / 2**20:>10.1f}'
+                  f'{backup:>10.3f}{lookup:>11.3f}')
+            conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+File list comparison benchmark.
+
+Times dryad2dataverse.monitor.diff_file_lists against the previous
+list based implementation of Monitor.diff_files for studies with
+many files, where a proportion of files have been added, deleted
+or have changed hashes.
+
+Usage:
+
+`python bench_diff.py [-f FILES [FILES ...]] [-c CHANGED] [-r REPEAT]`
+'''
+import argparse
+import random
+import time
+
+from dryad2dataverse import monitor
+
+def legacy_diff(oldFiles, newFiles)->dict:
+    '''
+    The previous Monitor.diff_files comparison, for reference
+    '''
+    diffReport = {}
+    if (set(oldFiles).issuperset(set(newFiles)) and
+            set(newFiles).issuperset(oldFiles)):
+        return diffReport
+    old_map = {x:{'orig':y, 'no_hash':y[1:4]} for x,y in enumerate(oldFiles)}
+    new_map = {x:{'orig':y, 'no_hash':y[1:4]} for x,y in enumerate(newFiles)}
+    old_no_hash = [old_map[x]['no_hash'] for x in old_map]
+    new_no_hash = [new_map[x]['no_hash'] for x in new_map]
+    hash_change = []
+    old = [x[1:-2] for x in oldFiles]
+    old_no_url = [x[1:] for x in oldFiles]
+    for fi in newFiles:
+        if fi[1:-2] in old and fi[1:] not in old_no_url:
+            hash_change.append(fi)
+    if not set(old_no_hash).issuperset(set(new_no_hash)):
+        needsadd = set(new_no_hash) - (set(old_no_hash) & set(new_no_hash))
+        diffReport.update({'add': [new_map[new_no_hash.index(x)]['orig']
+                                   for x in needsadd]})
+    if not set(new_no_hash).issuperset(old_no_hash):
+        needsdel = set(old_no_hash) - (set(new_no_hash) & set(old_no_hash))
+        diffReport.update({'delete' : [old_map[old_no_hash.index(x)]['orig']
+                                       for x in needsdel]})
+    if hash_change:
+        diffReport.update({'hash_change': hash_change})
+    return diffReport
+
+def fake_files(files:int, changed:float, seed:int=1)->tuple:
+    '''
+    Returns (old, new) file lists
+    '''
+    rand = random.Random(seed)
+    fil = lambda n, digest: (f'https://datadryad.org/api/v2/files/{n}/download',
+                             f'dir/file_{n}.csv', 'text/csv', 1000 + n, '',
+                             'md5', digest)
+    old = [fil(n, f'{n:032x}') for n in range(files)]
+    new = list(old)
+    nchange = int(files * changed)
+    #deletions, additions and hash changes
+    for idx in sorted(rand.sample(range(files), nchange * 2), reverse=True)[:nchange]:
+        del new[idx]
+    new.extend(fil(n, f'{n:032x}') for n in range(files, files + nchange))
+    for idx in rand.sample(range(len(new)), nchange):
+        new[idx] = new[idx][:-1] + ('changed',)
+    rand.shuffle(new)
+    return old, new
+
+def best(func, repeat, *args)->float:
+    '''
+    Returns the fastest of repeat runs, in ms
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+def argp():
+    '''
+    Parses arguments
+    '''
+    parser = argparse.ArgumentParser(description='File list comparison benchmark')
+    parser.add_argument('-f', '--files', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('-c', '--changed', type=float, default=0.05,
+                        help='Proportion of files added, deleted and changed')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    return parser
+
+def main():
+    '''
+    Main benchmark
+    '''
+    args = argp().parse_args()
+    print(f'{"files":>8}{"legacy ms":>12}{"linear ms":>12}')
+    for files in args.files:
+        old, new = fake_files(files, args.changed)
+        legacy = best(legacy_diff, args.repeat, old, new)
+        linear = best(monitor.diff_file_lists, args.repeat, old, new)
+        print(f'{files:>8}{legacy:>12.2f}{linear:>12.2f}')
+
+if __name__ == '__main__':
+    main()
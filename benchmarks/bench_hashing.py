@@ -0,0 +1,82 @@
+'''
+Compares file hashing methods:
+
+* `loop`: the original `read(blocksize)` loop, which copies every block
+* `readinto`: single pass into a reused buffer
+* `mmap`: memory mapped, memoryview slices
+
+Usage:
+
+`python bench_hashing.py [-s SIZE_MB [SIZE_MB ...]] [-d DIGEST [DIGEST ...]] [-t TMPDIR]`
+
+The default sizes are 100 MB, 1 GB and 3 GB. Test files are
+written to TMPDIR and deleted afterwards. Note that the first read of
+each file may come from disk and later reads from the page cache; the
+file is hashed once before timing to warm the cache.
+'''
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+
+from dryad2dataverse import hashing
+
+def loop(infile, dig_types, blocksize=2**16):
+    '''
+    The original hashing loop
+    '''
+    out = {}
+    for dig in dig_types:
+        hasher = hashing.new(dig)
+        with open(infile, 'rb') as m:
+            while True:
+                data = m.read(blocksize)
+                if not data:
+                    break
+                hasher.update(data)
+        out[dig] = hasher.hexdigest()
+    return out
+
+METHODS = {'loop': loop,
+           'readinto': lambda f, d: hashing.digest_file(f, d, mmap_threshold=None),
+           'mmap': lambda f, d: hashing.digest_file(f, d, mmap_threshold=0)}
+
+def argp():
+    '''
+    Parses arguments
+    '''
+    parser = argparse.ArgumentParser(description='File hashing benchmark')
+    parser.add_argument('-s', '--sizes', nargs='+', type=int,
+                        default=[100, 1000, 3000],
+                        help='File sizes in MB. Default: 100 1000 3000')
+    parser.add_argument('-d', '--digests', nargs='+', default=['md5'],
+                        help='Digest types. Default: md5')
+    parser.add_argument('-t', '--tmpdir', default=None,
+                        help='Location for test files')
+    return parser
+
+def main():
+    '''
+    Main benchmark loop
+    '''
+    args = argp().parse_args()
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmp:
+        for size in args.sizes:
+            fname = pathlib.Path(tmp, f'{size}MB.bin')
+            with open(fname, 'wb') as fil:
+                for _ in range(size):
+                    fil.write(os.urandom(2**20))
+            hashing.digest_file(fname, 'md5')
+            results = {}
+            for name, meth in METHODS.items():
+                start = time.perf_counter()
+                results[name] = meth(fname, args.digests)
+                elapsed = time.perf_counter() - start
+                print(f'{size:>6} MB  {name:<9}{elapsed:8.3f} s  '
+                      f'{size/elapsed:8.1f} MB/s')
+            assert len({repr(r) for r in results.values()}) == 1, 'Digest mismatch'
+            fname.unlink()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+'''
+Monitor database lookup benchmark.
+
+Builds a version 0 (unindexed) monitor database with a history of
+studies, times the lookups used by dryad2dataverse.monitor.Monitor,
+then applies the schema migrations and times them again.
+
+Usage:
+
+`python bench_monitor.py [-n STUDIES] [-v VERSIONS] [-f FILES] [-l LOOKUPS]`
+
+The defaults give 100 000 dryadStudy rows and 300 000 dvFiles rows.
+'''
+import argparse
+import json
+import pathlib
+import random
+import sqlite3
+import tempfile
+import time
+
+from dryad2dataverse import monitor
+
+QUERIES = {'status': 'SELECT * FROM dryadStudy WHERE doi = ?',
+           'latest': 'SELECT uid, dryadjson FROM dryadStudyLatest WHERE doi = ?',
+           'dvpid': 'SELECT dvpid FROM dvStudy WHERE dryaduid = ?',
+           'dv_fid': 'SELECT dvfid, ROWID FROM dvFiles WHERE dryfid = ? ORDER BY ROWID ASC',
+           'files': 'SELECT dryfilesjson FROM dryadFiles WHERE dryaduid = ?',
+           'dvstudy': 'SELECT dvpid FROM dvStudy WHERE dvpid = ?'}
+
+def populate(conn, studies, versions, files):
+    '''
+    Fills a monitor database with fake study history.
+    '''
+    for line in monitor.SCHEMA:
+        conn.execute(line)
+    conn.execute('PRAGMA user_version = 0')
+    uid = 0
+    for ver in range(versions):
+        for num in range(studies):
+            uid += 1
+            doi = f'doi:10.5061/dryad.{num}'
+            dryad = {'identifier': doi, 'lastModificationDate': f'2020-01-{ver+1:02d}',
+                     'title': f'Study {num}', 'abstract': 'x' * 500}
+            conn.execute('INSERT INTO dryadStudy VALUES (?, ?, ?, ?, ?)',
+                         (uid, doi, dryad['lastModificationDate'],
+                          json.dumps(dryad), '{}'))
+            conn.execute('INSERT INTO dryadFiles VALUES (?, ?)', (uid, '[]'))
+            conn.execute('INSERT INTO dvStudy VALUES (?, ?)', (uid, f'doi:10.80240/{num}'))
+            conn.executemany('INSERT INTO dvFiles VALUES (?, ?, ?, ?, ?, ?)',
+                             [(uid, num * files + f, 'md5', str(uid * files + f),
+                               'md5', '{}') for f in range(files)])
+    conn.commit()
+
+def time_lookups(conn, args)->dict:
+    '''
+    Times each query with random keys and returns mean milliseconds.
+    '''
+    rand = random.Random(1)
+    maxuid = args.studies * args.versions
+    keys = {'status': lambda: (f'doi:10.5061/dryad.{rand.randrange(args.studies)}',),
+            'latest': lambda: (f'doi:10.5061/dryad.{rand.randrange(args.studies)}',),
+            'dvpid': lambda: (rand.randrange(1, maxuid),),
+            'dv_fid': lambda: (rand.randrange(args.studies * args.files),),
+            'files': lambda: (rand.randrange(1, maxuid),),
+            'dvstudy': lambda: (f'doi:10.80240/{rand.randrange(args.studies)}',)}
+    out = {}
+    for name, query in QUERIES.items():
+        start = time.perf_counter()
+        try:
+            for _ in range(args.lookups):
+                conn.execute(query, keys[name]()).fetchall()
+        except sqlite3.OperationalError:
+            #Not present in this schema version
+            out[name] = float('nan')
+            continue
+        out[name] = (time.perf_counter() - start) / args.lookups * 1000
+    return out
+
+def argp():
+    '''
+    Parses arguments
+    '''
+    parser = argparse.ArgumentParser(description='Monitor database benchmark')
+    parser.add_argument('-n', '--studies', type=int, default=20000)
+    parser.add_argument('-v', '--versions', type=int, default=5)
+    parser.add_argument('-f', '--files', type=int, default=3)
+    parser.add_argument('-l', '--lookups', type=int, default=50)
+    return parser
+
+def main():
+    '''
+    Main benchmark
+    '''
+    args = argp().parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(pathlib.Path(tmp, 'bench.sqlite3'))
+        start = time.perf_counter()
+        populate(conn, args.studies, args.versions, args.files)
+        print(f'{args.studies * args.versions} studies, '
+              f'{args.studies * args.versions * args.files} files, '
+              f'built in {time.perf_counter() - start:.1f} s')
+        before = time_lookups(conn, args)
+        start = time.perf_counter()
+        monitor.migrate(conn)
+        print(f'Migrated in {time.perf_counter() - start:.2f} s')
+        after = time_lookups(conn, args)
+        print(f'{"lookup":<10}{"v0 ms":>10}{"current ms":>12}')
+        for name in QUERIES:
+            print(f'{name:<10}{before[name]:>10.3f}{after[name]:>12.3f}')
+        conn.close()
+
+if __name__ == '__main__':
+    main()
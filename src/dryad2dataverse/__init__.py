@@ -17,6 +17,12 @@ JSON to Dataverse JSON.
 * **dryad2dataverse.transfer** : metadata and file transfer
 utilities.
 
+* **dryad2dataverse.asynctransfer** : asynchronous (asyncio) versions
+of the serializer and transfer utilities. Requires aiohttp.
+
+* **dryad2dataverse.hashing** : single pass, multiple digest file
+checksums.
+
 * **dryad2dataverse.monitor** : Monitoring and database tools
 for maintaining a pipeline to Dataverse without unnecessary
 downloading and file duplication.
@@ -0,0 +1,602 @@
+'''
+Asynchronous versions of dryad2dataverse.serializer.Serializer
+and dryad2dataverse.transfer.Transfer, built on aiohttp.
+
+A single event loop can drive many simultaneous downloads, uploads
+and deletions across multiple studies. Share one aiohttp.ClientSession
+between instances so that connections are pooled:
+
+```
+async with aiohttp.ClientSession() as session:
+    studies = [AsyncSerializer(doi, session=session, **config) for doi in dois]
+    await asyncio.gather(*[s.load() for s in studies])
+```
+
+Requires the optional aiohttp dependency:
+`pip install dryad2dataverse[async]`.
+
+Methods which are not overridden here (eg, upload_study, upload_json)
+are inherited unchanged and remain synchronous.
+'''
+#pylint: disable=invalid-name
+import asyncio
+import logging
+import pathlib
+import shutil
+import tempfile
+import urllib.parse
+
+try:
+    import aiohttp
+except ImportError: #pragma: no cover
+    aiohttp = None
+
+from dryad2dataverse import config
+from dryad2dataverse import exceptions
+from dryad2dataverse import throttle
+from dryad2dataverse import USERAGENT
+from dryad2dataverse.serializer import Serializer
+from dryad2dataverse.transfer import Transfer, HASHTABLE
+
+LOGGER = logging.getLogger(__name__)
+
+#Methods safe to resend. Uploads are file streams and can't be rewound
+RETRY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+def _require_aiohttp():
+    '''
+    Raises an informative ImportError if aiohttp is not installed.
+    '''
+    if aiohttp is None:
+        raise ImportError('Asynchronous transfers require aiohttp. '
+                          'Install with `pip install dryad2dataverse[async]`')
+
+class _AsyncSessionMixin():
+    '''
+    aiohttp session handling and retries common to AsyncSerializer
+    and AsyncTransfer.
+    '''
+    #pylint: disable=too-few-public-methods
+    def _init_asession(self, session=None):
+        '''
+        Sets up the (possibly shared) aiohttp session.
+
+        Parameters
+        ----------
+        session : aiohttp.ClientSession
+            Existing session. If None, one is created on first use
+            and closed by close().
+        '''
+        _require_aiohttp()
+        self._asession = session
+        self._own_session = session is None
+
+    @property
+    def asession(self):
+        '''
+        Returns the aiohttp.ClientSession used for requests.
+        '''
+        if self._asession is None or self._asession.closed:
+            self._asession = aiohttp.ClientSession(
+                headers={'User-agent': USERAGENT},
+                timeout=aiohttp.ClientTimeout(total=None,
+                                              sock_connect=self.kwargs.get('timeout', 100)))
+            self._own_session = True
+        return self._asession
+
+    async def close(self):
+        '''
+        Closes the aiohttp session if it was created by this instance.
+        '''
+        if self._own_session and self._asession and not self._asession.closed:
+            await self._asession.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @staticmethod
+    def _backoff(attempt:int)->float:
+        '''
+        Returns retry sleep time in seconds, as per urllib3.util.Retry.
+
+        Parameters
+        ----------
+        attempt : int
+            Number of previous attempts.
+        '''
+        retry = config.RETRY_STRATEGY
+        return min(retry.backoff_factor * 2 ** attempt,
+                   getattr(retry, 'backoff_max', 120))
+
+    async def _request(self, method, url, **kwargs):
+        '''
+        Makes a request and returns an aiohttp.ClientResponse which has been
+        read into memory. Idempotent requests are retried using the parameters
+        of dryad2dataverse.config.RETRY_STRATEGY.
+
+        Parameters
+        ----------
+        method : str
+            HTTP method.
+        url : str
+            URL.
+        **kwargs
+            Keyword arguments passed to aiohttp.ClientSession.request.
+        '''
+        retry = config.RETRY_STRATEGY
+        tries = retry.total if method.upper() in RETRY_METHODS else 0
+        for attempt in range(tries + 1):
+            try:
+                resp = await self.asession.request(method, url, **kwargs)
+                await resp.read()
+                if resp.status in retry.status_forcelist and attempt < tries:
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+                return resp
+            except aiohttp.ClientConnectionError as err:
+                if attempt >= tries:
+                    LOGGER.exception(err)
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+        return resp
+
+class AsyncSerializer(_AsyncSessionMixin, Serializer):
+    '''
+    Serializes Dryad JSON to Dataverse JSON, with asynchronous
+    metadata retrieval.
+
+    Unlike Serializer, metadata is not fetched automatically on access;
+    call `await load()` (or `fetch_record` and `fetch_file_json`) first.
+    '''
+    def __init__(self, doi:str, session=None, **kwargs):
+        '''
+        Creates asynchronous Dryad study metadata instance.
+
+        Parameters
+        ----------
+        doi : str
+            DOI of Dryad study. eg: 'doi:10.5061/dryad.2rbnzs7jp'
+        session : aiohttp.ClientSession
+            Optional shared session.
+        kwargs : dict
+            As for dryad2dataverse.serializer.Serializer
+        '''
+        super().__init__(doi, **kwargs)
+        self._init_asession(session)
+
+    async def fetch_record(self, url=None):
+        '''
+        Fetches Dryad study record JSON from Dryad V2 API and saves it
+        to self._dryadJson.
+
+        Parameters
+        ----------
+        url : str
+            Dryad instance base URL (eg: 'https://datadryad.org').
+        '''
+        if not url:
+            url = self.kwargs['dry_url']
+        headers = await asyncio.to_thread(config.Config.update_headers, **self.kwargs)
+        doiClean = urllib.parse.quote(self.doi, safe='')
+        resp = await self._request('GET',
+                                   f'{url}{self.kwargs["api_path"]}/datasets/{doiClean}',
+                                   headers=headers)
+        try:
+            resp.raise_for_status()
+        except aiohttp.ClientResponseError as err:
+            LOGGER.error('URL error for: %s', url)
+            LOGGER.exception(err)
+            raise
+        self._dryadJson = await resp.json(content_type=None)
+        return self._dryadJson
+
+    async def fetch_file_json(self):
+        '''
+        Awaitable version of Serializer.fileJson. Fetches all pages
+        of the Dryad file listing concurrently and saves them to
+        self._fileJson.
+        '''
+        if self._fileJson:
+            return self._fileJson
+        if not self._dryadJson:
+            await self.fetch_record()
+        headers = await asyncio.to_thread(config.Config.update_headers, **self.kwargs)
+        base = (f'{self.kwargs["dry_url"]}{self.kwargs["api_path"]}'
+                f'/versions/{self.id}/files')
+
+        async def page(num=None):
+            params = {'page': num} if num else None
+            resp = await self._request('GET', base, headers=headers, params=params)
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
+        try:
+            first = await page()
+            lastPage = first['_links']['last']['href']
+            pages = int(lastPage[lastPage.rfind('=')+1:])
+            rest = await asyncio.gather(*[page(i) for i in range(2, pages+1)])
+        except Exception as e:
+            LOGGER.exception(e)
+            raise
+        self._fileJson = [first] + list(rest)
+        return self._fileJson
+
+    async def load(self):
+        '''
+        Fetches both study and file metadata.
+        '''
+        await self.fetch_record()
+        await self.fetch_file_json()
+        return self
+
+    @property
+    def dryadJson(self):
+        '''
+        Returns Dryad study JSON. Must be fetched first with
+        `await fetch_record()`.
+        '''
+        if not self._dryadJson:
+            raise exceptions.Dryad2DataverseError('Dryad JSON not loaded. '
+                                                  'Use await fetch_record() first')
+        return self._dryadJson
+
+    @dryadJson.setter
+    def dryadJson(self, value=None):
+        '''
+        Sets Dryad JSON.
+
+        Parameters
+        ----------
+        value : dict
+            Dryad JSON.
+        '''
+        self._dryadJson = value
+
+    @property
+    def fileJson(self):
+        '''
+        Returns a list of file JSONs. Must be fetched first with
+        `await fetch_file_json()`.
+        '''
+        if not self._fileJson:
+            raise exceptions.Dryad2DataverseError('File JSON not loaded. '
+                                                  'Use await fetch_file_json() first')
+        return self._fileJson
+
+class AsyncTransfer(_AsyncSessionMixin, Transfer):
+    '''
+    Transfers data files from a Dryad installation to a Dataverse
+    installation asynchronously.
+
+    Each instance keeps its files in its own directory inside
+    `tempfile_location`, so that studies with files of the same
+    name can be transferred at the same time. The directory is
+    removed by close().
+    '''
+    def __init__(self, dryad, session=None, **kwargs):
+        '''
+        Creates an asynchronous transfer instance.
+
+        Parameters
+        ----------
+        dryad : dryad2dataverse.asynctransfer.AsyncSerializer
+            Serializer with metadata already loaded (`await dryad.load()`).
+            A synchronous Serializer will also work.
+        session : aiohttp.ClientSession
+            Optional shared session.
+        **kwargs
+            As for dryad2dataverse.transfer.Transfer
+        '''
+        super().__init__(dryad, **kwargs)
+        self._init_asession(session)
+        self._tmpdir = None
+
+    @property
+    def tmpdir(self)->pathlib.Path:
+        '''
+        Returns this instance's temporary directory as pathlib.Path,
+        creating it if necessary.
+        '''
+        if self._tmpdir is None:
+            self._tmpdir = pathlib.Path(tempfile.mkdtemp(dir=super().tmpdir))
+        return self._tmpdir
+
+    async def close(self):
+        '''
+        Closes the aiohttp session if it was created by this instance
+        and removes the temporary directory.
+        '''
+        await super().close()
+        if self._tmpdir is not None:
+            await asyncio.to_thread(shutil.rmtree, self._tmpdir, True)
+            self._tmpdir = None
+
+    async def download_file(self, url=None, filename=None,
+                            size=None, chk=None, **kwargs):
+        '''
+        Downloads a file to this instance's temporary directory.
+        Returns checksum on success and an exception on failure.
+
+        Parameters
+        ----------
+        url : str
+            URL of download.
+        filename : str
+            Output file name.
+        size : int
+            Reported file size in bytes.
+        chk : str
+            checksum of file (if available and known).
+        kwargs : dict
+
+        Other parameters
+        ----------------
+        digest_type : str
+            checksum type (ie, md5, sha-256, etc)
+        '''
+        tmp = self.tmpdir
+        if size and size > self.kwargs['max_upload']:
+            LOGGER.warning('%s: File %s exceeds '
+                           'Dataverse maximum upload size. Skipping download.',
+                           self.doi, filename)
+            md5 = 'this_file_is_too_big_to_upload__'
+            for i in self._files:
+                if url == i[0]:
+                    i[-1] = md5
+            return md5
+        headers = await asyncio.to_thread(config.Config.update_headers, **self.kwargs)
+        try:
+            async with self.asession.get(url, headers=headers) as down:
+                down.raise_for_status()
+                with open(pathlib.Path(tmp, filename), 'wb') as fi:
+                    async for chunk in down.content.iter_chunked(2**16):
+                        fi.write(chunk)
+                        if self.shaper.enabled:
+                            await asyncio.sleep(self.shaper.delay('download', len(chunk)))
+        except (aiohttp.ClientResponseError,
+                aiohttp.ClientConnectionError) as err:
+            LOGGER.critical('Unable to download %s', url)
+            LOGGER.exception(err)
+            raise
+        if size:
+            checkSize = pathlib.Path(tmp, filename).stat().st_size
+            if checkSize != size:
+                try:
+                    raise exceptions.DownloadSizeError('Download size does not '
+                                                       'match reported size')
+                except exceptions.DownloadSizeError as e:
+                    LOGGER.exception(e)
+                    raise
+        md5 = None
+        if chk and kwargs.get('digest_type') in HASHTABLE:
+            md5 = await asyncio.to_thread(self._verify_digest,
+                                          pathlib.Path(tmp, filename),
+                                          kwargs['digest_type'])
+            if md5 != chk:
+                try:
+                    raise exceptions.HashError(f'Hex digest mismatch: {md5} : {chk}')
+                except exceptions.HashError as e:
+                    LOGGER.exception(e)
+                    raise
+        for i in self._files:
+            if url == i[0]:
+                i[-1] = md5
+        return md5
+
+    async def download_files(self, files=None):
+        '''
+        Downloads files concurrently.
+
+        Parameters
+        ----------
+        files : list
+            As for dryad2dataverse.transfer.Transfer.download_files.
+            Defaults to self.files.
+        '''
+        if not files:
+            files = self.files
+        sem = asyncio.Semaphore(self.kwargs.get('max_workers', 4))
+
+        async def bounded(f):
+            async with sem:
+                return await self.download_file(url=f[0], filename=f[1],
+                                                 mimetype=f[2], size=f[3],
+                                                 descr=f[4], digest_type=f[5],
+                                                 chk=f[-1])
+        return await asyncio.gather(*[bounded(f) for f in files])
+
+    async def file_lock_check(self, study, count=0):
+        '''
+        Checks for a study lock. Returns True if locked.
+
+        Parameters
+        ----------
+        study : str
+            Persistent indentifer of study.
+        count : int
+            Number of times the function has been called. Logs
+            lock messages only on 0.
+        '''
+        headers = {'X-Dataverse-key': self.kwargs['api_key']}
+        params = {'persistentId': study}
+        lock_status = await self._request('GET',
+                                          f'{self.kwargs["dv_url"]}'
+                                          '/api/datasets/:persistentId/locks',
+                                          headers=headers, params=params)
+        try:
+            lock_status.raise_for_status()
+        except aiohttp.ClientResponseError as err:
+            LOGGER.error('Unable to detect lock status for %s', study)
+            LOGGER.error('ERROR message: %s', await lock_status.text())
+            LOGGER.exception(err)
+            raise
+        locks = await lock_status.json(content_type=None)
+        if locks.get('data'):
+            if count == 0:
+                LOGGER.warning('Study %s has been locked', study)
+                LOGGER.warning('Lock info:\n%s', locks)
+            return True
+        return False
+
+    async def upload_file(self, dryadUrl=None, filename=None,
+                          mimetype=None, size=None, descr=None,
+                          hashtype=None, digest=None, studyId=None,
+                          dest=None, fprefix=None, force_unlock=False):
+        '''
+        Uploads file to Dataverse study. Returns a tuple of the
+        dryadFid (or None) and Dataverse JSON from the POST request.
+        Parameters are as for dryad2dataverse.transfer.Transfer.upload_file.
+        '''
+        #pylint: disable=too-many-arguments, too-many-positional-arguments, too-many-locals
+        #pylint: disable=unused-argument
+        if not studyId:
+            studyId = self.dvpid
+        prep = self._prepare_upload(dryadUrl, filename, mimetype, size, descr)
+        fid = prep['fid']
+        if prep.get('fail'):
+            return prep['fail']
+        params = {'persistentId' : studyId}
+        url = self.kwargs['dv_url'] + '/api/datasets/:persistentId/add'
+        try:
+            with open(prep['upfile'], 'rb') as fil:
+                form = aiohttp.FormData()
+                if self.shaper.enabled:
+                    #aiohttp reads file payloads in an executor thread
+                    fil = throttle.ThrottledReader(fil, self.shaper, 'upload')
+                form.add_field('file', fil, filename=prep['filename'],
+                               content_type=prep['mimetype'])
+                form.add_field('jsonData', f'{prep["dv4meta"]}')
+                upload = await self.asession.post(url, params=params,
+                                                  headers=self.auth, data=form)
+                upjson = await upload.json(content_type=None)
+            upload.raise_for_status()
+        except aiohttp.ClientResponseError as err:
+            LOGGER.critical('Error %s: %s', err.status, err.message)
+            return (fid, {'status' : f'Failure: Reason - {err.status}: {err.message}'})
+        except Exception as f_plus: #pylint: disable=broad-except
+            LOGGER.exception(f_plus)
+            return (fid, {'status' : f'Failure: Reason: {f_plus}'})
+        try:
+            self.fileUpRecord.append((fid, upjson))
+            mismatch = await asyncio.to_thread(self._upload_mismatch, upjson,
+                                               prep['upfile'], hashtype, digest)
+            if mismatch:
+                return (fid, {'status': mismatch})
+            if force_unlock:
+                await asyncio.to_thread(self.force_notab_unlock, studyId)
+            else:
+                count = 0
+                while await self.file_lock_check(studyId, count):
+                    await asyncio.sleep(15)
+                    count += 1
+            return (fid, upjson)
+        except Exception as f_plus: #pylint: disable=broad-except
+            LOGGER.exception(f_plus)
+            return (fid, {'status' : f'Failure: Reason: {f_plus}'})
+
+    async def upload_files(self, files=None, pid=None, fprefix=None, force_unlock=False,
+                           callback=None):
+        '''
+        Uploads multiple files to study with persistentId pid.
+        Uploads to a single study are made in sequence, as Dataverse
+        locks a study while each file is processed.
+
+        Parameters are as for dryad2dataverse.transfer.Transfer.upload_files.
+        The callback is an ordinary function, not a coroutine.
+        '''
+        #pylint: disable=too-many-arguments, too-many-positional-arguments
+        if not files:
+            files = self.files
+        out = []
+        for f in files:
+            out.append(await self.upload_file(*list(f)[:-1],
+                                              studyId=pid, fprefix=fprefix,
+                                              force_unlock=force_unlock))
+            if callback:
+                callback(out[-1])
+        return out
+
+    async def _delete_dv_file(self, dvfid)->dict:
+        '''
+        Deletes a single file from Dataverse and returns a status dict.
+        See dryad2dataverse.transfer.Transfer._delete_dv_file.
+
+        Parameters
+        ----------
+        dvfid : str
+            Dataverse file ID number.
+        '''
+        try:
+            if self._native_delete:
+                delme = await self._request('DELETE',
+                                            f'{self.kwargs["dv_url"]}/api/files/{dvfid}',
+                                            headers=self.auth)
+                if delme.ok:
+                    return {'status': 'OK', 'code': delme.status, 'method': 'native'}
+                text = await delme.text()
+                if (delme.status in (404, 405, 501) and
+                        'endpoint does not exist' in text.lower()):
+                    self._native_delete = False
+                elif delme.status == 404:
+                    #The file is already gone, eg. deleted by hand
+                    return {'status': 'OK', 'code': 404, 'method': 'native'}
+                elif delme.status not in (405, 501):
+                    return {'status': f'Failure: Reason - {delme.status}: {delme.reason}',
+                            'code': delme.status, 'method': 'native'}
+            delme = await self._request('DELETE',
+                                        f'{self.kwargs["dv_url"]}/'
+                                        'dvn/api/data-deposit/v1.1/swordv2/edit-media'
+                                        f'/file/{dvfid}',
+                                        auth=aiohttp.BasicAuth(self.kwargs['api_key'], ''))
+        except aiohttp.ClientConnectionError as err:
+            return {'status': f'Failure: Reason - {err}', 'code': None,
+                    'method': 'native' if self._native_delete else 'sword'}
+        if delme.status == 204:
+            return {'status': 'OK', 'code': 204, 'method': 'sword'}
+        return {'status': f'Failure: Reason - {delme.status}: {delme.reason}',
+                'code': delme.status, 'method': 'sword'}
+
+    async def delete_dv_file(self, dvfid)->bool:
+        '''
+        Deletes a file from Dataverse given a dataverse file ID.
+        Returns 1 on success, or 0 on failure.
+
+        Parameters
+        ----------
+        dvfid : str
+            Dataverse file ID number.
+        '''
+        result = await self._delete_dv_file(dvfid)
+        self.fileDelStatus[dvfid] = result
+        if result['status'] == 'OK':
+            self.fileDelRecord.append(dvfid)
+            return 1
+        LOGGER.warning('%s: unable to delete Dataverse file %s. %s',
+                       self.doi, dvfid, result['status'])
+        return 0
+
+    async def delete_dv_files(self, dvfids=None, max_workers=None)->dict:
+        '''
+        Deletes all files in list of Dataverse file ids concurrently.
+        Returns a dict of `{dvfid: {'status': str, 'code': int, 'method': str}}`.
+
+        Parameters
+        ----------
+        dvfids : list
+            List of Dataverse file ids.
+        max_workers : int
+            Maximum number of simultaneous deletions.
+            Defaults to the `max_workers` configuration value, or 4.
+        '''
+        if not dvfids:
+            return {}
+        sem = asyncio.Semaphore(max_workers or self.kwargs.get('max_workers', 4))
+        dvfids = [fid for fid in dict.fromkeys(dvfids) if fid is not None]
+
+        async def bounded(fid):
+            async with sem:
+                return await self.delete_dv_file(fid)
+        await asyncio.gather(*[bounded(fid) for fid in dvfids])
+        return {fid: self.fileDelStatus[fid] for fid in dvfids}
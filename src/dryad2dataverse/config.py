@@ -31,6 +31,10 @@ RETRY_STRATEGY = Retry(total=10,
                        allowed_methods=['HEAD', 'GET', 'OPTIONS',
                                          'POST', 'PUT'],
            backoff_factor=1)
+#File uploads must not be resent blindly, because a timed-out upload may
+#have succeeded. Retries are handled by
+#dryad2dataverse.transfer.Transfer.upload_file instead.
+UPLOAD_RETRY_STRATEGY = RETRY_STRATEGY.new(allowed_methods=['HEAD', 'GET', 'OPTIONS'])
 
 #Variable listings from previous versions of this file
 #that are now included in Constants
@@ -165,11 +169,17 @@ class Config(dict):
         '''
         Ensure all keys have values
         '''
-        can_be_false = ['force_unlock', 'test_mode']
+        can_be_false = ['force_unlock', 'test_mode',
+                        'max_rate', 'max_download_rate', 'max_upload_rate',
+                        'rate_profiles', 'upload_retries', 'digest_cache',
+                        'max_memory_file', 'dbase_wal', 'dbase_mmap_size',
+                        'compress_backups']
         badkey = [k for k, v in self.items() if not v]
         for rm in can_be_false:
-            badkey.remove(rm)#It can be false
-        listkeys = {k:v for k,v in self.items() if isinstance(v, list)}
+            if rm in badkey:
+                badkey.remove(rm)#It can be false
+        listkeys = {k:v for k,v in self.items() if isinstance(v, list)
+                    and k not in can_be_false}
         for k, v in listkeys.items():
             for sub_v in v:
                 if not sub_v:
@@ -0,0 +1,347 @@
+'''
+File checksum utilities. Computes any combination of the digest types
+supported by Dryad in a single pass through a file.
+
+Supported digest types are:
+('adler-32','crc-32','md2','md5','sha-1','sha-256','sha-384','sha-512')
+
+All digests are returned as lower case hexadecimal strings,
+including the adler-32 and crc-32 checksums.
+
+Large files are memory mapped, so that blocks are passed to the hash
+functions without being copied.
+
+Digests can be stored in a persistent DigestCache, so that unchanged
+files are not hashed again when a transfer is retried.
+'''
+import concurrent.futures
+import contextlib
+import hashlib
+import logging
+import mmap
+import os
+import pathlib
+import sqlite3
+import threading
+import zlib #crc32, adler32
+
+import Crypto.Hash.MD2 #md2
+
+from dryad2dataverse import exceptions
+
+LOGGER = logging.getLogger(__name__)
+
+HASHTABLE = {'adler-32' : zlib.adler32, #zlib?
+             'crc-32' : zlib.crc32, #zlib
+             'md2' : Crypto.Hash.MD2, #insecure
+             'md5' : hashlib.md5,
+             'sha-1' : hashlib.sha1,
+             'sha-256' : hashlib.sha256,
+             'sha-384' : hashlib.sha384,
+             'sha-512': hashlib.sha512}
+
+#Large reads are much faster than the old 64 KiB blocks
+BLOCKSIZE = 2**22
+#Files at least this large are memory mapped instead of read
+MMAP_THRESHOLD = 2**26
+
+CACHE_NAME = '.dryad2dataverse_digests.sqlite3'
+_CACHES = {}
+_CACHE_LOCK = threading.Lock()
+
+class _Checksum():
+    '''
+    hashlib-like wrapper for the zlib running checksums.
+    '''
+    def __init__(self, func, start):
+        self.func = func
+        self.value = start
+
+    def update(self, data):
+        '''
+        Update the checksum with a bytes-like object
+        '''
+        self.value = self.func(data, self.value)
+
+    def hexdigest(self)->str:
+        '''
+        Returns the checksum as an 8 character hex string
+        '''
+        return f'{self.value & 0xffffffff:08x}'
+
+def new(dig_type:str):
+    '''
+    Returns a new hash object with update and hexdigest methods.
+
+    Parameters
+    ----------
+    dig_type : str
+        Digest type, eg 'md5', 'sha-256', 'crc-32'.
+    '''
+    if dig_type == 'adler-32':
+        return _Checksum(zlib.adler32, 1)
+    if dig_type == 'crc-32':
+        return _Checksum(zlib.crc32, 0)
+    if dig_type == 'md2':
+        return Crypto.Hash.MD2.new()
+    if dig_type in HASHTABLE:
+        return HASHTABLE[dig_type]()
+    raise exceptions.HashError(f'Unable to determine hash type: {dig_type}')
+
+def _digest_mmap(fil, hashers:dict, size:int, blocksize:int):
+    '''
+    Feeds memoryview slices of a memory mapped file to hashers.
+
+    Parameters
+    ----------
+    fil : file object
+        Open binary file.
+    hashers : dict
+        {digest type: hash object}
+    size : int
+        File size in bytes.
+    blocksize : int
+        Slice size in bytes.
+    '''
+    with mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        try:
+            for start in range(0, size, blocksize):
+                block = view[start:start+blocksize]
+                for hasher in hashers.values():
+                    hasher.update(block)
+                block.release()
+        finally:
+            view.release()
+
+def digest_file(infile, dig_types, blocksize:int=BLOCKSIZE,
+                mmap_threshold:int=MMAP_THRESHOLD)->dict:
+    '''
+    Returns a dict of {digest type: hex digest} for a file,
+    reading the file only once.
+
+    Parameters
+    ----------
+    infile : Union[str, pathlib.Path]
+        Path to file.
+    dig_types : Union[str, list]
+        Digest type or list of digest types.
+    blocksize : int
+        Read size in bytes.
+    mmap_threshold : int
+        Files of at least this size are memory mapped rather than read
+        into a buffer. None never uses mmap.
+    '''
+    if isinstance(dig_types, str):
+        dig_types = [dig_types]
+    hashers = {d: new(d) for d in dig_types}
+    with open(infile, 'rb', buffering=0) as fil:
+        size = os.fstat(fil.fileno()).st_size
+        if mmap_threshold is not None and size and size >= mmap_threshold:
+            try:
+                _digest_mmap(fil, hashers, size, blocksize)
+                return {d: h.hexdigest() for d, h in hashers.items()}
+            except (OSError, ValueError) as err:
+                LOGGER.debug('Unable to mmap %s, reading instead: %s', infile, err)
+                hashers = {d: new(d) for d in dig_types}
+                fil.seek(0)
+        buf = bytearray(blocksize)
+        view = memoryview(buf)
+        while True:
+            nread = fil.readinto(buf)
+            if not nread:
+                break
+            for hasher in hashers.values():
+                hasher.update(view[:nread])
+    return {d: h.hexdigest() for d, h in hashers.items()}
+
+def digest_bytes(data, dig_types)->dict:
+    '''
+    Returns a dict of {digest type: hex digest} for a bytes-like object.
+
+    Parameters
+    ----------
+    data : bytes-like object
+    dig_types : Union[str, list]
+        Digest type or list of digest types.
+    '''
+    if isinstance(dig_types, str):
+        dig_types = [dig_types]
+    out = {}
+    for dig in dig_types:
+        hasher = new(dig)
+        hasher.update(data)
+        out[dig] = hasher.hexdigest()
+    return out
+
+def digest_files(infiles, dig_types, processes=None)->dict:
+    '''
+    Returns a dict of {file: {digest type: hex digest}} for many files.
+
+    Parameters
+    ----------
+    infiles : list
+        List of paths.
+    dig_types : Union[str, list]
+        Digest type or list of digest types for all files.
+    processes : int
+        Number of worker processes. None uses all available cores;
+        1 hashes in the current process.
+    '''
+    infiles = list(infiles)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(infiles))
+    if processes <= 1:
+        return {f: digest_file(f, dig_types) for f in infiles}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        results = pool.map(digest_file, infiles, [dig_types] * len(infiles))
+        return dict(zip(infiles, results))
+
+class DigestCache():
+    '''
+    Persistent SQLite cache of file digests, keyed by
+    (path, size, mtime_ns, digest type). A file which has not
+    changed since it was last hashed is not read again.
+    '''
+    def __init__(self, dbase):
+        '''
+        Parameters
+        ----------
+        dbase : Union[str, pathlib.Path]
+            Path to cache database. Created if it does not exist.
+        '''
+        self.dbase = pathlib.Path(dbase).expanduser().absolute()
+        self.dbase.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS digests \
+                          (path TEXT, size INTEGER, mtime_ns INTEGER, \
+                          dig_type TEXT, digest TEXT, \
+                          PRIMARY KEY (path, size, mtime_ns, dig_type));')
+        LOGGER.debug('Digest cache at %s', self.dbase)
+
+    def _connect(self):
+        '''
+        Returns a new connection; connections are short lived so that the
+        cache can be used from multiple threads.
+        '''
+        return contextlib.closing(sqlite3.connect(self.dbase, timeout=30,
+                                                  isolation_level=None))
+
+    @staticmethod
+    def _key(infile):
+        '''
+        Returns (path, size, mtime_ns) for a file.
+        '''
+        path = pathlib.Path(infile).expanduser().absolute()
+        stat = path.stat()
+        return (str(path), stat.st_size, stat.st_mtime_ns)
+
+    def get(self, infile, dig_types)->dict:
+        '''
+        Returns a dict of cached {digest type: hex digest}. Types
+        which are not cached, or whose file has changed, are omitted.
+
+        Parameters
+        ----------
+        infile : Union[str, pathlib.Path]
+            Path to file.
+        dig_types : Union[str, list]
+            Digest type or list of digest types.
+        '''
+        if isinstance(dig_types, str):
+            dig_types = [dig_types]
+        key = self._key(infile)
+        with self._connect() as conn:
+            rows = conn.execute('SELECT dig_type, digest FROM digests WHERE path = ? \
+                                 AND size = ? AND mtime_ns = ?', key).fetchall()
+        return {t: d for t, d in rows if t in dig_types}
+
+    def put(self, infile, digests:dict):
+        '''
+        Adds digests for a file, removing any stale entries for it.
+
+        Parameters
+        ----------
+        infile : Union[str, pathlib.Path]
+            Path to file.
+        digests : dict
+            {digest type: hex digest}
+        '''
+        key = self._key(infile)
+        with self._connect() as conn:
+            conn.execute('BEGIN')
+            conn.execute('DELETE FROM digests WHERE path = ? AND \
+                          (size != ? OR mtime_ns != ?)', key)
+            conn.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)',
+                             [key + (t, d) for t, d in digests.items()])
+            conn.execute('COMMIT')
+
+    def digest_file(self, infile, dig_types, blocksize:int=BLOCKSIZE)->dict:
+        '''
+        As dryad2dataverse.hashing.digest_file, but only computes
+        digests which are not already cached.
+
+        Parameters
+        ----------
+        infile : Union[str, pathlib.Path]
+            Path to file.
+        dig_types : Union[str, list]
+            Digest type or list of digest types.
+        blocksize : int
+            Read size in bytes.
+        '''
+        if isinstance(dig_types, str):
+            dig_types = [dig_types]
+        try:
+            out = self.get(infile, dig_types)
+        except sqlite3.Error as err:
+            LOGGER.warning('Digest cache unavailable: %s', err)
+            return digest_file(infile, dig_types, blocksize)
+        missing = [t for t in dig_types if t not in out]
+        if missing:
+            out.update(digest_file(infile, missing, blocksize))
+            try:
+                self.put(infile, {t: out[t] for t in missing})
+            except sqlite3.Error as err:
+                LOGGER.warning('Unable to write to digest cache: %s', err)
+        return out
+
+def get_cache(**kwargs):
+    '''
+    Returns the process-wide DigestCache for a configuration,
+    or None if the cache is disabled.
+
+    Parameters
+    ----------
+    **kwargs
+        Normally a dryad2dataverse.config.Config instance.
+
+    Other parameters
+    ----------------
+    digest_cache : str
+        Path to the cache database. If not present, the cache is
+        kept in `tempfile_location`. A null or false value
+        disables the cache.
+    tempfile_location : str
+        Path to temporary directory.
+    '''
+    if 'digest_cache' in kwargs:
+        path = kwargs['digest_cache']
+    elif kwargs.get('tempfile_location'):
+        path = pathlib.Path(kwargs['tempfile_location'], CACHE_NAME)
+    else:
+        path = None
+    if not path:
+        return None
+    path = pathlib.Path(path).expanduser().absolute()
+    with _CACHE_LOCK:
+        if path not in _CACHES:
+            try:
+                _CACHES[path] = DigestCache(path)
+            except (OSError, sqlite3.Error) as err:
+                LOGGER.warning('Digest cache disabled: %s', err)
+                _CACHES[path] = None
+        return _CACHES[path]
@@ -1,66 +1,810 @@
 '''
-Dryad/Dataverse status tracker. Monitor creates a singleton object which
+Dryad/Dataverse status tracker. Monitor creates an object which
 writes to a SQLite database. Methods will (generally) take either a
 dryad2dataverse.serializer.Serializer instance or
 dryad2dataverse.transfer.Transfer instance
 
+Monitor is thread-safe: each thread reads with its own connection,
+and all writes are made by a single writer thread.
+
 The monitor's primary function is to allow for state checking
 for Dryad studies so that files and studies aren't downloaded
 unneccessarily.
 '''
 #pylint: disable=invalid-name
-import copy
+import atexit
+import collections
+import concurrent.futures
 import datetime
+import gzip
+import hashlib
 import json
 import logging
+import os
 import pathlib
+import queue
+import shutil
 import sqlite3
+import sys
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError: #pragma: no cover
+    zstandard = None
 
 from dryad2dataverse import exceptions
 
 LOGGER = logging.getLogger(__name__)
 
-class Monitor():
+#JSON columns which may hold compressed BLOBs
+COMPRESSED = {'dryadStudy': ('dryadjson', 'dvjson'),
+              'dryadFiles': ('dryfilesjson',),
+              'dvFiles': ('dvfilejson',)}
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def pack(text, codec='zlib'):
     '''
-    The Monitor object is a tracker and database updater, so that
-    Dryad files can be monitored and updated over time. Monitor is a singleton,
-    but is not thread-safe.
+    Returns text for storage, compressed to a bytes BLOB
+    unless codec is None or 'none'.
+
+    Parameters
+    ----------
+    text : str
+        Usually JSON.
+    codec : str
+        One of 'zlib', 'zstd' or 'none'. 'zstd' requires the optional
+        zstandard package and falls back to zlib if it is not installed.
+    '''
+    if text is None or not codec or codec == 'none':
+        return text
+    data = text.encode('utf-8')
+    if codec == 'zstd':
+        if zstandard:
+            return zstandard.ZstdCompressor(level=9).compress(data)
+        LOGGER.warning('zstandard not installed. Using zlib compression')
+    return zlib.compress(data, 6)
+
+def unpack(value):
+    '''
+    Returns the text of a stored value, decompressing if required.
+    Plain TEXT values are returned unchanged.
+
+    Parameters
+    ----------
+    value : Union[str, bytes, None]
+    '''
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value.startswith(ZSTD_MAGIC):
+        if not zstandard:
+            raise exceptions.DatabaseError('Database contains zstd compressed '
+                                           'data. Install zstandard: '
+                                           'pip install dryad2dataverse[zstd]')
+        return zstandard.ZstdDecompressor().decompress(value).decode('utf-8')
+    try:
+        return zlib.decompress(value).decode('utf-8')
+    except zlib.error:
+        #Uncompressed BLOB
+        return value.decode('utf-8')
+
+def recode(conn, codec='zlib', batch:int=500)->int:
+    '''
+    Rewrites all stored JSON with a given compression codec, and
+    returns the number of values changed. Does not commit.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    codec : str
+        One of 'zlib', 'zstd' or 'none'.
+    batch : int
+        Number of rows read at a time.
+    '''
+    changed = 0
+    for table, columns in COMPRESSED.items():
+        last = 0
+        while True:
+            rows = conn.execute(f'SELECT rowid, {", ".join(columns)} FROM {table} '
+                                'WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                                (last, batch)).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            for row in rows:
+                for col, value in zip(columns, row[1:]):
+                    new = pack(unpack(value), codec)
+                    if new != value:
+                        conn.execute(f'UPDATE {table} SET {col} = ? WHERE rowid = ?',
+                                     (new, row[0]))
+                        changed += 1
+    return changed
+
+def fingerprint(obj)->str:
+    '''
+    Returns a canonical, key order independent sha-256 hex digest
+    of a JSON serializable object.
+
+    Parameters
+    ----------
+    obj : Union[dict, list, str, int, float, bool, None]
+    '''
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, separators=(',', ':'),
+                                     ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def serial_fingerprint(serial)->str:
+    '''
+    Returns the fingerprint of a serializer's Dryad JSON. It is
+    cached on the serializer and computed again only when a new
+    value is assigned to dryadJson, so changes made to dryadJson
+    in place are not detected.
+
+    Parameters
+    ----------
+    serial : dryad2dataverse.serializer.Serializer
+    '''
+    djson = serial.dryadJson
+    cached = getattr(serial, '_dryadhash', None)
+    if cached and cached[0] is djson:
+        return cached[1]
+    value = fingerprint(djson)
+    #The JSON itself is kept, so that its id can't be reused
+    serial._dryadhash = (djson, value) #pylint: disable=protected-access
+    return value
+
+def field_fingerprints(obj:dict)->dict:
+    '''
+    Returns a dict of {top level key: fingerprint of value}.
+
+    Parameters
+    ----------
+    obj : dict
+    '''
+    return {k: fingerprint(v) for k, v in obj.items()}
+
+def _backfill_fingerprints(conn, **kwargs):
+    '''
+    Adds fingerprints for the latest version of each study.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    **kwargs
+        Monitor settings; unused.
     '''
-    def __new__(cls, *args, **kwargs):
+    #pylint: disable=unused-argument
+    rows = conn.execute('SELECT uid, dryadjson FROM dryadStudyLatest').fetchall()
+    for uid, dryadjson in rows:
+        try:
+            djson = json.loads(unpack(dryadjson))
+        except (TypeError, json.JSONDecodeError):
+            LOGGER.warning('Unreadable Dryad JSON for uid %s. No fingerprint', uid)
+            continue
+        conn.execute('INSERT OR REPLACE INTO dryadFingerprint VALUES (?, ?, ?)',
+                     (uid, fingerprint(djson), json.dumps(field_fingerprints(djson))))
+
+def _compress_json(conn, **kwargs):
+    '''
+    Compresses stored JSON with the configured codec.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    **kwargs
+        Monitor settings.
+
+    Other parameters
+    ----------------
+    dbase_compression : str
+        One of 'zlib', 'zstd' or 'none'. Default zlib.
+    '''
+    recode(conn, kwargs.get('dbase_compression', 'zlib'))
+
+def configure(conn, **kwargs):
+    '''
+    Applies connection settings to a Monitor database connection.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    **kwargs
+        Normally a dryad2dataverse.config.Config instance.
+
+    Other parameters
+    ----------------
+    dbase_wal : bool
+        Use write-ahead logging, so that other processes can read
+        the database during a run. Default True.
+    dbase_synchronous : str
+        SQLite synchronous setting. Default 'NORMAL', which is safe
+        with WAL.
+    dbase_cache_size : int
+        Page cache size in KiB. Default 65536.
+    dbase_mmap_size : int
+        Maximum bytes of the database to memory map. Default 268435456.
+    '''
+    #PRAGMA values can't be parameters, so they are checked here
+    sync = str(kwargs.get('dbase_synchronous') or 'NORMAL').upper()
+    if sync not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise exceptions.DatabaseError(f'Invalid dbase_synchronous value: {sync}')
+    wal = kwargs.get('dbase_wal', True)
+    mode = conn.execute(f'PRAGMA journal_mode = {"WAL" if wal else "DELETE"};').fetchone()[0]
+    if wal and mode.lower() not in ('wal', 'memory'):
+        LOGGER.warning('WAL mode unavailable for this database; using %s', mode)
+    conn.execute(f'PRAGMA synchronous = {sync};')
+    conn.execute(f'PRAGMA cache_size = {-abs(int(kwargs.get("dbase_cache_size", 65536)))};')
+    conn.execute(f'PRAGMA mmap_size = {int(kwargs.get("dbase_mmap_size", 2**28))};')
+    conn.execute('PRAGMA busy_timeout = 30000;')
+
+#Version 0 schema
+SCHEMA = ['CREATE TABLE IF NOT EXISTS dryadStudy \
+           (uid INTEGER PRIMARY KEY AUTOINCREMENT, \
+           doi TEXT, lastmoddate TEXT, dryadjson TEXT, \
+           dvjson TEXT);',
+           'CREATE TABLE IF NOT EXISTS dryadFiles \
+           (dryaduid INTEGER REFERENCES dryadStudy (uid), \
+           dryfilesjson TEXT);',
+           'CREATE TABLE IF NOT EXISTS dvStudy \
+           (dryaduid INTEGER references dryadStudy (uid), \
+           dvpid TEXT);',
+           'CREATE TABLE IF NOT EXISTS dvFiles \
+           (dryaduid INTEGER references dryadStudy (uid), \
+           dryfid INT, \
+           drymd5 TEXT, dvfid TEXT, dvmd5 TEXT, \
+           dvfilejson TEXT);',
+           'CREATE TABLE IF NOT EXISTS lastcheck \
+           (checkdate TEXT);',
+           'CREATE TABLE IF NOT EXISTS failed_uploads \
+           (dryaduid INTEGER references dryadstudy (uid), \
+           dryfid INT, status TEXT);'
+          ]
+
+#Schema migrations. Each entry is a list of SQL statements (or functions
+#taking a sqlite3.Connection and the Monitor settings as keyword
+#arguments) which upgrades the database by one version;
+#the current version is stored in PRAGMA user_version.
+#Append only; never edit old entries.
+MIGRATIONS = [
+    #1: Indexes for common lookups
+    ['CREATE INDEX IF NOT EXISTS idx_dryadStudy_doi ON dryadStudy (doi, uid);',
+     'CREATE INDEX IF NOT EXISTS idx_dryadFiles_dryaduid ON dryadFiles (dryaduid);',
+     'CREATE INDEX IF NOT EXISTS idx_dvStudy_dryaduid ON dvStudy (dryaduid);',
+     'CREATE INDEX IF NOT EXISTS idx_dvStudy_dvpid ON dvStudy (dvpid);',
+     'CREATE INDEX IF NOT EXISTS idx_dvFiles_dryfid ON dvFiles (dryfid);',
+     'CREATE INDEX IF NOT EXISTS idx_dvFiles_dryaduid ON dvFiles (dryaduid, dryfid);',
+     'CREATE INDEX IF NOT EXISTS idx_failed_uploads_dryaduid ON failed_uploads (dryaduid);'],
+    #2: Most recent version of each study
+    ['CREATE VIEW IF NOT EXISTS dryadStudyLatest AS \
+      SELECT * FROM dryadStudy AS d WHERE d.uid = \
+      (SELECT max(uid) FROM dryadStudy WHERE doi = d.doi);'],
+    #3: Canonical JSON fingerprints of Dryad metadata
+    ['CREATE TABLE IF NOT EXISTS dryadFingerprint \
+      (dryaduid INTEGER PRIMARY KEY REFERENCES dryadStudy (uid), \
+      dryadhash TEXT, fieldhash TEXT);',
+     _backfill_fingerprints],
+    #4: Compressed JSON. Use Monitor.recompress to change the codec
+    [_compress_json],
+    #5: Current Dataverse files and change log, replacing copied
+    #forward dvFiles rows. dvFiles is kept for history.
+    ['CREATE TABLE IF NOT EXISTS dvFilesCurrent \
+      (doi TEXT, dryfid INT, drymd5 TEXT, dvfid TEXT, dvmd5 TEXT, \
+      dvfilejson BLOB, dryaduid INTEGER REFERENCES dryadStudy (uid));',
+     'CREATE INDEX IF NOT EXISTS idx_dvFilesCurrent_doi ON dvFilesCurrent (doi, dryfid);',
+     'CREATE INDEX IF NOT EXISTS idx_dvFilesCurrent_dryfid ON dvFilesCurrent (dryfid);',
+     'CREATE INDEX IF NOT EXISTS idx_dvFilesCurrent_dvfid ON dvFilesCurrent (dvfid);',
+     'CREATE TABLE IF NOT EXISTS dvFilesLog \
+      (logid INTEGER PRIMARY KEY AUTOINCREMENT, stamp TEXT, action TEXT, \
+      doi TEXT, dryaduid INTEGER, dryfid INT, dvfid TEXT, dvmd5 TEXT);',
+     'CREATE INDEX IF NOT EXISTS idx_dvFilesLog_doi ON dvFilesLog (doi);',
+     'CREATE INDEX IF NOT EXISTS idx_dvFilesLog_dryfid ON dvFilesLog (dryfid);',
+     'INSERT INTO dvFilesCurrent \
+      SELECT s.doi, f.dryfid, f.drymd5, f.dvfid, f.dvmd5, f.dvfilejson, f.dryaduid \
+      FROM dvFiles AS f JOIN dryadStudyLatest AS s ON f.dryaduid = s.uid;'],
+    #6: Deletions of files known only from legacy dvFiles rows
+    ['CREATE INDEX IF NOT EXISTS idx_dvFiles_dvfid ON dvFiles (dvfid);'],
+    #7: Failed uploads are marked with the time they were
+    #resolved by Monitor.record_retry
+    ['ALTER TABLE failed_uploads ADD COLUMN resolved TEXT;',
+     'CREATE INDEX IF NOT EXISTS idx_failed_uploads_pending ON failed_uploads \
+      (dryaduid, dryfid) WHERE resolved IS NULL;'],
+    #8: Run journal, so that an interrupted dryadd run can be resumed
+    ['CREATE TABLE IF NOT EXISTS runJournal \
+      (runid INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT, since TEXT, \
+      finished TEXT, status TEXT);',
+     'CREATE TABLE IF NOT EXISTS runJournalStudy \
+      (runid INTEGER REFERENCES runJournal (runid), seq INTEGER, doi TEXT, \
+      record BLOB, completed TEXT, outcome TEXT, PRIMARY KEY (runid, seq));'],
+    #9: Uploads recorded as they happen. Until Monitor.update finalizes
+    #a study, its new dvFilesCurrent and dvFilesLog rows have a null dryaduid
+    ['CREATE TABLE IF NOT EXISTS pendingStudy \
+      (doi TEXT PRIMARY KEY, dvpid TEXT, started TEXT);',
+     'CREATE INDEX IF NOT EXISTS idx_dvFilesCurrent_pending ON dvFilesCurrent (doi) \
+      WHERE dryaduid IS NULL;'],
+]
+
+def _backup_before_migration(conn, version:int)->pathlib.Path:
+    '''
+    Copies a database file which contains data before it is upgraded,
+    and returns the path to the copy, or None if nothing was copied.
+
+    The copy is named after the database and the old schema version,
+    eg. monitor-premigration-v3-2024-01-31-235959.sqlite3, so that
+    it is not removed when routine backups are rotated.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    version : int
+        Current schema version.
+    '''
+    path = next((row[2] for row in conn.execute('PRAGMA database_list;')
+                 if row[1] == 'main'), '')
+    if not path or not conn.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master \
+                                     WHERE type = 'table' AND name = 'dryadStudy');"
+                                    ).fetchone()[0]:
+        return None
+    if not conn.execute('SELECT EXISTS (SELECT 1 FROM dryadStudy);').fetchone()[0]:
+        return None
+    path = pathlib.Path(path)
+    dest = path.with_name(f'{path.stem}-premigration-v{version}-'
+                          f'{datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")}'
+                          f'{path.suffix}')
+    part = dest.with_name(dest.name + '.part')
+    try:
+        target = sqlite3.connect(part)
+        try:
+            conn.backup(target)
+        finally:
+            target.close()
+        os.replace(part, dest)
+    except (OSError, sqlite3.Error) as err:
+        LOGGER.exception(err)
+        raise exceptions.DatabaseError(f'Unable to back up database before '
+                                       f'upgrading it: {err}') from err
+    finally:
+        if part.exists():
+            part.unlink()
+    LOGGER.info('Backed up database to %s before upgrading it', dest)
+    return dest
+
+def migrate(conn, **kwargs)->int:
+    '''
+    Applies any outstanding schema migrations to a Monitor
+    database and returns the resulting schema version.
+    Pending transactions are committed first.
+
+    Migrations may rewrite stored data, so a database file which
+    contains data is first copied with the SQLite online backup API.
+    See _backup_before_migration.
+
+    Each migration holds the write lock from the moment the schema
+    version is read, so processes opening the same database at the
+    same time never apply a migration twice.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    **kwargs
+        Monitor settings, such as `dbase_compression`, passed to
+        migration functions.
+    '''
+    if conn.in_transaction:
+        conn.commit()
+    version = conn.execute('PRAGMA user_version;').fetchone()[0]
+    if version < len(MIGRATIONS):
+        _backup_before_migration(conn, version)
+    while version < len(MIGRATIONS):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            #Another connection may have upgraded the database
+            #while this one waited for the lock
+            version = conn.execute('PRAGMA user_version;').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.commit()
+                break
+            num = version + 1
+            LOGGER.info('Upgrading monitor database to schema version %s', num)
+            for step in MIGRATIONS[version]:
+                if callable(step):
+                    step(conn, **kwargs)
+                else:
+                    conn.execute(step)
+            #PRAGMA does not accept parameters
+            conn.execute(f'PRAGMA user_version = {int(num)};')
+            conn.commit()
+        except Exception as err: #pylint: disable=broad-except
+            #Migration functions can fail part way through rewriting data,
+            #eg. with unreadable JSON, so every failure is rolled back
+            conn.rollback()
+            LOGGER.exception(err)
+            raise exceptions.DatabaseError(f'Unable to upgrade database to '
+                                           f'version {version + 1}: {err}') from err
+        version = num
+    return version
+
+def diff_file_lists(oldFiles, newFiles)->dict:
+    '''
+    Compares two file lists in dryad2dataverse.serializer.Serializer.files
+    format and returns a dict with lists of files to add, delete and with
+    changed hashes, in list order. Keys with no files are omitted, so
+    identical lists return an empty dict.
+
+    Download links and file IDs are not stable, so files are matched on
+    (name, mimeType, size). Each file is matched at most once, so
+    duplicate files are counted rather than merged, and files identical
+    apart from their download link are matched first. Runs in linear time.
+
+    Parameters
+    ----------
+    oldFiles : list
+        [(downLink, name, mimeType, size, descr, digestType, digest), ...]
+    newFiles : list
+        [(downLink, name, mimeType, size, descr, digestType, digest), ...]
+    '''
+    def match(files, others, key:slice)->tuple:
+        #Returns (matched, unmatched) files. Each file in others
+        #is matched at most once
+        counts = collections.Counter(x[key] for x in others)
+        matched, unmatched = [], []
+        for fil in files:
+            if counts[fil[key]] > 0:
+                counts[fil[key]] -= 1
+                matched.append(fil)
+            else:
+                unmatched.append(fil)
+        return matched, unmatched
+    #URLs are not permanent
+    no_url = slice(1, None)
+    no_hash = slice(1, 4)
+    described = slice(1, 5)
+    newLeft = match(newFiles, oldFiles, no_url)[1]
+    oldLeft = match(oldFiles, newFiles, no_url)[1]
+    if not newLeft and not oldLeft:
+        return {}
+    diffReport = {'add': match(newLeft, oldLeft, no_hash)[1],
+                  'delete': match(oldLeft, newLeft, no_hash)[1],
+                  #Identical except for the hash
+                  'hash_change': match(newLeft, oldLeft, described)[0]}
+    return {k: v for k, v in diffReport.items() if v}
+
+class _Writer(threading.Thread):
+    '''
+    Thread which owns the only writing connection to a Monitor database.
+    Jobs run in the order they are submitted, and jobs which are
+    queued together are committed in a single transaction.
+    '''
+    def __init__(self, connect, group:int=32):
+        '''
+        Parameters
+        ----------
+        connect : callable
+            Returns a new sqlite3.Connection to the database.
+        group : int
+            Maximum number of jobs per transaction.
+        '''
+        super().__init__(name='dryad2dataverse-monitor-writer', daemon=True)
+        self.connect = connect
+        self.group = max(1, int(group))
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        #Incremented after every commit; used to invalidate cached reads
+        self.generation = 0
+        self.start()
+
+    def submit(self, func, *args, transaction:bool=True)->concurrent.futures.Future:
         '''
-        Creates a new singleton instance of Monitor.
+        Queues func(cursor, *args) and returns a Future which is
+        resolved with its result once the job is committed.
 
         Parameters
         ----------
+        func : callable
+            Takes a sqlite3.Cursor as its first argument. Must not commit.
         *args
+            Arguments for func.
+        transaction : bool
+            If False, func runs by itself outside a transaction,
+            eg. for VACUUM.
+        '''
+        fut = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                raise exceptions.DatabaseError('Monitor database is closed')
+            self.jobs.put((fut, func, args, transaction))
+        return fut
+
+    def close(self):
+        '''
+        Finishes all queued jobs and stops the thread.
+        '''
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.jobs.put(None)
+        if self is not threading.current_thread():
+            self.join()
+
+    def run(self):
+        conn = self.connect()
+        #Transactions are managed explicitly
+        conn.isolation_level = None
+        try:
+            pending = []
+            while True:
+                job = pending.pop() if pending else self.jobs.get()
+                if job is None:
+                    break
+                if not job[3]:
+                    self._run_alone(conn, job)
+                    continue
+                batch = [job]
+                while len(batch) < self.group:
+                    try:
+                        job = self.jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None or not job[3]:
+                        #Run after this batch
+                        pending.append(job)
+                        break
+                    batch.append(job)
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _run_alone(self, conn, job):
+        '''
+        Runs a job outside a transaction.
+
+        Parameters
+        ----------
+        conn : sqlite3.Connection
+        job : tuple
+            (Future, func, args, transaction)
+        '''
+        #pylint: disable=broad-except
+        fut, func, args, _ = job
+        if not fut.set_running_or_notify_cancel():
+            return
+        try:
+            result = func(conn.cursor(), *args)
+        except Exception as err:
+            fut.set_exception(err)
+            return
+        self.generation += 1
+        fut.set_result(result)
+
+    def _commit(self, conn, batch):
+        '''
+        Runs a batch of jobs in one transaction. Each job has its own
+        savepoint, so a failed job does not affect the others.
+
+        Parameters
+        ----------
+        conn : sqlite3.Connection
+        batch : list
+            List of (Future, func, args, transaction) tuples.
+        '''
+        #pylint: disable=broad-except
+        batch = [b for b in batch if b[0].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as err:
+            LOGGER.exception(err)
+            for fut, *_ in batch:
+                fut.set_exception(exceptions.DatabaseError(f'Unable to write: {err}'))
+            return
+        done = []
+        for fut, func, args, _ in batch:
+            conn.execute('SAVEPOINT job')
+            try:
+                result = func(conn.cursor(), *args)
+                conn.execute('RELEASE job')
+                done.append((fut, result))
+            except Exception as err:
+                conn.execute('ROLLBACK TO job')
+                conn.execute('RELEASE job')
+                fut.set_exception(err)
+        try:
+            conn.execute('COMMIT')
+        except sqlite3.Error as err:
+            LOGGER.exception(err)
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for fut, _ in done:
+                fut.set_exception(exceptions.DatabaseError(f'Unable to commit: {err}'))
+            return
+        LOGGER.debug('Committed %s monitor update(s)', len(batch))
+        self.generation += 1
+        for fut, result in done:
+            fut.set_result(result)
+
+class _Database():
+    '''
+    The connections to one Monitor database: a read connection for
+    each thread and a writer thread. Shared by every Monitor
+    instance which uses the same database file.
+    '''
+    def __init__(self, path, **kwargs):
+        '''
+        Creates or upgrades the database.
+
+        Parameters
+        ----------
+        path : Union[str, pathlib.Path]
+            Path to database, or ':memory:'
         **kwargs
+            Connection settings. See dryad2dataverse.monitor.configure.
         '''
-        if not hasattr(cls, 'inst'):
-            cls.inst = super().__new__(cls)
-            #This ensures only the first set of kwargs (on instantiation)
-            #are used.
-            cls.init = 0
-            cls.kwargs = kwargs
-            if not cls.kwargs.get('dbase'):
-                try:
-                    cls.kwargs['dbase'] = args[0]
-                except ValueError as e:
-                    raise KeyError from e
-            cls.conn = sqlite3.connect(pathlib.Path(cls.kwargs['dbase']).expanduser().absolute())
-            cls.cursor = cls.conn.cursor()
-            LOGGER.info('Open database %s', cls.kwargs['dbase'])
-        return cls.inst
+        if str(path) == ':memory:':
+            #Shared so that all threads see the same database
+            self.target = f'file:dryad2dataverse-{id(self)}?mode=memory&cache=shared'
+        else:
+            self.target = pathlib.Path(path).expanduser().absolute()
+        self.kwargs = kwargs
+        self.refs = 0
+        self.local = threading.local()
+        self.readers = []
+        self.lock = threading.Lock()
+        #The creating thread's connection also keeps
+        #an in-memory database alive
+        conn = self.connect(new=True)
+        self.local.conn = conn
+        self.readers.append(conn)
+        for line in SCHEMA:
+            conn.execute(line)
+        conn.commit()
+        migrate(conn, **kwargs)
+        self.writer = _Writer(self.connect, kwargs.get('dbase_group_commit') or 32)
+        LOGGER.info('Open database %s', path)
+
+    def connect(self, new:bool=False):
+        '''
+        Returns a new, configured connection to the database.
+
+        Parameters
+        ----------
+        new : bool
+            First connection, which may create the database.
+        '''
+        uri = isinstance(self.target, str)
+        conn = sqlite3.connect(self.target, uri=uri, timeout=30,
+                               check_same_thread=False)
+        if new:
+            #Must precede WAL, and only takes effect if the database
+            #has no tables yet. See Monitor.vacuum
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+        configure(conn, **self.kwargs)
+        if uri:
+            #Shared cache connections otherwise lock each other's tables
+            conn.execute('PRAGMA read_uncommitted = 1;')
+        return conn
+
+    def reader(self):
+        '''
+        Returns the read connection for the current thread.
+        '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            self.local.conn = conn
+            with self.lock:
+                self.readers.append(conn)
+        return conn
+
+    def submit(self, func, *args, transaction:bool=True)->concurrent.futures.Future:
+        '''
+        Queues a write for the writer thread. See _Writer.submit.
+
+        Parameters
+        ----------
+        func : callable
+        *args
+        transaction : bool
+        '''
+        #Uncommitted writes on this thread's connection would block the writer
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and conn.in_transaction:
+            conn.commit()
+        return self.writer.submit(func, *args, transaction=transaction)
+
+    def close(self):
+        '''
+        Commits all queued updates and closes all connections.
+        '''
+        self.writer.close()
+        with self.lock:
+            readers, self.readers = self.readers, []
+        for conn in readers:
+            conn.commit()
+            conn.close()
+        LOGGER.info('Closed database %s', self.target)
 
+#Open databases, by path. Each in-memory database has its own key
+_DATABASES = {}
+_DATABASES_LOCK = threading.Lock()
+
+def _open_database(path, **kwargs)->_Database:
+    '''
+    Returns the open _Database for a path, opening it if required.
+    Each ':memory:' database is separate.
+
+    Parameters
+    ----------
+    path : Union[str, pathlib.Path]
+    **kwargs
+        Connection settings, used only if the database is not yet open.
+    '''
+    memory = str(path) == ':memory:'
+    key = None if memory else pathlib.Path(path).expanduser().absolute()
+    with _DATABASES_LOCK:
+        db = _DATABASES.get(key)
+        if db is None:
+            db = _Database(path, **kwargs)
+            _DATABASES[(path, id(db)) if memory else key] = db
+        db.refs += 1
+        return db
+
+def _release_database(db:_Database):
+    '''
+    Releases a reference to a _Database, closing it if
+    it is no longer used.
+
+    Parameters
+    ----------
+    db : _Database
+    '''
+    with _DATABASES_LOCK:
+        db.refs -= 1
+        if db.refs > 0:
+            return
+        for key, value in list(_DATABASES.items()):
+            if value is db:
+                del _DATABASES[key]
+    db.close()
+
+@atexit.register
+def _close_databases():
+    '''
+    Commits queued updates for databases which are still open
+    at exit, while the writer threads are still running.
+    '''
+    with _DATABASES_LOCK:
+        dbs = list(_DATABASES.values())
+        _DATABASES.clear()
+    for db in dbs:
+        db.close()
+
+class Monitor():
+    '''
+    The Monitor object is a tracker and database updater, so that
+    Dryad files can be monitored and updated over time.
+
+    Each Monitor is independent, so several databases can be used at
+    once. Monitors using the same database file share its connections.
+    Use Monitor as a context manager, or call Monitor.close when done.
+
+    Monitor is thread-safe. Each thread reads with its own connection;
+    updates are queued for a single writer thread, which commits
+    queued updates from many studies together.
+    '''
     def __init__(self, *args, **kwargs):
         '''
-        Initialize singleton instance of Monitor
+        Initialize instance of Monitor
 
         Parameters
         ----------
         *args
             Positional arguments. Only the first is used
         **kwargs
-            Keyword arguments. Only dbase is used, and it overwrites args[0] if present
+            Keyword arguments. Only dbase is required, and it overwrites
+            args[0] if present
 
         Notes
         -----
@@ -70,63 +814,346 @@ class Monitor():
         These keyword parameters are required at a minimum, and are included as part of a
         Config instance.
         dbase : str
-            Path to dryad2dataverse monitor database
+            Path to dryad2dataverse monitor database, or ':memory:'
+            for a temporary database.
         dry_url : str
             Dryad base URL
+
+        Optional keyword parameters:
+        dbase_compression : str
+            Compression for stored JSON: 'zlib' (default), 'zstd' or 'none'.
+        dbase_wal, dbase_synchronous, dbase_cache_size, dbase_mmap_size
+            Connection settings. See dryad2dataverse.monitor.configure.
+        dbase_group_commit : int
+            Maximum number of queued updates committed in one
+            transaction. Default 32.
+
+        Connection settings and dbase_group_commit are taken from the
+        first Monitor to open a database file.
         '''
-        #pylint: disable=unused-argument
-        #arguments are parsed in __new__ to make a singleton
-        #but they need to be passed in __init__
-        if not self.init:
-
-            conn = sqlite3.connect(pathlib.Path(self.kwargs['dbase']).expanduser().absolute())
-            cursor = conn.cursor()
-            create = ['CREATE TABLE IF NOT EXISTS dryadStudy \
-                       (uid INTEGER PRIMARY KEY AUTOINCREMENT, \
-                       doi TEXT, lastmoddate TEXT, dryadjson TEXT, \
-                       dvjson TEXT);',
-                       'CREATE TABLE IF NOT EXISTS dryadFiles \
-                       (dryaduid INTEGER REFERENCES dryadStudy (uid), \
-                       dryfilesjson TEXT);',
-                       'CREATE TABLE IF NOT EXISTS dvStudy \
-                       (dryaduid INTEGER references dryadStudy (uid), \
-                       dvpid TEXT);',
-                       'CREATE TABLE IF NOT EXISTS dvFiles \
-                       (dryaduid INTEGER references dryadStudy (uid), \
-                       dryfid INT, \
-                       drymd5 TEXT, dvfid TEXT, dvmd5 TEXT, \
-                       dvfilejson TEXT);',
-                       'CREATE TABLE IF NOT EXISTS lastcheck \
-                       (checkdate TEXT);',
-                       'CREATE TABLE IF NOT EXISTS failed_uploads \
-                       (dryaduid INTEGER references dryadstudy (uid), \
-                       dryfid INT, status TEXT);'
-                      ]
-
-            for line in create:
-                cursor.execute(line)
-            conn.commit()
-            conn.close()
-        self.init = 1
+        self.kwargs = kwargs
+        if not self.kwargs.get('dbase'):
+            try:
+                self.kwargs['dbase'] = args[0]
+            except IndexError as e:
+                raise KeyError('dbase') from e
+        self._memo = {}
+        self._generation = 0
+        self._db = _open_database(self.kwargs['dbase'], **self.kwargs)
+        self.conn = self._db.reader()
+        self.cursor = self.conn.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def __del__(self):
         '''
         Commits all database transactions on object deletion and closes database.
         '''
-        self.conn.commit()
-        self.conn.close()
+        #Writer threads can't run during interpreter shutdown
+        if getattr(self, '_db', None) and not sys.is_finalizing():
+            self.close()
+
+    @property
+    def _database(self)->_Database:
+        '''
+        Returns the open database, or raises DatabaseError if
+        the Monitor is closed.
+        '''
+        if not self._db:
+            raise exceptions.DatabaseError('Monitor is closed')
+        return self._db
+
+    def _reader(self):
+        '''
+        Returns the read connection for the current thread.
+        '''
+        return self._database.reader()
+
+    def _cursor(self):
+        '''
+        Returns a new cursor for the current thread's read connection.
+        '''
+        return self._reader().cursor()
+
+    def _submit(self, func, *args, transaction:bool=True)->concurrent.futures.Future:
+        '''
+        Queues a write for the writer thread. See _Writer.submit.
+
+        Parameters
+        ----------
+        func : callable
+        *args
+        transaction : bool
+        '''
+        return self._database.submit(func, *args, transaction=transaction)
+
+    def flush(self):
+        '''
+        Waits until all queued updates are committed.
+        '''
+        self._submit(lambda cursor: None).result()
+
+    def close(self):
+        '''
+        Commits all queued updates and releases the database. Its
+        connections are closed once no other Monitor is using it.
+        '''
+        if not self._db:
+            return
+        try:
+            if not self._db.writer.closed:
+                self.flush()
+        finally:
+            db, self._db = self._db, None
+            _release_database(db)
 
     @property
     def lastmod(self):
         '''
         Returns last modification date from monitor.dbase.
         '''
-        self.cursor.execute('SELECT checkdate FROM lastcheck ORDER BY rowid DESC;')
-        last_mod = self.cursor.fetchall()
+        cursor = self._cursor()
+        cursor.execute('SELECT checkdate FROM lastcheck ORDER BY rowid DESC;')
+        last_mod = cursor.fetchall()
         if last_mod:
             return last_mod[0][0]
         return None
 
+    def _pack(self, text):
+        '''
+        Compresses text for storage with the configured codec.
+
+        Parameters
+        ----------
+        text : str
+        '''
+        return pack(text, self.kwargs.get('dbase_compression', 'zlib'))
+
+    def recompress(self, codec=None)->int:
+        '''
+        Rewrites all stored JSON using a compression codec and returns
+        the number of values changed. Run VACUUM afterwards to reclaim
+        the space.
+
+        Parameters
+        ----------
+        codec : str
+            One of 'zlib', 'zstd' or 'none'. Defaults to the
+            `dbase_compression` setting, or zlib.
+        '''
+        if not codec:
+            codec = self.kwargs.get('dbase_compression', 'zlib')
+        changed = self._submit(lambda cursor: recode(cursor.connection, codec)).result()
+        self.clear_cache()
+        LOGGER.info('Recompressed %s values with %s', changed, codec)
+        return changed
+
+    def backup(self, dest=None, compress:bool=False, pages:int=-1)->pathlib.Path:
+        '''
+        Copies the database with the SQLite online backup API, which
+        makes a consistent copy while the database is in use, and
+        returns the path to the copy.
+
+        Parameters
+        ----------
+        dest : Union[str, pathlib.Path]
+            Backup file. Defaults to the database path with the current
+            time appended to the name, eg. monitor_2024-01-31-2359.sqlite3
+        compress : bool
+            Compress the backup with gzip and add '.gz' to the file name.
+        pages : int
+            Database pages copied per step. The default copies the whole
+            database in one read transaction, which does not block the
+            writer in WAL mode. Positive values let other connections lock
+            the database between steps, but their writes restart the copy.
+        '''
+        if not dest:
+            if str(self.kwargs['dbase']) == ':memory:':
+                raise exceptions.DatabaseError('In-memory databases require '
+                                               'a backup destination')
+            path = pathlib.Path(self.kwargs['dbase']).expanduser().absolute()
+            dest = path.with_name(f'{path.stem}_'
+                                  f'{datetime.datetime.now().strftime("%Y-%m-%d-%H%M")}'
+                                  f'{path.suffix}')
+        dest = pathlib.Path(dest).expanduser().absolute()
+        if compress and dest.suffix != '.gz':
+            dest = dest.with_name(dest.name + '.gz')
+        #Partial copies never have the final name
+        part = dest.with_name(dest.name + '.part')
+        raw = part.with_name(dest.stem + '.part') if compress else part
+        source = self._database.connect()
+        try:
+            target = sqlite3.connect(raw)
+            try:
+                source.backup(target, pages=pages)
+            finally:
+                target.close()
+            if compress:
+                with open(raw, 'rb') as fin, gzip.open(part, 'wb') as fout:
+                    shutil.copyfileobj(fin, fout, 2**22)
+            os.replace(part, dest)
+        finally:
+            source.close()
+            for fil in (raw, part):
+                if fil.exists():
+                    fil.unlink()
+        LOGGER.info('Backed up database to %s', dest)
+        return dest
+
+    @staticmethod
+    def _prune(cursor, keep_last:int, cutoff)->dict:
+        '''
+        Deletes superseded study versions. Runs in the writer thread.
+        See Monitor.prune.
+
+        Parameters
+        ----------
+        cursor : sqlite3.Cursor
+            Writer cursor.
+        keep_last : int
+        cutoff : str
+            ISO date, or None.
+        '''
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS prune (uid INTEGER PRIMARY KEY);')
+        cursor.execute('DELETE FROM temp.prune;')
+        cursor.execute('INSERT INTO temp.prune SELECT uid FROM \
+                        (SELECT uid, lastmoddate, row_number() OVER \
+                        (PARTITION BY doi ORDER BY uid DESC) AS num FROM dryadStudy) \
+                        WHERE num > ? AND (? IS NULL OR lastmoddate < ?);',
+                       (keep_last, cutoff, cutoff))
+        #Failed uploads can be retried, and current files
+        #keep the version in which they were uploaded
+        cursor.execute('DELETE FROM temp.prune WHERE \
+                        uid IN (SELECT dryaduid FROM failed_uploads \
+                                WHERE resolved IS NULL) OR \
+                        uid IN (SELECT dryaduid FROM dvFilesCurrent);')
+        #get_dv_fid never reads legacy dvFiles rows for files in
+        #dvFilesCurrent or dvFilesLog; otherwise it uses the newest row
+        cursor.execute('DELETE FROM dvFiles WHERE dryaduid IN temp.prune AND \
+                        (dryfid IN (SELECT dryfid FROM dvFilesCurrent) OR \
+                        dryfid IN (SELECT dryfid FROM dvFilesLog) OR \
+                        rowid NOT IN (SELECT max(rowid) FROM dvFiles GROUP BY dryfid));')
+        dvfiles = cursor.rowcount
+        cursor.execute('DELETE FROM temp.prune WHERE uid IN (SELECT dryaduid FROM dvFiles);')
+        for table in ('dryadFiles', 'dryadFingerprint', 'dvStudy', 'failed_uploads'):
+            cursor.execute(f'DELETE FROM {table} WHERE dryaduid IN temp.prune;')
+        cursor.execute('DELETE FROM dryadStudy WHERE uid IN temp.prune;')
+        return {'dryadStudy': cursor.rowcount, 'dvFiles': dvfiles}
+
+    def prune(self, keep_last:int=None, older_than=None)->dict:
+        '''
+        Deletes superseded versions of studies and returns the number
+        of dryadStudy and dvFiles rows deleted. The most recent version
+        of each study is always kept, as are versions with unresolved failed
+        uploads or current Dataverse files, and the dvFiles rows which
+        Monitor.get_dv_fid still uses. Run Monitor.vacuum afterwards
+        to reclaim the space.
+
+        If both keep_last and older_than are given, only versions
+        matching both are deleted.
+
+        Parameters
+        ----------
+        keep_last : int
+            Number of versions of each study to keep.
+        older_than : Union[int, datetime.datetime]
+            Delete versions last modified before this date, or
+            this number of days ago.
+        '''
+        if not keep_last and older_than is None:
+            raise ValueError('keep_last or older_than is required')
+        cutoff = None
+        if older_than is not None:
+            if not isinstance(older_than, datetime.date):
+                older_than = (datetime.datetime.now(datetime.timezone.utc) -
+                              datetime.timedelta(days=older_than))
+            cutoff = older_than.strftime('%Y-%m-%d')
+        counts = self._submit(self._prune, max(int(keep_last or 1), 1), cutoff).result()
+        self.clear_cache()
+        LOGGER.info('Pruned %s study versions and %s file records',
+                    counts['dryadStudy'], counts['dvFiles'])
+        return counts
+
+    def vacuum(self, pages:int=0)->int:
+        '''
+        Returns unused database pages to the file system with an
+        incremental vacuum, and returns the number of pages freed.
+        Databases created before incremental vacuuming are converted
+        with a full VACUUM the first time, which may take some time.
+
+        Parameters
+        ----------
+        pages : int
+            Maximum number of pages to free. 0 frees all.
+        '''
+        def _vacuum(cursor):
+            before = cursor.execute('PRAGMA freelist_count;').fetchone()[0]
+            if cursor.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+                LOGGER.info('Enabling incremental vacuum with a full VACUUM')
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+                cursor.execute('VACUUM;')
+            else:
+                #Each result row is a step, so they must all be fetched
+                cursor.execute(f'PRAGMA incremental_vacuum({int(pages)});').fetchall()
+            cursor.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchall()
+            return before - cursor.execute('PRAGMA freelist_count;').fetchone()[0]
+        freed = self._submit(_vacuum, transaction=False).result()
+        LOGGER.info('Vacuum freed %s pages', freed)
+        return freed
+
+    def clear_cache(self):
+        '''
+        Discards all memoized status and diff results.
+        '''
+        self._memo.clear()
+        self._generation += 1
+
+    def _memo_key(self, serial, *extra)->tuple:
+        '''
+        Returns the memoization key for a serializer. Results are
+        reused only while the Dryad metadata and the database
+        are unchanged. The Dryad JSON fingerprint is cached on the
+        serializer; see serial_fingerprint.
+
+        Parameters
+        ----------
+        serial : dryad2dataverse.serializer.Serializer
+        *extra
+            Additional key components.
+        '''
+        return (serial.dryadJson.get('identifier'),
+                serial.dryadJson.get('lastModificationDate'),
+                serial_fingerprint(serial), *extra,
+                self._reader().total_changes, self._database.writer.generation,
+                self._generation)
+
+    def _memoized(self, name, key, func, *args):
+        '''
+        Returns func(*args), reusing the previous result for the same
+        method and DOI if the key is unchanged.
+
+        Parameters
+        ----------
+        name : str
+            Method name.
+        key : tuple
+            Output of Monitor._memo_key.
+        func : callable
+        *args
+            Arguments for func.
+        '''
+        hit = self._memo.get((name, key[0]))
+        if hit and hit[0] == key:
+            return hit[1]
+        value = func(*args)
+        #Only the most recent state of each study is kept
+        self._memo[(name, key[0])] = (key, value)
+        return value
+
     def status(self, serial)->dict:
         '''
         Returns a dictionary with keys 'status' and 'dvpid' and 'notes'.
@@ -170,7 +1197,25 @@ class Monitor():
         not `new` or `identical`. Note that Dryad has no way to indicate *both*
         a file and metadata change, so this value reflects only the *last* change
         in the Dryad state.
+
+        Results are memoized until a new value is assigned to the
+        serializer's dryadJson or the database changes. Don't change
+        dryadJson in place.
+        '''
+        out = self._memoized('status', self._memo_key(serial), self._status, serial)
+        if out['dvpid']:
+            serial.dvpid = out['dvpid']
+        return dict(out)
+
+    def _status(self, serial)->dict:
+        '''
+        Uncached Monitor.status.
+
+        Parameters
+        ----------
+        serial :  dryad2dataverse.serializer.Serializer
         '''
+        cursor = self._cursor()
         # Last mod date is indicator of change.
         # From email w/Ryan Scherle 10 Nov 2020
         #The versionNumber updates for either a metadata change or a
@@ -194,35 +1239,116 @@ class Monitor():
         ## So now what?
         #############################
         doi = serial.dryadJson['identifier']
-        self.cursor.execute('SELECT * FROM dryadStudy WHERE doi = ?',
-                            (doi,))
-        result = self.cursor.fetchall()
+        cursor.execute('SELECT l.uid, l.lastmoddate, f.dryadhash \
+                        FROM dryadStudyLatest AS l LEFT JOIN dryadFingerprint AS f \
+                        ON f.dryaduid = l.uid WHERE l.doi = ?',
+                       (doi,))
+        result = cursor.fetchone()
 
         if not result:
             return {'status': 'new', 'dvpid': None, 'notes': ''}
-        # dvjson = json.loads(result[-1][4])
         # Check the fresh vs. updated jsons for the keys
         try:
-            dryaduid = result[-1][0]
-            self.cursor.execute('SELECT dvpid from dvStudy WHERE \
-                                 dryaduid = ?', (dryaduid,))
-            dvpid = self.cursor.fetchall()[-1][0]
+            dryaduid = result[0]
+            cursor.execute('SELECT dvpid from dvStudy WHERE \
+                            dryaduid = ?', (dryaduid,))
+            dvpid = cursor.fetchall()[-1][0]
             serial.dvpid = dvpid
         except TypeError as exc:
             LOGGER.error('Dryad DOI : %s. Error finding Dataverse PID', doi)
             LOGGER.exception(exc)
             raise exceptions.DatabaseError from exc
 
-        newfile = copy.deepcopy(serial.dryadJson)
-        testfile = copy.deepcopy(json.loads(result[-1][3]))
-        if newfile == testfile:
-            return {'status': 'identical', 'dvpid': dvpid, 'notes': ''}
-        if newfile['lastModificationDate'] != testfile['lastModificationDate']:
+        newfile = serial.dryadJson
+        if result[2]:
+            #Compare fingerprints and avoid parsing the stored JSON
+            if serial_fingerprint(serial) == result[2]:
+                return {'status': 'identical', 'dvpid': dvpid, 'notes': ''}
+            oldmod = result[1]
+        else:
+            #No fingerprint, so compare the documents
+            cursor.execute('SELECT dryadjson FROM dryadStudy WHERE uid = ?',
+                           (dryaduid,))
+            testfile = json.loads(unpack(cursor.fetchone()[0]))
+            if newfile == testfile:
+                return {'status': 'identical', 'dvpid': dvpid, 'notes': ''}
+            oldmod = testfile['lastModificationDate']
+        if newfile['lastModificationDate'] != oldmod:
             return {'status': 'updated', 'dvpid': dvpid,
                     'notes': newfile['versionChanges']}
         return {'status': 'lastmodsame', 'dvpid': dvpid,
                      'notes': newfile.get('versionChanges')}
 
+    def bulk_status(self, records, batch:int=450)->dict:
+        '''
+        Classifies a whole harvest at once. Returns a dict of
+        {doi: {'status', 'dvpid', 'notes'}}, with the same values
+        as Monitor.status.
+
+        Studies which can't be classified, such as those with no
+        Dataverse PID, are logged and left out, so that Monitor.status
+        can be used for them.
+
+        Parameters
+        ----------
+        records : list
+            [(doi, Dryad JSON), ...], as from dryadd.get_records.
+        batch : int
+            Maximum number of studies per query.
+
+        Notes
+        -----
+        Each batch of the harvest is joined with the latest version
+        of each study in a single query. Stored JSON is only read
+        for studies without a fingerprint.
+        '''
+        djson = dict(records)
+        harvest = [(doi, fingerprint(dry)) for doi, dry in djson.items()]
+        cursor = self._cursor()
+        rows = []
+        for start in range(0, len(harvest), batch):
+            chunk = harvest[start:start+batch]
+            cursor.execute(f'WITH harvest (doi, dryadhash) AS \
+                             (VALUES {", ".join(["(?, ?)"] * len(chunk))}) \
+                             SELECT h.doi, h.dryadhash, l.uid, l.lastmoddate, \
+                             f.dryadhash, \
+                             CASE WHEN f.dryadhash IS NULL THEN l.dryadjson END, \
+                             (SELECT dvpid FROM dvStudy WHERE dryaduid = l.uid \
+                              ORDER BY rowid DESC LIMIT 1) \
+                             FROM harvest AS h \
+                             LEFT JOIN dryadStudyLatest AS l ON l.doi = h.doi \
+                             LEFT JOIN dryadFingerprint AS f ON f.dryaduid = l.uid;',
+                           [val for row in chunk for val in row])
+            rows.extend(cursor.fetchall())
+        out = {}
+        for doi, newhash, uid, oldmod, oldhash, oldjson, dvpid in rows:
+            if uid is None:
+                out[doi] = {'status': 'new', 'dvpid': None, 'notes': ''}
+                continue
+            if not dvpid:
+                LOGGER.error('Dryad DOI : %s. Error finding Dataverse PID', doi)
+                continue
+            newfile = djson[doi]
+            if oldhash:
+                identical = newhash == oldhash
+            else:
+                try:
+                    testfile = json.loads(unpack(oldjson))
+                except (TypeError, json.JSONDecodeError, exceptions.DatabaseError) as err:
+                    LOGGER.error('Dryad DOI : %s. Unreadable stored JSON: %s', doi, err)
+                    continue
+                identical = newfile == testfile
+                oldmod = testfile['lastModificationDate']
+            if identical:
+                out[doi] = {'status': 'identical', 'dvpid': dvpid, 'notes': ''}
+            elif newfile['lastModificationDate'] != oldmod:
+                out[doi] = {'status': 'updated', 'dvpid': dvpid,
+                            'notes': newfile.get('versionChanges')}
+            else:
+                out[doi] = {'status': 'lastmodsame', 'dvpid': dvpid,
+                            'notes': newfile.get('versionChanges')}
+        return out
+
     def diff_metadata(self, serial):
         '''
         Analyzes differences in metadata between current serializer
@@ -247,46 +1373,44 @@ class Monitor():
         ]
         ```
         '''
-        if self.status(serial)['status'] == 'updated':
-            self.cursor.execute('SELECT dryadjson from dryadStudy \
-                                 WHERE doi = ?',
-                                (serial.dryadJson['identifier'],))
-            oldJson = json.loads(self.cursor.fetchall()[-1][0])
-            out = []
-            for k in serial.dryadJson:
-                if serial.dryadJson[k] != oldJson.get(k):
-                    out.append({k: (oldJson.get(k), serial.dryadJson[k])})
-            return out
-
-        return None
+        out = self._memoized('diff_metadata', self._memo_key(serial),
+                             self._diff_metadata, serial)
+        if out is None:
+            return None
+        return list(out)
 
-    @staticmethod
-    def __added_hashes(oldFiles, newFiles):
+    def _diff_metadata(self, serial):
         '''
-        Checks that two objects in dryad2dataverse.serializer.files format
-        stripped of digestType and digest values are identical. Returns array
-        of files with changed hash.
-
-        Assumes name, mimeType, size, descr all unchanged, which is not
-        necessarily a valid assumption
+        Uncached Monitor.diff_metadata.
 
         Parameters
         ----------
-        oldFiles : Union[list, tuple]
-            (name, mimeType, size, descr, digestType, digest)
-
-        newFiles : Union[list, tuple]
-            (name, mimeType, size, descr, digestType, digest)
+        serial : dryad2dataverse.serializer.Serializer
         '''
-        hash_change = []
-        old = [x[1:-2] for x in oldFiles]
-        #URLs are not permanent
-        old_no_url = [x[1:] for x in oldFiles]
-        for fi in newFiles:
-            if fi[1:-2] in old and fi[1:] not in old_no_url:
-                hash_change.append(fi)
-        return hash_change
+        cursor = self._cursor()
+        if self.status(serial)['status'] == 'updated':
+            cursor.execute('SELECT l.uid, f.fieldhash FROM dryadStudyLatest AS l \
+                            LEFT JOIN dryadFingerprint AS f ON f.dryaduid = l.uid \
+                            WHERE l.doi = ?',
+                           (serial.dryadJson['identifier'],))
+            uid, fieldhash = cursor.fetchone()
+            keys = list(serial.dryadJson)
+            if fieldhash:
+                #Only changed fields need the old document
+                oldhash = json.loads(fieldhash)
+                keys = [k for k, v in field_fingerprints(serial.dryadJson).items()
+                        if v != oldhash.get(k)]
+                if not keys:
+                    return []
+            cursor.execute('SELECT dryadjson from dryadStudy WHERE uid = ?', (uid,))
+            oldJson = json.loads(unpack(cursor.fetchone()[0]))
+            out = []
+            for k in keys:
+                if serial.dryadJson[k] != oldJson.get(k):
+                    out.append({k: (oldJson.get(k), serial.dryadJson[k])})
+            return out
 
+        return None
 
     def diff_files(self, serial):
         '''
@@ -305,23 +1429,37 @@ class Monitor():
         `{'add':[dyadfiletuples], 'delete:[dryadfiletuples],
           'hash_change': [dryadfiletuples]}`
 
+        Parameters
+        ----------
+        serial : dryad2dataverse.serializer.Serializer
+        '''
+        out = self._memoized('diff_files',
+                             self._memo_key(serial, tuple(serial.files)),
+                             self._diff_files, serial)
+        return {k: list(v) for k, v in out.items()}
+
+    def _diff_files(self, serial):
+        '''
+        Uncached Monitor.diff_files.
+
         Parameters
         ----------
         serial : dryad2dataverse.serializer.Serializer
         '''
         #pylint: disable=too-many-locals
+        cursor = self._cursor()
 
-        diffReport = {}
         if self.status(serial)['status'] == 'new':
             #do we want to show what needs to be added?
             return {'add': serial.files}
             #return {}
-        self.cursor.execute('SELECT uid from dryadStudy WHERE doi = ?',
-                            (serial.doi,))
-        mostRecent = self.cursor.fetchall()[-1][0]
-        self.cursor.execute('SELECT dryfilesjson from dryadFiles WHERE \
-                             dryaduid = ?', (mostRecent,))
-        oldFileList = self.cursor.fetchall()[-1][0]
+        cursor.execute('SELECT uid from dryadStudyLatest WHERE doi = ?',
+                       (serial.doi,))
+        mostRecent = cursor.fetchone()[0]
+        cursor.execute('SELECT dryfilesjson from dryadFiles WHERE \
+                        dryaduid = ?', (mostRecent,))
+        oldFileList = unpack(cursor.fetchall()[-1][0])
+        oldFiles = []
         if not oldFileList:
             oldFileList = []
         else:
@@ -349,46 +1487,12 @@ class Monitor():
                     digest = f.get('digest', '')
                     out.append((downLink, name, mimeType, size, descr, digestType, digest))
                 oldFiles = out
-        newFiles = serial.files[:]
-        # Tests go here
-        #Check for identity first
-        #if returned here there are definitely no changes
-        if (set(oldFiles).issuperset(set(newFiles)) and
-                set(newFiles).issuperset(oldFiles)):
-            return diffReport
-        #filenames for checking hash changes.
-        #Can't use URL or hashes for comparisons because they can change
-        #without warning, despite the fact that the API says that
-        #file IDs are unique. They aren't. Verified by Ryan Scherle at
-        #Dryad December 2021
-        old_map = {x:{'orig':y, 'no_hash':y[1:4]} for x,y in enumerate(oldFiles)}
-        new_map = {x:{'orig':y, 'no_hash':y[1:4]} for x,y in enumerate(newFiles)}
-        old_no_hash = [old_map[x]['no_hash'] for x in old_map]
-        new_no_hash = [new_map[x]['no_hash'] for x in new_map]
-
-        #check for added hash only
-        hash_change = Monitor.__added_hashes(oldFiles, newFiles)
-
-        must = set(old_no_hash).issuperset(set(new_no_hash))
-        if not must:
-            needsadd = set(new_no_hash) - (set(old_no_hash) & set(new_no_hash))
-            #Use the map created above to return the full file info
-            diffReport.update({'add': [new_map[new_no_hash.index(x)]['orig']
-                                       for x in needsadd]})
-        must = set(new_no_hash).issuperset(old_no_hash)
-        if not must:
-            needsdel = set(old_no_hash) - (set(new_no_hash) & set(old_no_hash))
-            diffReport.update({'delete' : [old_map[old_no_hash.index(x)]['orig']
-                                           for x in needsdel]})
-        if hash_change:
-            diffReport.update({'hash_change': hash_change})
-        return diffReport
+        return diff_file_lists(oldFiles, serial.files)
 
-    def get_dv_fid(self, url):
+    @staticmethod
+    def _dryad_fid(url)->int:
         '''
-        Returns str — the Dataverse file ID from parsing a Dryad
-        file download link.  Normally used for determining dataverse
-        file ids for *deletion* in case of dryad file changes.
+        Returns the Dryad file ID from a Dryad file download link.
 
         Parameters
         ----------
@@ -398,22 +1502,59 @@ class Monitor():
         '''
         fid = url[url.rfind('/', 0, -10)+1:].strip('/download')
         try:
-            fid = int(fid)
+            return int(fid)
         except ValueError as e:
             LOGGER.error('File ID %s is not an integer', fid)
             LOGGER.exception(e)
             raise
 
-        #File IDs are *CHANGEABLE* according to Dryad, Dec 2021
-        #SQLite default returns are by ROWID ASC, so the last record
-        #returned should still be the correct, ie. most recent, one.
-        #However, just in case, this is now done explicitly.
-        self.cursor.execute('SELECT dvfid, ROWID FROM dvFiles WHERE \
-                             dryfid = ? ORDER BY ROWID ASC;', (fid,))
-        dvfid = self.cursor.fetchall()
-        if dvfid:
-            return dvfid[-1][0]
-        return None
+    def get_dv_fid(self, url):
+        '''
+        Returns str — the Dataverse file ID from parsing a Dryad
+        file download link.  Normally used for determining dataverse
+        file ids for *deletion* in case of dryad file changes.
+
+        Parameters
+        ----------
+        url : str
+            *Dryad* file URL in form of
+            'https://datadryad.org/api/v2/files/385819/download'.
+        '''
+        return self.get_dv_fid_map([url])[url]
+
+    def get_dv_fid_map(self, urls, batch:int=900)->dict:
+        '''
+        Returns a dict of {Dryad file URL: Dataverse file ID} for many
+        Dryad file download links, using one query for every `batch`
+        links. Files which are not in Dataverse have a value of None.
+
+        Parameters
+        ----------
+        urls : list
+            *Dryad* file URLs in form of
+            'https://datadryad.org/api/v2/files/385819/download'.
+        batch : int
+            Maximum number of file IDs per query.
+        '''
+        fids = {url: self._dryad_fid(url) for url in urls}
+        unique = list(dict.fromkeys(fids.values()))
+        cursor = self._cursor()
+        found = {}
+        for start in range(0, len(unique), batch):
+            chunk = unique[start:start+batch]
+            #File IDs are *CHANGEABLE* according to Dryad, Dec 2021
+            #so the most recent record is used. Files with a change
+            #history but no current record have been deleted, and
+            #dvFiles has records which predate dvFilesCurrent.
+            cursor.execute(f'WITH ids (fid) AS (VALUES {", ".join(["(?)"] * len(chunk))}) \
+                             SELECT fid, coalesce( \
+                             (SELECT dvfid FROM dvFilesCurrent WHERE dryfid = fid \
+                              ORDER BY ROWID DESC LIMIT 1), \
+                             CASE WHEN EXISTS (SELECT 1 FROM dvFilesLog WHERE dryfid = fid) \
+                             THEN NULL ELSE (SELECT dvfid FROM dvFiles WHERE dryfid = fid \
+                              ORDER BY ROWID DESC LIMIT 1) END) FROM ids;', chunk)
+            found.update(cursor.fetchall())
+        return {url: found.get(fid) for url, fid in fids.items()}
 
     def get_dv_fids(self, filelist):
         '''
@@ -436,11 +1577,8 @@ class Monitor():
              'text/plain', 1350)]
              ```
         '''
-        fids = []
-        for f in filelist:
-            fids.append(self.get_dv_fid(f[0]))
-        return fids
-        # return [self.get_dv_fid(f[0]) for f in filelist]
+        fidmap = self.get_dv_fid_map([f[0] for f in filelist])
+        return [fidmap[f[0]] for f in filelist]
 
     def get_json_dvfids(self, serial)->list:
         '''
@@ -457,162 +1595,549 @@ class Monitor():
         -------
         list
         '''
-        self.cursor.execute('SELECT max(uid) FROM dryadStudy WHERE doi=?',
-                            (serial.doi,))
+        cursor = self._cursor()
+        cursor.execute('SELECT 1 FROM dvFilesCurrent WHERE doi = ? UNION ALL \
+                        SELECT 1 FROM dvFilesLog WHERE doi = ? LIMIT 1',
+                       (serial.doi, serial.doi))
+        if cursor.fetchone():
+            #Pending JSON is from an interrupted run, and is current
+            cursor.execute('SELECT dvfid FROM dvFilesCurrent WHERE \
+                            doi = ? AND dryfid = ? AND dryaduid IS NOT NULL',
+                           (serial.doi, 0))
+            return [f[0] for f in cursor.fetchall()]
+        #Records which predate dvFilesCurrent
+        cursor.execute('SELECT max(uid) FROM dryadStudy WHERE doi=?',
+                       (serial.doi,))
         try:
-            uid = self.cursor.fetchone()[0]
-            self.cursor.execute('SELECT dvfid FROM dvFiles WHERE \
-                                 dryaduid = ? AND dryfid=?', (uid, 0))
-            jsonfid = [f[0] for f in self.cursor.fetchall()]
+            uid = cursor.fetchone()[0]
+            cursor.execute('SELECT dvfid FROM dvFiles WHERE \
+                            dryaduid = ? AND dryfid=?', (uid, 0))
+            jsonfid = [f[0] for f in cursor.fetchall()]
             return jsonfid
 
         except TypeError:
             return []
 
+    def _add_files(self, cursor, doi, dryaduid, files):
+        '''
+        Records files uploaded to Dataverse in dvFilesCurrent
+        and dvFilesLog. Does not commit.
+
+        Parameters
+        ----------
+        cursor : sqlite3.Cursor
+            Writer cursor.
+        doi : str
+            Dryad DOI.
+        dryaduid : int
+            dryadStudy uid.
+        files : list
+            List of (Dryad file ID, checksum, Dataverse file ID,
+            packed Dataverse upload response) tuples. Dryad JSON
+            has file ID 0.
+        '''
+        stamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        cursor.executemany('INSERT INTO dvFilesCurrent VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           [(doi, dryfid, md5, str(dvfid), md5, upjson, dryaduid)
+                            for dryfid, md5, dvfid, upjson in files])
+        cursor.executemany('INSERT INTO dvFilesLog (stamp, action, doi, dryaduid, \
+                            dryfid, dvfid, dvmd5) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           [(stamp, 'add', doi, dryaduid, dryfid, str(dvfid), md5)
+                            for dryfid, md5, dvfid, _ in files])
+
+    def _delete_files(self, cursor, doi, dryaduid, dvfids):
+        '''
+        Removes files deleted from Dataverse from dvFilesCurrent
+        and records the deletions in dvFilesLog. Files known only
+        from legacy dvFiles rows are logged too, so that
+        Monitor.get_dv_fid no longer returns them. Does not commit.
+
+        Parameters
+        ----------
+        cursor : sqlite3.Cursor
+            Writer cursor.
+        doi : str
+            Dryad DOI.
+        dryaduid : int
+            dryadStudy uid.
+        dvfids : list
+            Dataverse file IDs.
+        '''
+        stamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        cursor.executemany('INSERT INTO dvFilesLog (stamp, action, doi, dryaduid, \
+                            dryfid, dvfid, dvmd5) SELECT ?, ?, doi, ?, dryfid, dvfid, \
+                            dvmd5 FROM dvFilesCurrent WHERE doi = ? AND dvfid = ?',
+                           [(stamp, 'delete', dryaduid, doi, str(d)) for d in dvfids])
+        cursor.executemany('INSERT INTO dvFilesLog (stamp, action, doi, dryaduid, \
+                            dryfid, dvfid, dvmd5) SELECT ?, ?, ?, ?, dryfid, dvfid, \
+                            dvmd5 FROM dvFiles WHERE dvfid = ? AND NOT EXISTS \
+                            (SELECT 1 FROM dvFilesCurrent WHERE doi = ? AND dvfid = ?) \
+                            ORDER BY rowid DESC LIMIT 1',
+                           [(stamp, 'delete', doi, dryaduid, str(d), doi, str(d))
+                            for d in dvfids])
+        cursor.executemany('DELETE FROM dvFilesCurrent WHERE doi = ? AND dvfid = ?',
+                           [(doi, str(d)) for d in dvfids])
+
+    def record_study(self, transfer):
+        '''
+        Records the Dataverse study of a transfer which is in progress,
+        so that an interrupted transfer of a new study can continue
+        with the same Dataverse study. Waits until committed.
+
+        Parameters
+        ----------
+        transfer : dryad2dataverse.transfer.Transfer
+        '''
+        stamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self._submit(lambda cursor: cursor.execute('INSERT INTO pendingStudy VALUES \
+                                                    (?, ?, ?) ON CONFLICT (doi) DO \
+                                                    UPDATE SET dvpid = excluded.dvpid',
+                                                   (transfer.doi, transfer.dvpid,
+                                                    stamp))).result()
+
+    def record_upload(self, transfer, rec:tuple)->bool:
+        '''
+        Records a single completed upload before the rest of the
+        transfer finishes, and returns True if it was successful.
+        If the transfer is interrupted, Monitor.get_pending lists the
+        files which need not be uploaded again; Monitor.update
+        completes the record. Waits until committed.
+
+        Suitable as the callback for Transfer.upload_files.
+
+        Parameters
+        ----------
+        transfer : dryad2dataverse.transfer.Transfer
+        rec : tuple
+            (Dryad file ID, Dataverse upload response), as returned by
+            Transfer.upload_file. Dryad JSON has file ID 0.
+        '''
+        added, _ = self._upload_results([rec], transfer.doi)
+        if not added:
+            return False
+        files = [(dryfid, md5, dvfid, self._pack(json.dumps(upjson)))
+                 for dryfid, md5, dvfid, upjson in added]
+        stamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        def _record(cursor):
+            cursor.execute('INSERT INTO pendingStudy VALUES (?, ?, ?) \
+                            ON CONFLICT (doi) DO NOTHING',
+                           (transfer.doi, transfer.dvpid, stamp))
+            cursor.execute('SELECT 1 FROM dvFilesCurrent WHERE doi = ? AND dvfid = ?',
+                           (transfer.doi, str(files[0][2])))
+            if not cursor.fetchone():
+                self._add_files(cursor, transfer.doi, None, files)
+        self._submit(_record).result()
+        return True
+
+    def get_pending(self, doi:str)->dict:
+        '''
+        Returns the progress of an interrupted transfer as a dict with
+        keys `dvpid` (None if no transfer is pending) and `files`,
+        a dict of {Dryad file ID: Dataverse file ID} for files
+        uploaded but not yet finalized by Monitor.update.
+
+        Parameters
+        ----------
+        doi : str
+            Dryad DOI.
+        '''
+        cursor = self._cursor()
+        cursor.execute('SELECT dvpid FROM pendingStudy WHERE doi = ?', (doi,))
+        row = cursor.fetchone()
+        cursor.execute('SELECT dryfid, dvfid FROM dvFilesCurrent WHERE \
+                        doi = ? AND dryaduid IS NULL', (doi,))
+        return {'dvpid': row[0] if row else None, 'files': dict(cursor.fetchall())}
+
     def update(self, transfer):
         '''
         Updates the Monitor database with information from a
-        dryad2dataverse.transfer.Transfer instance.
+        dryad2dataverse.transfer.Transfer instance, and waits until
+        the update is committed.
 
         If a Dryad primary metadata record has changes, it will be
         deleted from the database.
 
         This method should be called after all transfers are completed,
         including Dryad JSON updates, as the last action for transfer.
+        Uploads already recorded with Monitor.record_upload become part
+        of the new version. Memoized status and diff results are discarded.
 
         Parameters
         ----------
         transfer : dryad2dataverse.transfer.Transfer
         '''
-        #pylint: disable=too-many-branches, too-many-statements, too-many-locals
-        # get the pre-update dryad uid in case we need it.
-        self.cursor.execute('SELECT max(uid) FROM dryadStudy WHERE doi = ?',
-                            (transfer.dryad.dryadJson['identifier'],))
-        olduid = self.cursor.fetchone()[0]
-        if olduid:
-            olduid = int(olduid)
-        if self.status(transfer.dryad)['status'] != 'unchanged':
-            doi = transfer.doi
-            lastmod = transfer.dryad.dryadJson.get('lastModificationDate')
-            dryadJson = json.dumps(transfer.dryad.dryadJson)
-            dvJson = json.dumps(transfer.dvStudy)
-
-            # Update study metadata
-            self.cursor.execute('INSERT INTO dryadStudy \
-                                 (doi, lastmoddate, dryadjson, dvjson) \
-                                 VALUES (?, ?, ?, ?)',
-                                (doi, lastmod, dryadJson, dvJson))
-            self.cursor.execute('SELECT max(uid) FROM dryadStudy WHERE \
-                                 doi = ?', (doi,))
-            dryaduid = self.cursor.fetchone()[0]
-            #if type(dryaduid) != int:
-            if not isinstance(dryaduid, int):
-                try:
-                    raise TypeError('Dryad UID is not an integer')
-                except TypeError as e:
-                    LOGGER.error(e)
-                    raise
-
-            # Update dryad file json
-            self.cursor.execute('INSERT INTO dryadFiles VALUES (?, ?)',
-                                (dryaduid,
-                                 json.dumps(transfer.dryad.fileJson)))
-            # Update dataverse study map
-            self.cursor.execute('SELECT dvpid FROM dvStudy WHERE \
-                                 dvpid = ?', (transfer.dryad.dvpid,))
-            if not self.cursor.fetchone():
-                self.cursor.execute('INSERT INTO dvStudy VALUES (?, ?)',
-                                    (dryaduid, transfer.dryad.dvpid))
-            else:
-                self.cursor.execute('UPDATE dvStudy SET dryaduid=?, \
-                                     dvpid=? WHERE dvpid =?',
-                                    (dryaduid, transfer.dryad.dvpid,
-                                     transfer.dryad.dvpid))
-
-            # Update the files table
-            # Because we want to have a *complete* file list for each
-            # dryaduid, we have to copy any existing old files,
-            # then add and delete.
-            if olduid:
-                self.cursor.execute('SELECT * FROM dvFiles WHERE \
-                                     dryaduid=?', (olduid,))
-                inserter = self.cursor.fetchall()
-                for rec in inserter:
-                    # TODONE FIX THIS #I think it's fixed 11 Feb 21
-                    self.cursor.execute('INSERT INTO dvFiles VALUES \
-                                         (?, ?, ?, ?, ?, ?)',
-                                        (dryaduid, rec[1], rec[2],
-                                         rec[3], rec[4], rec[5]))
-            # insert newly uploaded files
-            for rec in transfer.fileUpRecord:
-                try:
-                    dvfid = rec[1]['data']['files'][0]['dataFile']['id']
-                    # Screw you for burying the file ID this deep
-                    recMd5 = rec[1]['data']['files'][0]['dataFile']['checksum']['value']
-                except (KeyError, IndexError) as err:
-                    #write to failed uploads table instead
-                    status = rec[1].get('status')
-                    if not status:
-                        LOGGER.error('JSON read error for Dryad file ID %s', rec[0])
-                        LOGGER.error('File %s for DOI %s may not be uploaded', rec[0], transfer.doi)
-                        LOGGER.exception(err)
-                        msg = {'status': 'Failure: Other non-specific '
-                                         'failure. Check logs'}
-
-                        self.cursor.execute('INSERT INTO failed_uploads VALUES \
-                                        (?, ?, ?);', (dryaduid, rec[0], json.dumps(msg)))
-                        continue
-                    self.cursor.execute('INSERT INTO failed_uploads VALUES \
-                                        (?, ?, ?);', (dryaduid, rec[0], json.dumps(rec[1])))
-                    LOGGER.warning(type(err))
-                    LOGGER.warning('%s. DOI %s, File ID %s',
-                                   rec[1].get('status'),
-                                   transfer.doi, rec[0])
+        self.update_async(transfer).result()
+        self.clear_cache()
+
+    def update_async(self, transfer)->concurrent.futures.Future:
+        '''
+        Queues an update of the Monitor database with information from a
+        dryad2dataverse.transfer.Transfer instance, and returns a
+        concurrent.futures.Future which is resolved when the update
+        is committed. Use Future.add_done_callback for notification,
+        or Future.result() to wait.
+
+        Updates queued together, eg from several threads, are
+        committed in a single transaction.
+
+        Parameters
+        ----------
+        transfer : dryad2dataverse.transfer.Transfer
+        '''
+        if self.status(transfer.dryad)['status'] == 'unchanged':
+            fut = concurrent.futures.Future()
+            fut.set_result(None)
+            return fut
+        return self._submit(self._write_update, self._prepare_update(transfer))
+
+    @staticmethod
+    def _upload_results(records, doi)->tuple:
+        '''
+        Splits upload records into successful and failed uploads.
+        Returns ([(Dryad file ID, checksum, Dataverse file ID,
+        upload response)], [(Dryad file ID, JSON status message)]).
+
+        Parameters
+        ----------
+        records : list
+            (Dryad file ID, Dataverse upload response) tuples,
+            as in Transfer.fileUpRecord.
+        doi : str
+            Dryad DOI, for logging.
+        '''
+        added = []
+        failed = []
+        # insert newly uploaded files
+        for rec in records:
+            try:
+                dvfid = rec[1]['data']['files'][0]['dataFile']['id']
+                # Screw you for burying the file ID this deep
+                recMd5 = rec[1]['data']['files'][0]['dataFile']['checksum']['value']
+            except (KeyError, IndexError) as err:
+                #write to failed uploads table instead
+                status = rec[1].get('status')
+                if not status:
+                    LOGGER.error('JSON read error for Dryad file ID %s', rec[0])
+                    LOGGER.error('File %s for DOI %s may not be uploaded', rec[0], doi)
+                    LOGGER.exception(err)
+                    msg = {'status': 'Failure: Other non-specific '
+                                     'failure. Check logs'}
+
+                    failed.append((rec[0], json.dumps(msg)))
                     continue
-                # md5s verified during upload step, so they should
-                # match already
-                self.cursor.execute('INSERT INTO dvFiles VALUES \
-                                     (?, ?, ?, ?, ?, ?)',
-                                    (dryaduid, rec[0], recMd5,
-                                     dvfid, recMd5, json.dumps(rec[1])))
-
-            # Now the deleted files
-            for rec in transfer.fileDelRecord:
+                failed.append((rec[0], json.dumps(rec[1])))
+                LOGGER.warning(type(err))
+                LOGGER.warning('%s. DOI %s, File ID %s',
+                               rec[1].get('status'),
+                               doi, rec[0])
+                continue
+            # md5s verified during upload step, so they should
+            # match already
+            added.append((rec[0], recMd5, dvfid, rec[1]))
+        return added, failed
+
+    def _prepare_update(self, transfer)->dict:
+        '''
+        Serializes the contents of a transfer for Monitor._write_update.
+        Runs in the calling thread, so that the writer thread
+        only writes.
+
+        Parameters
+        ----------
+        transfer : dryad2dataverse.transfer.Transfer
+        '''
+        # dvFilesCurrent holds the complete current file list, so
+        # only additions and deletions are written.
+        added, failed = self._upload_results(transfer.fileUpRecord, transfer.doi)
+
+        # And any JSON metadata updates.
+        # JSON has dryfid==0. Superseded JSON files are deleted
+        # from Dataverse, and so from dvFilesCurrent, below.
+        if transfer.jsonFlag:
+            # update dryad JSON, which is normally in fileUpRecord too
+            djson5 = transfer.jsonFlag[1]['data']['files'][0]['dataFile']['checksum']['value']
+            dfid = transfer.jsonFlag[1]['data']['files'][0]['dataFile']['id']
+            if str(dfid) not in [str(a[2]) for a in added]:
+                added.append((0, djson5, dfid, transfer.jsonFlag[1]))
+
+        # Failed deletions are left in place, as the files still
+        # exist in Dataverse
+        for dvfid, result in transfer.fileDelStatus.items():
+            if result['status'] != 'OK':
+                LOGGER.warning('DOI %s: Dataverse file %s not deleted. %s',
+                               transfer.doi, dvfid, result['status'])
+
+        return {'doi': transfer.doi,
+                'lastmod': transfer.dryad.dryadJson.get('lastModificationDate'),
+                'dryadjson': self._pack(json.dumps(transfer.dryad.dryadJson)),
+                'dvjson': self._pack(json.dumps(transfer.dvStudy)),
+                'dryadhash': serial_fingerprint(transfer.dryad),
+                'fieldhash': json.dumps(field_fingerprints(transfer.dryad.dryadJson)),
+                'filejson': self._pack(json.dumps(transfer.dryad.fileJson)),
+                'dvpid': transfer.dryad.dvpid,
+                'added': [(dryfid, md5, dvfid, self._pack(json.dumps(upjson)))
+                          for dryfid, md5, dvfid, upjson in added],
+                'failed': failed,
                 # fileDelRecord consists only of [fid,fid2, ...]
-                # Dryad record ID is int not str
-                self.cursor.execute('DELETE FROM dvFiles WHERE dvfid=? \
-                                     AND dryaduid=?',
-                                    (int(rec), dryaduid))
-                LOGGER.debug('deleted dryfid = %s, dryaduid = %s', rec, dryaduid)
-
-            # And lastly, any JSON metadata updates:
-            # NOW WHAT?
-            # JSON has dryfid==0
-            self.cursor.execute('SELECT * FROM dvfiles WHERE \
-                                 dryfid=? and dryaduid=?',
-                                (0, dryaduid))
+                'deleted': list(transfer.fileDelRecord)}
+
+    def _write_update(self, cursor, rec:dict)->int:
+        '''
+        Writes the output of Monitor._prepare_update and returns
+        the new dryadStudy uid. Runs in the writer thread.
+
+        Parameters
+        ----------
+        cursor : sqlite3.Cursor
+            Writer cursor.
+        rec : dict
+        '''
+        # Update study metadata
+        cursor.execute('INSERT INTO dryadStudy \
+                        (doi, lastmoddate, dryadjson, dvjson) \
+                        VALUES (?, ?, ?, ?)',
+                       (rec['doi'], rec['lastmod'], rec['dryadjson'], rec['dvjson']))
+        dryaduid = cursor.lastrowid
+        #if type(dryaduid) != int:
+        if not isinstance(dryaduid, int):
             try:
-                exists = self.cursor.fetchone()[0]
-                # Old metadata must be deleted on a change.
-                if exists:
-                    shouldDel = self.status(transfer.dryad)['status']
-                    if shouldDel == 'updated':
-                        self.cursor.execute('DELETE FROM dvfiles WHERE \
-                                             dryfid=? and dryaduid=?',
-                                            (0, dryaduid))
-            except TypeError:
-                pass
-
-            if transfer.jsonFlag:
-                # update dryad JSON
-                djson5 = transfer.jsonFlag[1]['data']['files'][0]['dataFile']['checksum']['value']
-                dfid = transfer.jsonFlag[1]['data']['files'][0]['dataFile']['id']
-                self.cursor.execute('INSERT INTO dvfiles VALUES \
-                                     (?, ?, ?, ?, ?, ?)',
-                                    (dryaduid, 0, djson5, dfid,
-                                     djson5, json.dumps(transfer.jsonFlag[1])))
-
-        self.conn.commit()
+                raise TypeError('Dryad UID is not an integer')
+            except TypeError as e:
+                LOGGER.error(e)
+                raise
+
+        cursor.execute('INSERT OR REPLACE INTO dryadFingerprint VALUES (?, ?, ?)',
+                       (dryaduid, rec['dryadhash'], rec['fieldhash']))
+
+        # Update dryad file json
+        cursor.execute('INSERT INTO dryadFiles VALUES (?, ?)',
+                       (dryaduid, rec['filejson']))
+        # Update dataverse study map
+        cursor.execute('SELECT dvpid FROM dvStudy WHERE \
+                        dvpid = ?', (rec['dvpid'],))
+        if not cursor.fetchone():
+            cursor.execute('INSERT INTO dvStudy VALUES (?, ?)',
+                           (dryaduid, rec['dvpid']))
+        else:
+            cursor.execute('UPDATE dvStudy SET dryaduid=?, \
+                            dvpid=? WHERE dvpid =?',
+                           (dryaduid, rec['dvpid'], rec['dvpid']))
+
+        # Update the files table. Files recorded by Monitor.record_upload
+        # are already there, and now belong to this version
+        cursor.execute('SELECT dvfid FROM dvFilesCurrent WHERE \
+                        doi = ? AND dryaduid IS NULL', (rec['doi'],))
+        pending = {x[0] for x in cursor.fetchall()}
+        self._add_files(cursor, rec['doi'], dryaduid,
+                        [x for x in rec['added'] if str(x[2]) not in pending])
+        for table in ('dvFilesCurrent', 'dvFilesLog'):
+            cursor.execute(f'UPDATE {table} SET dryaduid = ? WHERE \
+                             doi = ? AND dryaduid IS NULL', (dryaduid, rec['doi']))
+        cursor.execute('DELETE FROM pendingStudy WHERE doi = ?', (rec['doi'],))
+        cursor.executemany('INSERT INTO failed_uploads (dryaduid, dryfid, status) \
+                            VALUES (?, ?, ?);',
+                           [(dryaduid, fid, msg) for fid, msg in rec['failed']])
+
+        # Now the deleted files
+        self._delete_files(cursor, rec['doi'], dryaduid, rec['deleted'])
+        LOGGER.debug('deleted dvfids = %s, dryaduid = %s',
+                     rec['deleted'], dryaduid)
+        return dryaduid
+
+    def get_failed_uploads(self)->list:
+        '''
+        Returns a list of studies with unresolved failed uploads, as
+        dicts with keys `doi`, `dryaduid`, `dvpid`, `dryfids`,
+        `dryadJson` and `fileJson`. The JSON and study IDs are those
+        of the latest stored version of each study, so the files can be
+        transferred again without querying Dryad. Files which are in
+        Dataverse are omitted, as are studies without a Dataverse PID.
+        '''
+        cursor = self._cursor()
+        cursor.execute('SELECT DISTINCT s.doi, f.dryfid FROM failed_uploads AS f \
+                        JOIN dryadStudy AS s ON f.dryaduid = s.uid \
+                        WHERE f.resolved IS NULL AND NOT EXISTS \
+                        (SELECT 1 FROM dvFilesCurrent AS c WHERE \
+                         c.doi = s.doi AND c.dryfid = f.dryfid) \
+                        ORDER BY s.doi, f.dryfid;')
+        pending = {}
+        for doi, dryfid in cursor.fetchall():
+            pending.setdefault(doi, []).append(dryfid)
+        out = []
+        for doi, dryfids in pending.items():
+            cursor.execute('SELECT l.uid, l.dryadjson, d.dryfilesjson, v.dvpid \
+                            FROM dryadStudyLatest AS l \
+                            LEFT JOIN dryadFiles AS d ON d.dryaduid = l.uid \
+                            LEFT JOIN dvStudy AS v ON v.dryaduid = l.uid \
+                            WHERE l.doi = ?;', (doi,))
+            row = cursor.fetchone()
+            if not row or not row[3]:
+                LOGGER.warning('No Dataverse study for %s. Unable to retry uploads', doi)
+                continue
+            out.append({'doi': doi, 'dryaduid': row[0], 'dvpid': row[3],
+                        'dryfids': dryfids,
+                        'dryadJson': json.loads(unpack(row[1])),
+                        'fileJson': json.loads(unpack(row[2]) or '[]')})
+        return out
+
+    def record_retry(self, transfer, gone=())->dict:
+        '''
+        Records the outcome of retrying failed uploads and returns
+        the number of failures `{'resolved': n, 'failed': m}`.
+        Successful uploads are added to the current files and their
+        failures marked resolved; repeated failures have their status
+        updated. Waits until the update is committed.
+
+        Parameters
+        ----------
+        transfer : dryad2dataverse.transfer.Transfer
+            Transfer which uploaded the files, usually to the study
+            returned by Monitor.get_failed_uploads.
+        gone : list
+            Dryad file IDs which are no longer in the study, whose
+            failures are resolved without an upload.
+        '''
+        added, failed = self._upload_results(transfer.fileUpRecord, transfer.doi)
+        rec = {'doi': transfer.doi,
+               'added': [(dryfid, md5, dvfid, self._pack(json.dumps(upjson)))
+                         for dryfid, md5, dvfid, upjson in added],
+               'failed': failed,
+               'gone': list(gone)}
+        counts = self._submit(self._write_retry, rec).result()
+        self.clear_cache()
+        LOGGER.info('%s: resolved %s failed uploads, %s still failing',
+                    transfer.doi, counts['resolved'], counts['failed'])
+        return counts
+
+    def _write_retry(self, cursor, rec:dict)->dict:
+        '''
+        Writes the output of Monitor.record_retry. Runs in the
+        writer thread.
+
+        Parameters
+        ----------
+        cursor : sqlite3.Cursor
+            Writer cursor.
+        rec : dict
+        '''
+        cursor.execute('SELECT max(uid) FROM dryadStudy WHERE doi = ?', (rec['doi'],))
+        dryaduid = cursor.fetchone()[0]
+        self._add_files(cursor, rec['doi'], dryaduid, rec['added'])
+        stamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        pending = 'resolved IS NULL AND dryfid = ? AND \
+                   dryaduid IN (SELECT uid FROM dryadStudy WHERE doi = ?)'
+        cursor.executemany(f'UPDATE failed_uploads SET resolved = ? WHERE {pending}',
+                           [(stamp, fid, rec['doi'])
+                            for fid in [a[0] for a in rec['added']] + rec['gone']])
+        resolved = cursor.rowcount
+        cursor.executemany(f'UPDATE failed_uploads SET status = ? WHERE {pending}',
+                           [(msg, fid, rec['doi']) for fid, msg in rec['failed']])
+        return {'resolved': resolved, 'failed': len(rec['failed'])}
+
+    def start_run(self, records, since=None, started=None)->int:
+        '''
+        Records the studies harvested for a dryadd run in the run
+        journal and returns the run ID. Any earlier unfinished run
+        is marked abandoned.
+
+        Parameters
+        ----------
+        records : list
+            ((doi, Dryad JSON), ...), as from dryadd.get_records.
+        since : str
+            Modification date used for the harvest.
+        started : str
+            UTC time the harvest started, in the Dryad API format.
+            Defaults to now. Becomes the last check time when
+            the run is finished.
+        '''
+        if not started:
+            started = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        studies = [(doi, self._pack(json.dumps(record))) for doi, record in records]
+        def _start(cursor):
+            cursor.execute("UPDATE runJournal SET status = 'abandoned' \
+                            WHERE status = 'running';")
+            cursor.execute("INSERT INTO runJournal (started, since, status) \
+                            VALUES (?, ?, 'running');", (started, since))
+            runid = cursor.lastrowid
+            cursor.executemany('INSERT INTO runJournalStudy (runid, seq, doi, record) \
+                                VALUES (?, ?, ?, ?);',
+                               [(runid, seq, doi, record)
+                                for seq, (doi, record) in enumerate(studies)])
+            return runid
+        runid = self._submit(_start).result()
+        LOGGER.info('Started run %s with %s studies', runid, len(studies))
+        return runid
+
+    def resume_run(self)->dict:
+        '''
+        Returns the most recent unfinished run as a dict with keys
+        `runid`, `started`, `since`, `records` (the harvested
+        ((doi, Dryad JSON), ...)) and `completed` (a set of DOIs),
+        or None if every run has finished.
+        '''
+        cursor = self._cursor()
+        cursor.execute("SELECT runid, started, since FROM runJournal \
+                        WHERE status = 'running' ORDER BY runid DESC LIMIT 1;")
+        run = cursor.fetchone()
+        if not run:
+            return None
+        cursor.execute('SELECT doi, record, completed FROM runJournalStudy \
+                        WHERE runid = ? ORDER BY seq;', (run[0],))
+        rows = cursor.fetchall()
+        return {'runid': run[0], 'started': run[1], 'since': run[2],
+                'records': tuple((doi, json.loads(unpack(record)))
+                                 for doi, record, _ in rows),
+                'completed': {doi for doi, _, completed in rows if completed}}
+
+    def complete_study(self, runid:int, doi:str, outcome:str=None):
+        '''
+        Marks a study as completed in the run journal, and waits
+        until the change is committed.
+
+        Parameters
+        ----------
+        runid : int
+            Run ID from Monitor.start_run.
+        doi : str
+            Dryad DOI.
+        outcome : str
+            Optional note, eg. the study status.
+        '''
+        stamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self._submit(lambda cursor: cursor.execute('UPDATE runJournalStudy SET \
+                                                    completed = ?, outcome = ? \
+                                                    WHERE runid = ? AND doi = ?;',
+                                                   (stamp, outcome, runid, doi))).result()
+
+    def finish_run(self, runid:int)->str:
+        '''
+        Marks a run as complete and, in the same transaction, sets the
+        last check time to the time the run started, so that studies
+        changed during the run are harvested next time. Returns the
+        new last check time. Study details of older runs are discarded.
+
+        Parameters
+        ----------
+        runid : int
+            Run ID from Monitor.start_run.
+        '''
+        stamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        def _finish(cursor):
+            cursor.execute("UPDATE runJournal SET finished = ?, status = 'complete' \
+                            WHERE runid = ?;", (stamp, runid))
+            cursor.execute('SELECT started FROM runJournal WHERE runid = ?;', (runid,))
+            row = cursor.fetchone()
+            if not row:
+                raise exceptions.DatabaseError(f'No run with ID {runid}')
+            cursor.execute('INSERT INTO lastcheck VALUES (?);', row)
+            cursor.execute("DELETE FROM runJournalStudy WHERE runid != ? AND runid IN \
+                            (SELECT runid FROM runJournal WHERE status != 'running');",
+                           (runid,))
+            return row[0]
+        started = self._submit(_finish).result()
+        LOGGER.info('Finished run %s. Last check time: %s', runid, started)
+        return started
 
     def set_timestamp(self, curdate=None):
         '''
@@ -630,6 +2155,5 @@ class Monitor():
         #Dryad API uses Zulu time
         if not curdate:
             curdate = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-        self.cursor.execute('INSERT INTO lastcheck VALUES (?)',
-                            (curdate,))
-        self.conn.commit()
+        self._submit(lambda cursor: cursor.execute('INSERT INTO lastcheck VALUES (?)',
+                                                   (curdate,))).result()
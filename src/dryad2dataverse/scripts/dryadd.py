@@ -8,6 +8,8 @@ Requires Python 3.6+ and requests library
 from  email.message import EmailMessage as Em
 import argparse
 import ast
+import collections
+import concurrent.futures
 import datetime
 import glob
 import logging
@@ -17,7 +19,9 @@ import pathlib
 import pprint
 import shutil
 import smtplib
+import sqlite3
 import sys
+import tempfile
 import textwrap
 import time
 
@@ -28,6 +32,7 @@ from requests.adapters import HTTPAdapter
 import dryad2dataverse
 import dryad2dataverse.auth
 import dryad2dataverse.config
+import dryad2dataverse.hashing
 import dryad2dataverse.monitor
 import dryad2dataverse.serializer
 import dryad2dataverse.transfer
@@ -107,9 +112,53 @@ def argp():
                         help='Verbose output',
                         required=False,
                         action='store_true')
+    parser.add_argument('--resume',
+                        help='Continue the last interrupted run, skipping '
+                             'studies which were completed, instead of '
+                             'searching Dryad again',
+                        required=False,
+                        action='store_true')
     parser.add_argument('--version', action='version',
                         version='dryad2dataverse ' + dryad2dataverse.__version__,
                         help='Show version number and exit')
+    subparsers = parser.add_subparsers(dest='command', metavar='command',
+                                       help='Optional command. Without one, '
+                                            'dryadd transfers updated studies.')
+    maint = subparsers.add_parser('maintenance',
+                                  help='Back up, prune and compact the database',
+                                  description=textwrap.dedent(
+                                      '''
+                                      Backs up the monitor database, deletes
+                                      superseded versions of studies and returns
+                                      unused space to the file system. The most
+                                      recent version of each study is always kept.
+                                      If both options are given, only versions
+                                      matching both are deleted. With neither,
+                                      the database is only compacted.
+                                      ''').strip())
+    maint.add_argument('--keep-last',
+                       help='Number of versions of each study to keep',
+                       type=int,
+                       dest='keep_last')
+    maint.add_argument('--older-than',
+                       help='Delete versions last modified more than this many days ago',
+                       type=int,
+                       dest='older_than')
+    retry = subparsers.add_parser('retry-failed',
+                                  help='Retry failed file uploads',
+                                  description=textwrap.dedent(
+                                      '''
+                                      Downloads and uploads again only the files
+                                      whose uploads failed, using the study
+                                      information stored in the monitor database.
+                                      Dryad is not searched for updates, and the
+                                      time of the last update check is unchanged.
+                                      ''').strip())
+    retry.add_argument('--workers',
+                       help='Number of studies to retry at the same time. '
+                            'Defaults to the max_workers configuration value.',
+                       type=int,
+                       dest='workers')
 
     return parser
 
@@ -499,6 +548,268 @@ def test_config(cfile:pathlib.Path):
 
 
 
+def backup_dbase(monitor, **kwargs)->pathlib.Path:
+    '''
+    Makes an online backup of the monitor database and deletes all
+    but the newest `number_of_backups` backups. Returns the backup path.
+
+    Parameters
+    ----------
+    monitor : dryad2dataverse.monitor.Monitor
+    **kwargs
+        Normally a dryad2dataverse.config.Config instance.
+
+    Other parameters
+    ----------------
+    dbase : str
+        Path to database
+    number_of_backups : int
+        Number of backups to keep
+    compress_backups : bool
+        gzip backups
+    '''
+    logger = logging.getLogger()
+    dest = monitor.backup(compress=kwargs.get('compress_backups', False))
+    db_full = pathlib.Path(kwargs['dbase']).expanduser().absolute()
+    #Backups are dbase_YYYY-mm-dd-HHMM.suffix, optionally gzipped
+    fnames = [f for pattern in (f'{db_full.stem}_*{db_full.suffix}',
+                                f'{db_full.stem}_*{db_full.suffix}.gz')
+              for f in glob.glob(str(pathlib.Path(db_full.parent, pattern)))]
+    fnames.sort(reverse=True)
+    for fil in fnames[kwargs['number_of_backups']:]:
+        os.remove(fil)
+        logger.info('Deleted database backup: %s', fil)
+    return dest
+
+def maintenance(monitor, keep_last:int=None, older_than:int=None, **kwargs):
+    '''
+    Backs up, prunes and compacts the monitor database, then
+    closes the monitor.
+
+    Parameters
+    ----------
+    monitor : dryad2dataverse.monitor.Monitor
+    keep_last : int
+        Number of versions of each study to keep.
+    older_than : int
+        Delete versions last modified more than this many days ago.
+    **kwargs
+        Normally a dryad2dataverse.config.Config instance.
+    '''
+    logger = logging.getLogger()
+    logger.info('Database backup: %s', backup_dbase(monitor, **kwargs))
+    if keep_last or older_than is not None:
+        counts = monitor.prune(keep_last=keep_last, older_than=older_than)
+        logger.info('Deleted %s study versions and %s file records',
+                    counts['dryadStudy'], counts['dvFiles'])
+    logger.info('Freed %s database pages', monitor.vacuum())
+    monitor.close()
+
+def retry_study(monitor, failed:dict, **kwargs)->dict:
+    '''
+    Transfers the files of one study whose uploads failed and records
+    the outcome. Returns the counts from Monitor.record_retry.
+
+    Studies are retried at the same time, so each one downloads to
+    its own directory inside `tempfile_location`, which is removed
+    afterwards.
+
+    Parameters
+    ----------
+    monitor : dryad2dataverse.monitor.Monitor
+    failed : dict
+        A study from Monitor.get_failed_uploads.
+    **kwargs
+        Normally a dryad2dataverse.config.Config instance.
+    '''
+    #pylint: disable=protected-access
+    study = dryad2dataverse.serializer.Serializer(failed['doi'], **kwargs)
+    #Stored metadata, so that Dryad is not queried again
+    study.dryadJson = failed['dryadJson']
+    study._fileJson = failed['fileJson']
+    study.dvpid = failed['dvpid']
+    tmp = pathlib.Path(kwargs['tempfile_location']).expanduser().absolute()
+    tmpdir = tempfile.mkdtemp(dir=tmp)
+    #The digest cache stays in tempfile_location
+    opts = {'digest_cache': str(tmp.joinpath(dryad2dataverse.hashing.CACHE_NAME)),
+            **kwargs, 'tempfile_location': tmpdir}
+    transfer = dryad2dataverse.transfer.Transfer(study, **opts)
+    try:
+        files = [f for f in transfer.files
+                 if transfer._dryad_file_id(f[0]) in failed['dryfids']]
+        found = {transfer._dryad_file_id(f[0]) for f in files}
+        #Dryad JSON has file ID 0
+        gone = [fid for fid in failed['dryfids'] if fid and fid not in found]
+        if files:
+            transfer.download_files(files)
+            transfer.upload_files(files, pid=study.dvpid,
+                                  force_unlock=kwargs.get('force_unlock', False))
+        if 0 in failed['dryfids']:
+            transfer.upload_json()
+        return monitor.record_retry(transfer, gone=gone)
+    finally:
+        transfer.release_buffers()
+        study.session.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def retry_failed(monitor, workers:int=None, **kwargs)->dict:
+    '''
+    Retries all unresolved failed uploads, several studies at a time,
+    and returns the total `{'resolved': n, 'failed': m}`.
+
+    Parameters
+    ----------
+    monitor : dryad2dataverse.monitor.Monitor
+    workers : int
+        Number of studies to transfer at the same time.
+        Defaults to `max_workers`, or 4.
+    **kwargs
+        Normally a dryad2dataverse.config.Config instance.
+    '''
+    logger = logging.getLogger()
+    studies = monitor.get_failed_uploads()
+    logger.info('Retrying failed uploads for %s studies', len(studies))
+    totals = {'resolved': 0, 'failed': 0}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or kwargs.get('max_workers') or 4) as pool:
+        futures = {pool.submit(retry_study, monitor, failed, **kwargs): failed['doi']
+                   for failed in studies}
+        for fut in concurrent.futures.as_completed(futures):
+            try:
+                counts = fut.result()
+            except Exception as err: # pylint: disable=broad-except
+                logger.exception('Unable to retry failed uploads for %s: %s',
+                                 futures[fut], err)
+                continue
+            for key, val in counts.items():
+                totals[key] += val
+    return totals
+
+def transfer_study(doi:tuple, monitor, count:int=None, verbosity:bool=False,
+                   elog=None, status:dict=None, **kwargs)->str:
+    '''
+    Transfers one harvested study to Dataverse and updates the
+    monitor. Returns 'embargoed' or the study's monitor status.
+
+    Parameters
+    ----------
+    doi : tuple
+        (doi, Dryad JSON), as from get_records.
+    monitor : dryad2dataverse.monitor.Monitor
+    count : int
+        Position in the harvest, for verbose output.
+    verbosity : bool
+        Output some data to stdout.
+    elog : logging.Logger
+        Email logger.
+    status : dict
+        The study's status, as from Monitor.bulk_status. If None,
+        Monitor.status is used.
+    **kwargs
+        Keyword arguments. Just unpack dryad2dataverse.config.Config
+    '''
+    logger = logging.getLogger()
+    if not elog:
+        elog = logging.getLogger('email_log')
+    #Create study object
+    study = dryad2dataverse.serializer.Serializer(doi[0], **kwargs)
+    #verbose output
+    verbo(verbosity,
+          **{'Processing': count,
+             'DOI': study.doi,
+             'Title': study.dryadJson['title']})
+    if study.embargo:
+        logger.warning('Study %s is embargoed. Skipping', study.doi)
+        elog.warning('Study %s is embargoed. Skipping', study.doi)
+        verbo(verbosity, **{'Embargoed':study.embargo})
+        return 'embargoed'
+    #it turns out that the Dryad API sends all the metadata
+    #from the study in their search, so it's not necessary
+    #to download it again
+    study.dryadJson = doi[1]
+
+    #check to see what sort of update it is.
+    if status:
+        study.dvpid = status['dvpid']
+    else:
+        status = monitor.status(study)
+    update_type = status['status']
+    verbo(verbosity, **{'Status': update_type})
+    #create a transfer object to copy the files over
+    transfer = dryad2dataverse.transfer.Transfer(study, **kwargs)
+    transfer.test_api_key()
+    #Uploads completed by an interrupted run
+    pending = monitor.get_pending(study.doi)
+    #Now start the action
+    if update_type == 'new':
+        logger.info('New study: %s, %s', doi[0], doi[1]['title'])
+        logger.info('Uploading study metadata')
+        if pending['dvpid']:
+            logger.info('Continuing interrupted transfer to %s', pending['dvpid'])
+            transfer.upload_study(dvpid=pending['dvpid'])
+        else:
+            transfer.upload_study(targetDv=kwargs['target'])
+            monitor.record_study(transfer)
+        #New files are in now in monitor.diff_files()['add']
+        #with 2 Feb 2022 API change
+        #so we can ignore them here
+        if 0 not in pending['files']:
+            logger.info('Uploading Dryad JSON metadata')
+            transfer.upload_json()
+            if transfer.jsonFlag:
+                monitor.record_upload(transfer, transfer.jsonFlag)
+        transfer.set_correct_date()
+        notify(new_content(study, **kwargs),
+               **kwargs)
+
+    elif update_type == 'updated':
+        logger.info('Updated metadata: %s', doi[0])
+        logger.info('Updating metadata')
+        transfer.upload_study(dvpid=study.dvpid)
+        #remove old JSON files
+        transfer.delete_dv_files(monitor.get_json_dvfids(study))
+        if 0 not in pending['files']:
+            transfer.upload_json()
+            if transfer.jsonFlag:
+                monitor.record_upload(transfer, transfer.jsonFlag)
+        transfer.set_correct_date()
+        notify(changed_content(study, monitor, **kwargs),
+               **kwargs)
+
+        #new, identical, updated, lastmodsame
+    elif update_type in ('unchanged', 'lastmodsame'):
+        logger.info('Unchanged metadata %s', doi[0])
+        return update_type
+
+    diff = monitor.diff_files(study)
+    if diff.get('delete'):
+        del_these = monitor.get_dv_fids(diff['delete'])
+        transfer.delete_dv_files(dvfids=del_these)
+        logger.info('Deleted files %s from '
+                    'Dataverse', diff['delete'])
+    if diff.get('add') and pending['files']:
+        #pylint: disable=protected-access
+        diff['add'] = [f for f in diff['add']
+                       if transfer._dryad_file_id(f[0]) not in pending['files']]
+        logger.info('%s files already uploaded by an interrupted run',
+                    len(pending['files']))
+    if diff.get('add'):
+        logger.info('Adding files %s '
+                    'to Dataverse', diff['add'])
+        #you need to download them first if they're new
+        transfer.download_files(diff['add'])
+        #now send them to Dataverse, recording each one as it is done
+        transfer.upload_files(diff['add'], pid=study.dvpid,
+                              force_unlock=kwargs['force_unlock'],
+                              callback=lambda rec: monitor.record_upload(transfer, rec))
+    #Update the tracking database for that record
+    monitor.update(transfer)
+
+    #Release in-memory files now rather than when
+    #the transfer object is garbage collected
+    transfer.release_buffers()
+    return update_type
+
 def main():
     '''
     Primary function
@@ -540,37 +851,63 @@ def main():
         logme.debug('Command line arguments: %s' , pprint.pformat(anonymizer(args)))
 
     monitor = dryad2dataverse.monitor.Monitor(**config)
-    #copy the database to make a backup, because paranoia is your friend
-    db_full = pathlib.Path(config['dbase']).expanduser().absolute()
-    if db_full.exists():
+    if args.command == 'maintenance':
+        maintenance(monitor, keep_last=args.keep_last,
+                    older_than=args.older_than, **config)
+        logger.info('Completed maintenance')
+        return
+    if args.command == 'retry-failed':
+        counts = retry_failed(monitor, workers=args.workers, **config)
+        monitor.close()
+        for _ in [logger, elog]:
+            _.info('Completed retry of failed uploads. Resolved: %s, still failing: %s',
+                   counts['resolved'], counts['failed'])
+        return
+    run = monitor.resume_run() if args.resume else None
+    if args.resume and not run:
+        logger.info('No interrupted run to resume')
+    #back up the database, because paranoia is your friend.
+    #The backup runs while the updates are requested from Dryad
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        backup = pool.submit(backup_dbase, monitor, **config)
+        logger.info('Last update time: %s', monitor.lastmod)
+        if run:
+            logger.info('Resuming run %s started %s. %s of %s studies completed',
+                        run['runid'], run['started'], len(run['completed']),
+                        len(run['records']))
+            updates = run['records']
+        else:
+            #The next run picks up anything changed during this one
+            started = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            #get all updates since the last update check
+            updates = get_records(monitor.lastmod,
+                                  verbosity=args.verbosity,
+                                  **config)
         try:
-            shutil.copyfile(db_full,
-                            pathlib.Path(db_full.parent,
-                                         db_full.stem + '_' +
-                                         datetime.datetime.now().strftime('%Y-%m-%d-%H%M') +
-                                         db_full.suffix)
-                            )
-        except FileNotFoundError:
+            logger.info('Database backup: %s', backup.result())
+        except (OSError, sqlite3.Error,
+                dryad2dataverse.exceptions.DatabaseError) as err:
             for _ in [logger, elog]:
-                _.exception('Database not found: %s', config['dbase'])
-            print(f'Database not found: {config["dbase"]}', file=sys.stderr)
+                _.exception('Unable to back up database %s: %s', config['dbase'], err)
+            print(f'Unable to back up database {config["dbase"]}: {err}', file=sys.stderr)
             sys.exit()
-    #list comprehension includes untimestamped dbase name, hence 2+
-    fnames = glob.glob((str(pathlib.Path(db_full.parent,
-                           db_full.stem + '*' + db_full.suffix))))
-    fnames.remove(str(db_full))
-    fnames.sort(reverse=True)
-    fnames = fnames[config['number_of_backups']:]
-    for fil in fnames:
-        os.remove(fil)
-        logger.info('Deleted database backup: %s', fil)
-    logger.info('Last update time: %s', monitor.lastmod)
-    #get all updates since the last update check
-    updates = get_records(monitor.lastmod,
-                          verbosity=args.verbosity,
-                          **config)
+    if run:
+        runid, completed = run['runid'], run['completed']
+    else:
+        #Journal the harvest, so that an interrupted run can be resumed
+        runid = monitor.start_run(updates, since=monitor.lastmod, started=started)
+        completed = set()
     logger.info('Total new files: %s', len(updates))
     elog.info('Total new files: %s', len(updates))
+    #Classify the whole harvest at once
+    todo = {x[0] for x in updates if x[0] not in completed}
+    statuses = monitor.bulk_status([x for x in updates if x[0] in todo])
+    counts = collections.Counter(v['status'] for v in statuses.values())
+    if len(todo) > len(statuses):
+        #Checked again with Monitor.status when they are transferred
+        counts['unclassified'] = len(todo) - len(statuses)
+    for _ in [logger, elog]:
+        _.info('Harvest status: %s', dict(counts))
     checkwarn(val=len(updates) if not config['test_mode'] else
               min(config['test_mode_limit'], len(updates)),
               loggers=[logger],
@@ -596,86 +933,24 @@ def main():
                         doi[0], doi[0])
             if not updates:
                 break #no new files in this case
+            if doi[0] in completed:
+                logger.info('Already completed in run %s: %s', runid, doi[0])
+                continue
             #use get in this case because people *will* have nothing to exclude
             if doi[0] in config.get('exclude_list',[]):
                 logger.warning('Skipping excluded doi: %s', doi[0])
+                monitor.complete_study(runid, doi[0], 'excluded')
                 continue
-            #Create study object
-            study = dryad2dataverse.serializer.Serializer(doi[0], **config)
-            #verbose output
-            verbo(args.verbosity,
-                  **{'Processing': count,
-                     'DOI': study.doi,
-                     'Title': study.dryadJson['title']})
-            if study.embargo:
-                logger.warning('Study %s is embargoed. Skipping', study.doi)
-                elog.warning('Study %s is embargoed. Skipping', study.doi)
-                verbo(args.verbosity, **{'Embargoed':study.embargo})
-                continue
-            #it turns out that the Dryad API sends all the metadata
-            #from the study in their search, so it's not necessary
-            #to download it again
-            study.dryadJson = doi[1]
-
-            #check to see what sort of update it is.
-            update_type = monitor.status(study)['status']
-            verbo(args.verbosity, **{'Status': update_type})
-            #create a transfer object to copy the files over
-            transfer = dryad2dataverse.transfer.Transfer(study, **config)
-            transfer.test_api_key()
-            #Now start the action
-            if update_type == 'new':
-                logger.info('New study: %s, %s', doi[0], doi[1]['title'])
-                logger.info('Uploading study metadata')
-                transfer.upload_study(targetDv=config['target'])
-                #New files are in now in monitor.diff_files()['add']
-                #with 2 Feb 2022 API change
-                #so we can ignore them here
-                logger.info('Uploading Dryad JSON metadata')
-                transfer.upload_json()
-                transfer.set_correct_date()
-                notify(new_content(study, **config),
-                       **config)
-                testcount+=1
-
-            elif update_type == 'updated':
-                logger.info('Updated metadata: %s', doi[0])
-                logger.info('Updating metadata')
-                transfer.upload_study(dvpid=study.dvpid)
-                #remove old JSON files
-                transfer.delete_dv_files(monitor.get_json_dvfids(study))
-                transfer.upload_json()
-                transfer.set_correct_date()
-                notify(changed_content(study, monitor, **config),
-                       **config)
-
-                #new, identical, updated, lastmodsame
-            elif update_type in ('unchanged', 'lastmodsame'):
-                logger.info('Unchanged metadata %s', doi[0])
-                continue
-
-            diff = monitor.diff_files(study)
-            if diff.get('delete'):
-                del_these = monitor.get_dv_fids(diff['delete'])
-                transfer.delete_dv_files(dvfids=del_these)
-                logger.info('Deleted files %s from '
-                            'Dataverse', diff['delete'])
-            if diff.get('add'):
-                logger.info('Adding files %s '
-                            'to Dataverse', diff['add'])
-                #you need to download them first if they're new
-                transfer.download_files(diff['add'])
-                #now send them to Dataverse
-                transfer.upload_files(diff['add'], pid=study.dvpid,
-                                      force_unlock=config['force_unlock'])
-            #Update the tracking database for that record
-            monitor.update(transfer)
-
-            #Delete the transfer object to ensure that
-            #the temporary directory doesn't get filled
-            del transfer
+            #A repeated DOI is checked again after the first transfer
+            outcome = transfer_study(doi, monitor, count=count,
+                                     verbosity=args.verbosity, elog=elog,
+                                     status=statuses.pop(doi[0], None), **config)
+            if outcome == 'new':
+                testcount += 1
+            monitor.complete_study(runid, doi[0], outcome)
         #and finally, update the time for the next run
-        monitor.set_timestamp()
+        monitor.finish_run(runid)
+        monitor.close()
         logger.info('Completed update process')
         elog.info('Completed update process')
         finished = ('Dryad to Dataverse transfers completed',
@@ -697,7 +972,8 @@ def main():
         logger.exception('%s\nCritical failure with DOI: %s : %s\n%s', err,
                          doi[0], doi[1]['title'], doi[1].get('sharingLink'),
                          stack_info=True, exc_info=True)
-        print(f'Error: {err}. Exiting. For details see log at {config["log"]}.',
+        print(f'Error: {err}. Exiting. For details see log at {config["log"]}. '
+              'Use --resume to continue this run.',
               file=sys.stderr)
         sys.exit()
 
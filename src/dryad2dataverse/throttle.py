@@ -0,0 +1,322 @@
+'''
+Bandwidth shaping for file downloads and uploads.
+
+Limits are set in bytes per second with the configuration values
+`max_rate` (shared by downloads and uploads), `max_download_rate`
+and `max_upload_rate`. A value of 0 or None is unlimited.
+
+Optional time-of-day profiles in `rate_profiles` override these
+values during part of the day, eg:
+
+```
+rate_profiles:
+- start: '08:00'
+  end: '18:00'
+  max_rate: 5000000
+```
+
+Shapers are shared by every transfer in the process with the same
+settings, so limits apply across all studies and threads.
+'''
+import datetime
+import io
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+RATE_KEYS = ('max_rate', 'max_download_rate', 'max_upload_rate')
+_SHAPERS = {}
+_SHAPER_LOCK = threading.Lock()
+
+class TokenBucket():
+    '''
+    Thread-safe token bucket rate limiter.
+    '''
+    def __init__(self, rate=None, clock=time.monotonic):
+        '''
+        Parameters
+        ----------
+        rate : int
+            Rate in bytes per second. None or 0 is unlimited.
+        clock : callable
+            Returns the time in seconds. Default time.monotonic.
+        '''
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.clock = clock
+        self.tokens = float(rate or 0)
+        self.stamp = clock()
+
+    def set_rate(self, rate=None):
+        '''
+        Changes the rate limit.
+
+        Parameters
+        ----------
+        rate : int
+            Rate in bytes per second. None or 0 is unlimited.
+        '''
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = min(self.tokens, float(rate or 0))
+
+    def reserve(self, nbytes:int)->float:
+        '''
+        Reserves bandwidth for nbytes and returns the number of
+        seconds to wait before the bytes may be sent.
+
+        Parameters
+        ----------
+        nbytes : int
+            Number of bytes.
+        '''
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            now = self.clock()
+            #Allow a burst of at most one second
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= nbytes
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+def _minutes(value)->int:
+    '''
+    Returns minutes after midnight for an 'HH:MM' string.
+
+    Parameters
+    ----------
+    value : Union[str, int]
+        'HH:MM'. YAML 1.1 reads unquoted HH:MM as a base 60 integer,
+        which is conveniently the same as minutes after midnight.
+    '''
+    if isinstance(value, int):
+        return value
+    hours, minutes = str(value).split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+class Shaper():
+    '''
+    Download and upload bandwidth limiter with optional
+    time-of-day profiles.
+    '''
+    def __init__(self, clock=time.monotonic, **kwargs):
+        '''
+        Parameters
+        ----------
+        clock : callable
+            Clock for the token buckets. Default time.monotonic.
+        **kwargs
+            Normally a dryad2dataverse.config.Config instance.
+
+        Other parameters
+        ----------------
+        max_rate : int
+            Combined download and upload limit in bytes per second.
+        max_download_rate : int
+            Download limit in bytes per second.
+        max_upload_rate : int
+            Upload limit in bytes per second.
+        rate_profiles : list
+            List of dicts with keys `start`, `end` ('HH:MM', local time)
+            and any of the rate keys above, which override the defaults
+            between start and end.
+        '''
+        self.default = {k: kwargs.get(k) for k in RATE_KEYS}
+        self.profiles = kwargs.get('rate_profiles') or []
+        self.buckets = {'global': TokenBucket(clock=clock),
+                        'download': TokenBucket(clock=clock),
+                        'upload': TokenBucket(clock=clock)}
+        self._checked = None
+        self.current = None
+        self._update_limits()
+
+    @property
+    def enabled(self)->bool:
+        '''
+        True if any limit is set, in any profile.
+        '''
+        return any(self.default.values()) or any(
+            p.get(k) for p in self.profiles for k in RATE_KEYS)
+
+    def limits(self, now=None)->dict:
+        '''
+        Returns the limits in effect at time now.
+
+        Parameters
+        ----------
+        now : datetime.datetime
+            Defaults to current local time.
+        '''
+        if not now:
+            now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        out = dict(self.default)
+        for prof in self.profiles:
+            start, end = _minutes(prof['start']), _minutes(prof['end'])
+            if ((start <= minute < end) or
+                    (start > end and (minute >= start or minute < end))):
+                out.update({k: prof[k] for k in RATE_KEYS if k in prof})
+                break
+        return out
+
+    def _update_limits(self):
+        '''
+        Applies the current profile; checked at most once a minute.
+        '''
+        stamp = int(time.time() // 60)
+        if stamp == self._checked:
+            return
+        self._checked = stamp
+        limits = self.limits()
+        if limits != self.current:
+            LOGGER.info('Bandwidth limits: %s', limits)
+            self.current = limits
+            self.buckets['global'].set_rate(limits['max_rate'])
+            self.buckets['download'].set_rate(limits['max_download_rate'])
+            self.buckets['upload'].set_rate(limits['max_upload_rate'])
+
+    def delay(self, direction:str, nbytes:int)->float:
+        '''
+        Reserves bandwidth and returns the required wait in seconds.
+        Useful with asyncio.sleep.
+
+        Parameters
+        ----------
+        direction : str
+            'download' or 'upload'
+        nbytes : int
+            Number of bytes transferred.
+        '''
+        self._update_limits()
+        return max(self.buckets['global'].reserve(nbytes),
+                   self.buckets[direction].reserve(nbytes))
+
+    def throttle(self, direction:str, nbytes:int):
+        '''
+        Blocks until nbytes may be transferred.
+
+        Parameters
+        ----------
+        direction : str
+            'download' or 'upload'
+        nbytes : int
+            Number of bytes transferred.
+        '''
+        wait = self.delay(direction, nbytes)
+        if wait:
+            time.sleep(wait)
+
+class ThrottledReader(io.IOBase):
+    '''
+    Read-only stream wrapper which limits the rate at which a stream
+    (such as a requests_toolbelt MultipartEncoder or a file) can be read.
+
+    The length, position and file descriptor of the underlying stream
+    are passed through, so that requests and aiohttp can set
+    Content-Length instead of sending the data in chunks.
+    '''
+    def __init__(self, stream, shaper:Shaper, direction:str='upload'):
+        '''
+        Parameters
+        ----------
+        stream : file-like object
+            Anything with a read method.
+        shaper : dryad2dataverse.throttle.Shaper
+        direction : str
+            'download' or 'upload'
+        '''
+        super().__init__()
+        self.stream = stream
+        self.shaper = shaper
+        self.direction = direction
+        self.position = 0
+
+    @property
+    def len(self):
+        '''
+        Total length of the stream, as used by requests to set
+        Content-Length. Streams without a `len` attribute, such as
+        files, are measured with os.fstat.
+        '''
+        if hasattr(self.stream, 'len'):
+            return self.stream.len
+        return os.fstat(self.fileno()).st_size
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        '''
+        Returns the file descriptor of the underlying stream.
+        Raises io.UnsupportedOperation if it has none.
+        '''
+        try:
+            return self.stream.fileno()
+        except AttributeError as err:
+            raise io.UnsupportedOperation('fileno') from err
+
+    def seekable(self):
+        seekable = getattr(self.stream, 'seekable', None)
+        return bool(seekable and seekable())
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        '''
+        Moves to a new position in the underlying stream.
+
+        Parameters
+        ----------
+        offset : int
+        whence : int
+        '''
+        if not self.seekable():
+            raise io.UnsupportedOperation('seek')
+        self.position = self.stream.seek(offset, whence)
+        return self.position
+
+    def tell(self):
+        '''
+        Returns the position in the underlying stream, or the number
+        of bytes read so far if it has no position.
+        '''
+        if hasattr(self.stream, 'tell'):
+            return self.stream.tell()
+        return self.position
+
+    def read(self, size=-1):
+        '''
+        Reads from the stream at the permitted rate.
+
+        Parameters
+        ----------
+        size : int
+            Maximum number of bytes
+        '''
+        data = self.stream.read(size)
+        if data:
+            self.position += len(data)
+            self.shaper.throttle(self.direction, len(data))
+        return data
+
+def get_shaper(**kwargs)->Shaper:
+    '''
+    Returns the process-wide Shaper for a set of bandwidth settings.
+
+    Parameters
+    ----------
+    **kwargs
+        Normally a dryad2dataverse.config.Config instance.
+    '''
+    key = (tuple(kwargs.get(k) for k in RATE_KEYS),
+           repr(kwargs.get('rate_profiles')))
+    with _SHAPER_LOCK:
+        if key not in _SHAPERS:
+            _SHAPERS[key] = Shaper(**kwargs)
+        return _SHAPERS[key]
@@ -3,36 +3,71 @@ This module handles data downloads and uploads from a Dryad instance to a Datave
 '''
 
 #pylint: disable=invalid-name #Maybe one day
-import hashlib
+import concurrent.futures
 import io
 import json
 import logging
 import pathlib
 import os
+import threading
 import time
 import traceback
-import zlib #crc32, adler32
 
-import Crypto.Hash.MD2 #md2
 import requests
 from requests.adapters import HTTPAdapter
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
 from dryad2dataverse import config
 from dryad2dataverse import exceptions
+from dryad2dataverse import hashing
+from dryad2dataverse import throttle
 from dryad2dataverse import USERAGENT
 
 LOGGER = logging.getLogger(__name__)
 URL_LOGGER = logging.getLogger('urllib3')
 
-HASHTABLE = {'adler-32' : zlib.adler32, #zlib?
-             'crc-32' : zlib.crc32, #zlib
-             'md2' : Crypto.Hash.MD2, #insecure
-             'md5' : hashlib.md5,
-             'sha-1' : hashlib.sha1,
-             'sha-256' : hashlib.sha256,
-             'sha-384' : hashlib.sha384,
-             'sha-512': hashlib.sha512}
+HASHTABLE = hashing.HASHTABLE
+
+class MemoryBudget():
+    '''
+    Process-wide accounting of the memory used by files
+    held in memory instead of in tempfile_location.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.used = 0
+
+    def acquire(self, nbytes:int, cap:int)->bool:
+        '''
+        Reserves nbytes if the total stays within cap. Returns
+        True on success, or False if the file should go to disk.
+
+        Parameters
+        ----------
+        nbytes : int
+            Number of bytes.
+        cap : int
+            Maximum total bytes.
+        '''
+        with self.lock:
+            if self.used + nbytes > cap:
+                return False
+            self.used += nbytes
+            return True
+
+    def release(self, nbytes:int):
+        '''
+        Releases a reservation.
+
+        Parameters
+        ----------
+        nbytes : int
+            Number of bytes.
+        '''
+        with self.lock:
+            self.used = max(0, self.used - nbytes)
+
+BUFFER_BUDGET = MemoryBudget()
 
 class Transfer():
     '''
@@ -68,6 +103,22 @@ class Transfer():
             Contact name
         target : str
             Target collection short name
+
+        Optional kwargs:
+        max_rate, max_download_rate, max_upload_rate : int
+            Bandwidth limits in bytes per second.
+            See dryad2dataverse.throttle.
+        rate_profiles : list
+            Time-of-day bandwidth profiles. See dryad2dataverse.throttle.
+        digest_cache : str
+            Path to persistent checksum cache. Defaults to a file in
+            tempfile_location; null disables. See dryad2dataverse.hashing.
+        max_memory_file : int
+            Files smaller than this many bytes are kept in memory
+            instead of tempfile_location. 0 disables. Default 1 MiB.
+        max_memory_buffers : int
+            Maximum total bytes of in-memory files for all transfers
+            in the process. Default 256 MiB.
         '''
         self.kwargs = kwargs
         self.dryad = dryad
@@ -76,10 +127,21 @@ class Transfer():
         #self._files = copy.deepcopy(self.dryad.files)
         self.fileUpRecord = []
         self.fileDelRecord = []
+        self.fileDelStatus = {}
         self.dvStudy = None
         self.jsonFlag = None #Whether or not new json uploaded
+        self._native_delete = True #Native file delete API available
         self.session = requests.Session()
         self.session.mount('https://', HTTPAdapter(max_retries=config.RETRY_STRATEGY))
+        self.upload_session = requests.Session()
+        self.upload_session.mount('https://',
+                                  HTTPAdapter(max_retries=config.UPLOAD_RETRY_STRATEGY))
+        self.uploadKeys = {} #Idempotency keys of completed uploads
+        self._local = threading.local() #Per-thread sessions for pool workers
+        self.shaper = throttle.get_shaper(**kwargs)
+        self.digest_cache = hashing.get_cache(**kwargs)
+        self.buffers = {} #In-memory files, keyed by temporary file path
+        self._reserved = {}
         self.check_kwargs()
 
     def check_kwargs(self):
@@ -104,7 +166,7 @@ class Transfer():
 
     def _del__(self):
         '''Expunges files from temporary file on deletion'''
-        tmp = pathlib.Path(self.kwargs['tempfile_location']).expanduser().absolute()
+        tmp = self.tmpdir
         for f in self.files:
             if pathlib.Path(tmp, f[1]).exists():
                 os.remove(pathlib.Path(tmp, f[1]))
@@ -145,6 +207,13 @@ class Transfer():
         '''
         return self.dryad.dvpid
 
+    @property
+    def tmpdir(self)->pathlib.Path:
+        '''
+        Returns the directory for temporary files as pathlib.Path.
+        '''
+        return pathlib.Path(self.kwargs['tempfile_location']).expanduser().absolute()
+
     @property
     def auth(self):
         '''
@@ -345,10 +414,83 @@ class Transfer():
             self.dryad.dvpid = updata['data'].get('datasetPersistentId')
         return self.dvpid
 
+    def _reserve_buffer(self, upfile, size)->bool:
+        '''
+        Reserves memory for a file of a given size, if it is small
+        enough to be held in memory. Returns True if reserved.
+
+        Parameters
+        ----------
+        upfile : pathlib.Path
+            Temporary file path, used as key.
+        size : int
+            Size in bytes.
+        '''
+        self._release_buffer(upfile)
+        if not size or size >= self.kwargs.get('max_memory_file', 2**20):
+            return False
+        if not BUFFER_BUDGET.acquire(size, self.kwargs.get('max_memory_buffers', 2**28)):
+            LOGGER.debug('Memory buffer limit reached; writing %s to disk', upfile)
+            return False
+        self._reserved[upfile] = size
+        return True
+
+    def _release_buffer(self, upfile):
+        '''
+        Discards an in-memory file and releases its memory reservation.
+
+        Parameters
+        ----------
+        upfile : pathlib.Path
+            Temporary file path, used as key.
+        '''
+        self.buffers.pop(upfile, None)
+        BUFFER_BUDGET.release(self._reserved.pop(upfile, 0))
+
+    def _spill_buffer(self, upfile):
+        '''
+        Writes an in-memory file to its temporary file path, so that
+        it is still available after the buffer is released.
+
+        Parameters
+        ----------
+        upfile : pathlib.Path
+            Temporary file path, used as key.
+        '''
+        if upfile in self.buffers:
+            LOGGER.debug('Writing %s to disk for a later retry', upfile)
+            with open(upfile, 'wb') as fil:
+                fil.write(self.buffers[upfile])
+
+    def release_buffers(self):
+        '''
+        Discards all in-memory files held by this instance.
+        '''
+        for upfile in list(self._reserved):
+            self._release_buffer(upfile)
+
+    def _local_digest(self, upfile, dig_type)->str:
+        '''
+        Returns the hex digest of a local file, whether held
+        in memory or on disk.
+
+        Parameters
+        ----------
+        upfile : pathlib.Path
+            Temporary file path.
+        dig_type : str
+            Digest type.
+        '''
+        if upfile in self.buffers:
+            return hashing.digest_bytes(self.buffers[upfile], dig_type)[dig_type]
+        return self._check_md5(upfile, dig_type, self.digest_cache)
+
     @staticmethod
-    def _check_md5(infile, dig_type):
+    def _check_md5(infile, dig_type, cache=None):
         '''
         Returns the hex digest of a file (formerly just md5sum).
+        All digest types, including adler-32 and crc-32, are returned
+        as hex strings. See dryad2dataverse.hashing.
 
         Parameters
         ----------
@@ -356,6 +498,8 @@ class Transfer():
             Complete path to target file.
         dig_type : Union[str, None]
             Digest type
+        cache : dryad2dataverse.hashing.DigestCache
+            Optional persistent digest cache.
         '''
         #From Ryan Scherle
         #When Dryad calculates a digest, it only uses MD5.
@@ -363,38 +507,38 @@ class Transfer():
         #The list of allowed values is:
         #('adler-32','crc-32','md2','md5','sha-1','sha-256','sha-384','sha-512')
         #hashlib doesn't support adler-32, crc-32, md2
+        try:
+            if cache:
+                return cache.digest_file(infile, dig_type)[dig_type]
+            return hashing.digest_file(infile, dig_type)[dig_type]
+        except exceptions.HashError:
+            LOGGER.exception('Unable to determine hash type for %s: %s', infile, dig_type)
+            raise exceptions.HashError(f'Unable to determine hash type for{infile}: '
+                                       f'{dig_type}') from None
+
+    def _verify_digest(self, infile, dig_type):
+        '''
+        Returns the hex digest of a downloaded file. With a digest
+        cache, the md5 used by Dataverse is computed in the same pass
+        and cached for the upload check.
 
-        blocksize = 2**16
-        #Well, this is inelegant
-        with open(infile, 'rb') as m:
-            #fmd5 = hashlib.md5()
-            ## var name kept for posterity. Maybe refactor
-            if dig_type in ['sha-1', 'sha-256', 'sha-384', 'sha-512', 'md5', 'md2']:
-                if dig_type == 'md2':
-                    fmd5 = Crypto.Hash.MD2.new()
-                else:
-                    fmd5 = HASHTABLE[dig_type]()
-                fblock = m.read(blocksize)
-                while fblock:
-                    fmd5.update(fblock)
-                    fblock = m.read(blocksize)
-                return fmd5.hexdigest()
-            if dig_type in ['adler-32', 'crc-32']:
-                fblock = m.read(blocksize)
-                curvalue = HASHTABLE[dig_type](fblock)
-                while fblock:
-                    fblock = m.read(blocksize)
-                    curvalue = HASHTABLE[dig_type](fblock, curvalue)
-                return curvalue
-        LOGGER.exception('Unable to determine hash type for %s: %s', infile, dig_type)
-        raise exceptions.HashError(f'Unable to determine hash type for{infile}: {dig_type}')
-
+        Parameters
+        ----------
+        infile : pathlib.Path
+            Complete path to target file.
+        dig_type : str
+            Dryad digest type
+        '''
+        if infile in self.buffers or not self.digest_cache:
+            return self._local_digest(infile, dig_type)
+        return self.digest_cache.digest_file(infile, list({dig_type, 'md5'}))[dig_type]
 
     def download_file(self, url=None, filename=None,
                       size=None, chk=None, **kwargs):
         '''
         Downloads a file via requests streaming and saves to the
-        the defined temporary file directory.
+        the defined temporary file directory. Small files are kept
+        in memory instead (see `max_memory_file`).
         Returns checksum on success and an exception on failure.
 
         Parameters
@@ -418,7 +562,7 @@ class Transfer():
         LOGGER.debug('Start download sequence')
         LOGGER.debug('MAX SIZE = %s', self.kwargs['max_upload'])
         LOGGER.debug('Filename: %s, size=%s', filename, size)
-        tmp = pathlib.Path(self.kwargs['tempfile_location']).expanduser().absolute()
+        tmp = self.tmpdir
         if size:
             if size > self.kwargs['max_upload']:
                 #TOO BIG
@@ -431,18 +575,43 @@ class Transfer():
                         i[-1] = md5
                 LOGGER.debug('Stop download sequence with large file skip')
                 return md5
+        upfile = pathlib.Path(tmp, filename)
+        inmem = self._reserve_buffer(upfile, size)
         try:
             down = self.session.get(url, stream=True,
                                     headers=config.Config.update_headers(**self.kwargs))
             down.raise_for_status()
-            with open(pathlib.Path(tmp,filename), 'wb') as fi:
+            data = bytearray() if inmem else None
+            fi = None if inmem else open(upfile, 'wb') #pylint: disable=consider-using-with
+            try:
                 for chunk in down.iter_content(chunk_size=8192):
-                    fi.write(chunk)
+                    if inmem and len(data) + len(chunk) > self._reserved[upfile]:
+                        #Larger than reported; don't exceed the reservation
+                        LOGGER.debug('%s is larger than its reported size; '
+                                     'writing to disk', upfile)
+                        fi = open(upfile, 'wb') #pylint: disable=consider-using-with
+                        fi.write(data)
+                        self._release_buffer(upfile)
+                        inmem = False
+                    if inmem:
+                        data.extend(chunk)
+                    else:
+                        fi.write(chunk)
+                    if self.shaper.enabled:
+                        self.shaper.throttle('download', len(chunk))
+            finally:
+                if fi:
+                    fi.close()
+            if inmem:
+                self.buffers[upfile] = data
 
             #verify size
             #https://stackoverflow.com/questions/2104080/how-can-i-check-file-size-in-python'
             if size:
-                checkSize = os.stat(pathlib.Path(tmp,filename)).st_size
+                if inmem:
+                    checkSize = len(data)
+                else:
+                    checkSize = os.stat(upfile).st_size
                 if checkSize != size:
                     try:
                         raise exceptions.DownloadSizeError('Download size does not '
@@ -453,8 +622,7 @@ class Transfer():
             #now check the md5
             md5 = None
             if chk and kwargs.get('digest_type') in HASHTABLE:
-                md5 = Transfer._check_md5(pathlib.Path(tmp,filename),
-                                      kwargs['digest_type'])
+                md5 = self._verify_digest(upfile, kwargs['digest_type'])
                 if md5 != chk:
                     try:
                         raise exceptions.HashError(f'Hex digest mismatch: {md5} : {chk}')
@@ -470,10 +638,12 @@ class Transfer():
             return md5
         except (requests.exceptions.HTTPError,
                 requests.exceptions.ConnectionError) as err:
+            self._release_buffer(upfile)
             LOGGER.critical('Unable to download %s', url)
             LOGGER.exception(err)
             raise
         except Exception as err:
+            self._release_buffer(upfile)
             LOGGER.exception(err)
             raise
 
@@ -601,6 +771,194 @@ class Transfer():
             #LOGGER.warning('Ingest halted for file %s for study %s', fid, study)
             #uningest.raise_for_status()
 
+    def _prepare_upload(self, dryadUrl, filename, mimetype, size, descr)->dict:
+        '''
+        Returns a dict of the values required to upload a file, with keys
+        `fid`, `filename`, `mimetype`, `upfile` and `dv4meta`, or
+        `fid` and `fail` if the file can't be uploaded.
+
+        Filenames and mimetypes are altered to prevent tabular processing
+        if required.
+
+        Parameters
+        ----------
+        dryadUrl : str
+            Dryad download URL.
+        filename : str
+            Filename (not including path).
+        mimetype : str
+            Mimetype of file.
+        size : int
+            Size in bytes.
+        descr : str
+            File description.
+        '''
+        fprefix = self.tmpdir
+        if dryadUrl:
+            fid = self._dryad_file_id(dryadUrl)
+        else:
+            fid = 0 #dummy fid for non-Dryad use
+        upfile = pathlib.Path(fprefix, filename[:])
+        badExt = filename[filename.rfind('.'):].lower()
+        #Descriptions are technically possible, although how to add
+        #them is buried in Dryad's API documentation
+        dv4meta = {'label' : filename[:], 'description' : descr}
+        #if mimetype == 'application/zip' or filename.lower().endswith('.zip'):
+        if mimetype == 'application/zip' or badExt in self.kwargs.get('notab',[]):
+            mimetype = 'application/octet-stream' # stop unzipping automatically
+            filename += '.NOPROCESS' # Also screw with their naming convention
+            #debug log about file names to see what is up with XSLX
+            #see doi:10.5061/dryad.z8w9ghxb6
+            LOGGER.debug('File renamed to %s for upload', filename)
+        if size >= self.kwargs['max_upload']:
+            fail = (fid, {'status' : 'Failure: MAX_UPLOAD size exceeded'})
+            self.fileUpRecord.append(fail)
+            LOGGER.warning('%s: File %s of '
+                           'size %s exceeds '
+                           'Dataverse MAX_UPLOAD size. Skipping.', self.doi, filename, size)
+            return {'fid': fid, 'fail': fail}
+        return {'fid': fid, 'filename': filename, 'mimetype': mimetype,
+                'upfile': upfile, 'dv4meta': dv4meta}
+
+    def _upload_mismatch(self, upjson, upfile, hashtype, digest):
+        '''
+        Compares the checksum of an uploaded file reported by Dataverse
+        with the local checksum. Returns None if they match, or
+        a dryad2dataverse.exceptions.HashError if they do not.
+
+        Parameters
+        ----------
+        upjson : dict
+            Dataverse JSON response from upload.
+        upfile : pathlib.Path
+            Path to local file.
+        hashtype : str
+            Original Dryad hash type.
+        digest : str
+            Original Dryad digest.
+        '''
+        upmd5 = upjson['data']['files'][0]['dataFile']['checksum']['value']
+        #Dataverse hash type
+        _type = upjson['data']['files'][0]['dataFile']['checksum']['type']
+        if _type.lower() != hashtype.lower():
+            comparator = self._local_digest(upfile, _type.lower())
+        else:
+            comparator = digest
+        #if hashtype.lower () != 'md5':
+        #    #get an md5 because dataverse uses md5s. Or most of them do anyway.
+        #    #One day this will be rewritten properly.
+        #    md5 = self._check_md5(filename, 'md5')
+        #else:
+        #    md5 = digest
+        #if md5 and (upmd5 != md5):
+        if upmd5 != comparator:
+            try:
+                raise exceptions.HashError(f'{_type} mismatch:\nlocal: '
+                                           f'{comparator}\nuploaded: {upmd5}')
+            except exceptions.HashError as e:
+                LOGGER.exception(e)
+                return e
+        return None
+
+    @staticmethod
+    def _idempotency_key(fid, digest):
+        '''
+        Returns a client-side idempotency key for an upload,
+        consisting of Dryad file ID and digest, or None for
+        non-Dryad files.
+
+        Parameters
+        ----------
+        fid : int
+            Dryad file ID.
+        digest : str
+            Dryad file digest.
+        '''
+        if not fid:
+            return None
+        return f'{fid}:{digest or ""}'
+
+    def _post_file(self, url, params, filename, upfile, mimetype, dv4meta):
+        '''
+        POSTs a single file to Dataverse and returns the requests.Response.
+        The request is not retried automatically. Files held in memory
+        are sent directly from their buffers.
+
+        Parameters
+        ----------
+        url : str
+            Dataverse add file endpoint.
+        params : dict
+            Request parameters.
+        filename : str
+            Filename for Dataverse.
+        upfile : pathlib.Path
+            Path to local file.
+        mimetype : str
+            Mimetype of file.
+        dv4meta : dict
+            Dataverse file metadata.
+        '''
+        #pylint: disable=too-many-arguments, too-many-positional-arguments, consider-using-with
+        if upfile in self.buffers:
+            fil = io.BytesIO(self.buffers[upfile])
+        else:
+            fil = open(upfile, 'rb')
+        with fil:
+            multi = MultipartEncoder(fields={'file': (filename, fil, mimetype),
+                                             'jsonData': f'{dv4meta}'})
+            tmphead = self.auth.copy()
+            tmphead.update({'Content-type' : multi.content_type})
+            tmphead.update({'User-agent':USERAGENT})
+            data = multi
+            if self.shaper.enabled:
+                data = throttle.ThrottledReader(multi, self.shaper, 'upload')
+            return self.upload_session.post(url, params=params,
+                                            headers=tmphead,
+                                            data=data)
+
+    def find_upload(self, studyId, label, upfile):
+        '''
+        Checks the latest version of a Dataverse study for a file with
+        the given label whose checksum matches the local file.
+
+        Returns the file information in the same format as a
+        Dataverse upload response, or None if there is no such file.
+        Used to confirm whether an upload which appeared to fail
+        actually succeeded, before it is sent again.
+
+        Parameters
+        ----------
+        studyId : str
+            Persistent Dataverse study identifier.
+        label : str
+            Label of the file in Dataverse, ie. its original name
+            without any `.NOPROCESS` suffix.
+        upfile : pathlib.Path
+            Path to local file.
+        '''
+        headers = {'X-Dataverse-key': self.kwargs['api_key'], 'User-agent': USERAGENT}
+        try:
+            listing = self.session.get(f'{self.kwargs["dv_url"]}/api/datasets/'
+                                       ':persistentId/versions/:latest/files',
+                                       params={'persistentId': studyId},
+                                       headers=headers)
+            listing.raise_for_status()
+            files = listing.json().get('data', [])
+        except (requests.exceptions.HTTPError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.JSONDecodeError) as err:
+            LOGGER.warning('Unable to list files for %s: %s', studyId, err)
+            return None
+        for fmeta in files:
+            if fmeta.get('label') != label:
+                continue
+            chk = fmeta.get('dataFile', {}).get('checksum', {})
+            if chk.get('value') and chk['value'] == self._local_digest(upfile,
+                                                                      chk['type'].lower()):
+                return {'status': 'OK', 'data': {'files': [fmeta]}}
+        return None
+
     def upload_file(self, dryadUrl=None, filename=None,
                     mimetype=None, size=None, descr=None,
                     hashtype=None,
@@ -615,6 +973,10 @@ class Transfer():
         horrendous failure whereupon you will get an actual
         exception.
 
+        Files held in memory by download_file are released
+        after the upload. If the upload fails, they are first
+        written to `tempfile_location` so that it can be retried.
+
         Parameters
         ----------
         dryadURL : str
@@ -642,82 +1004,107 @@ class Transfer():
             from non-superusers (undocumented as of 31 March 2021).
             **Forcible unlock requires a superuser API key.**
         '''
+        #pylint: disable=too-many-arguments, too-many-positional-arguments
+        uploaded = False
+        try:
+            out = self._upload_file(dryadUrl, filename, mimetype, size, descr,
+                                    hashtype, digest, studyId, dest,
+                                    fprefix, force_unlock)
+            uploaded = out[1].get('status') == 'OK'
+            return out
+        finally:
+            if filename:
+                upfile = self.tmpdir.joinpath(filename)
+                if not uploaded:
+                    self._spill_buffer(upfile)
+                self._release_buffer(upfile)
+
+    def _upload_file(self, dryadUrl=None, filename=None,
+                     mimetype=None, size=None, descr=None,
+                     hashtype=None,
+                     digest=None, studyId=None, dest=None,
+                     fprefix=None, force_unlock=False):
+        '''
+        Performs the upload for upload_file.
+        '''
         #pylint: disable = consider-using-with, too-many-arguments, too-many-positional-arguments
         #pylint:disable=too-many-locals, too-many-branches, too-many-statements
         #Fix the arguments one day
         if not studyId:
             studyId = self.dvpid
         dest = self.kwargs['dv_url']
-        fprefix = pathlib.Path(self.kwargs['tempfile_location']).expanduser().absolute()
-        if dryadUrl:
-            fid = dryadUrl.strip('/download')
-            fid = int(fid[fid.rfind('/')+1:])
-        else:
-            fid = 0 #dummy fid for non-Dryad use
         params = {'persistentId' : studyId}
-        upfile = pathlib.Path(fprefix, filename[:])
-        badExt = filename[filename.rfind('.'):].lower()
-        #Descriptions are technically possible, although how to add
-        #them is buried in Dryad's API documentation
-        dv4meta = {'label' : filename[:], 'description' : descr}
-        #if mimetype == 'application/zip' or filename.lower().endswith('.zip'):
-        if mimetype == 'application/zip' or badExt in self.kwargs.get('notab',[]):
-            mimetype = 'application/octet-stream' # stop unzipping automatically
-            filename += '.NOPROCESS' # Also screw with their naming convention
-            #debug log about file names to see what is up with XSLX
-            #see doi:10.5061/dryad.z8w9ghxb6
-            LOGGER.debug('File renamed to %s for upload', filename)
-        if size >= self.kwargs['max_upload']:
-            fail = (fid, {'status' : 'Failure: MAX_UPLOAD size exceeded'})
-            self.fileUpRecord.append(fail)
-            LOGGER.warning('%s: File %s of '
-                           'size %s exceeds '
-                           'Dataverse MAX_UPLOAD size. Skipping.', self.doi, filename, size)
-            return fail
-
-        fields = {'file': (filename, open(upfile, 'rb'), mimetype)}
-        fields.update({'jsonData': f'{dv4meta}'})
-        multi = MultipartEncoder(fields=fields)
-        ctype = {'Content-type' : multi.content_type}
-        tmphead = self.auth.copy()
-        tmphead.update(ctype)
-        tmphead.update({'User-agent':USERAGENT})
+        prep = self._prepare_upload(dryadUrl, filename, mimetype, size, descr)
+        fid = prep['fid']
+        if prep.get('fail'):
+            return prep['fail']
+        filename, mimetype = prep['filename'], prep['mimetype']
+        upfile, dv4meta = prep['upfile'], prep['dv4meta']
+
+        key = self._idempotency_key(fid, digest)
+        if key in self.uploadKeys:
+            LOGGER.info('%s: file %s (%s) already uploaded. Skipping',
+                        self.doi, filename, key)
+            return (fid, self.uploadKeys[key])
         url = dest + '/api/datasets/:persistentId/add'
-        upload = self.session.post(url, params=params,
-                                       headers=tmphead,
-                                       data=multi)
-        try:
-            upload.raise_for_status()
-
-        except (requests.exceptions.HTTPError,
-                    requests.exceptions.ConnectionError):
-            LOGGER.critical('Error %s: %s, upload.status_code, upload.reason')
-            return (fid, {'status' : f'Failure: Reason - {upload.status_code}: {upload.reason}'})
-
+        upjson = None
+        failure = None
+        retries = self.kwargs.get('upload_retries', 3)
+        #POSTs are not retried by the session, because a timed-out upload
+        #may still have succeeded. Check before sending it again.
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(min(config.RETRY_STRATEGY.backoff_factor * 2 ** attempt, 120))
+                upjson = self.find_upload(studyId, dv4meta['label'], upfile)
+                if upjson:
+                    LOGGER.warning('%s: upload of %s (%s) succeeded despite error',
+                                   self.doi, filename, key)
+                    break
+            try:
+                upload = self._post_file(url, params, filename, upfile, mimetype, dv4meta)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as err:
+                LOGGER.warning('%s: upload attempt %s of %s for %s failed: %s',
+                               self.doi, attempt + 1, retries + 1, filename, err)
+                failure = (fid, {'status' : f'Failure: Reason - {err}'})
+                continue
+            if upload.status_code in config.RETRY_STRATEGY.status_forcelist:
+                LOGGER.warning('%s: upload attempt %s of %s for %s failed: %s %s',
+                               self.doi, attempt + 1, retries + 1, filename,
+                               upload.status_code, upload.reason)
+                failure = (fid, {'status' : f'Failure: Reason - {upload.status_code}: '
+                                            f'{upload.reason}'})
+                continue
+            failure = None
+            break
+        if failure and not upjson:
+            upjson = self.find_upload(studyId, dv4meta['label'], upfile)
+            if not upjson:
+                LOGGER.critical('%s: unable to upload %s. %s', self.doi,
+                                filename, failure[1]['status'])
+                return failure
+
+        if not upjson:
+            try:
+                upload.raise_for_status()
+            except (requests.exceptions.HTTPError,
+                        requests.exceptions.ConnectionError):
+                LOGGER.critical('Error %s: %s', upload.status_code, upload.reason)
+                return (fid, {'status' : f'Failure: Reason - {upload.status_code}: '
+                                         f'{upload.reason}'})
+            try:
+                upjson = upload.json()
+            except requests.exceptions.JSONDecodeError as e:
+                LOGGER.warning('JSON error with upload')
+                LOGGER.exception(e)
+                return (fid, {'status' : f'Failure: Reason {upload.reason}'})
 
         try:
-            self.fileUpRecord.append((fid, upload.json()))
-            upmd5 = upload.json()['data']['files'][0]['dataFile']['checksum']['value']
-            #Dataverse hash type
-            _type = upload.json()['data']['files'][0]['dataFile']['checksum']['type']
-            if _type.lower() != hashtype.lower():
-                comparator = self._check_md5(upfile, _type.lower())
-            else:
-                comparator = digest
-            #if hashtype.lower () != 'md5':
-            #    #get an md5 because dataverse uses md5s. Or most of them do anyway.
-            #    #One day this will be rewritten properly.
-            #    md5 = self._check_md5(filename, 'md5')
-            #else:
-            #    md5 = digest
-            #if md5 and (upmd5 != md5):
-            if upmd5 != comparator:
-                try:
-                    raise exceptions.HashError(f'{_type} mismatch:\nlocal: '
-                                               f'{comparator}\nuploaded: {upmd5}')
-                except exceptions.HashError as e:
-                    LOGGER.exception(e)
-                    return (fid, {'status': e})
+            self.fileUpRecord.append((fid, upjson))
+            mismatch = self._upload_mismatch(upjson, upfile, hashtype, digest)
+            if mismatch:
+                return (fid, {'status': mismatch})
             #Make damn sure that the study isn't locked because of
             #tab file processing
             ##SPSS files still process despite spoofing MIME and extension
@@ -737,20 +1124,17 @@ class Transfer():
                         time.sleep(15) # Don't hit it too often
                     count += 1
 
-
-            return (fid, upload.json())
-
-        except requests.exceptions.JSONDecodeError as e:
-            LOGGER.warning('JSON error with upload')
-            LOGGER.exception(e)
-            return (fid, {'status' : f'Failure: Reason {upload.reason}'})
+            if key:
+                self.uploadKeys[key] = upjson
+            return (fid, upjson)
 
         #It can crash later
         except Exception as f_plus: #pylint: disable=broad-except
             LOGGER.exception(f_plus)
             return (fid, {'status' : f'Failure: Reason: {f_plus}'})
 
-    def upload_files(self, files=None, pid=None, fprefix=None, force_unlock=False):
+    def upload_files(self, files=None, pid=None, fprefix=None, force_unlock=False,
+                     callback=None):
         '''
         Uploads multiple files to study with persistentId pid.
         Returns a list of the original tuples plus JSON responses.
@@ -770,10 +1154,14 @@ class Transfer():
             The Dataverse `/locks` endpoint blocks POST and DELETE requests
             from non-superusers (undocumented as of 31 March 2021).
             **Forcible unlock requires a superuser API key.**
+        callback : callable
+            Called with each (dryadFid, JSON response) result as soon
+            as its upload finishes, eg. Monitor.record_upload.
         '''
+        #pylint: disable=too-many-arguments, too-many-positional-arguments
         if not files:
             files = self.files
-        fprefix = pathlib.Path(self.kwargs['tempfile_location']).expanduser().absolute()
+        fprefix = self.tmpdir
         out = []
         for f in files:
             #out.append(self.upload_file(f[0], f[1], f[2], f[3],
@@ -783,6 +1171,8 @@ class Transfer():
             out.append(self.upload_file(*list(f)[:-1],
                                         studyId=pid, fprefix=fprefix,
                                         force_unlock=force_unlock))
+            if callback:
+                callback(out[-1])
         return out
 
     def upload_json(self, studyId=None, dest=None):
@@ -837,43 +1227,129 @@ class Transfer():
                 LOGGER.exception(err)
                 raise
 
-    def delete_dv_file(self, dvfid)->bool:
+    def _delete_dv_file(self, dvfid)->dict:
+        '''
+        Deletes a single file from Dataverse and returns a status dict
+        of the form `{'status': str, 'code': int, 'method': str}`.
+
+        The native Dataverse API (`DELETE /api/files/{id}`) is tried
+        first; if it is not available on the target installation, the
+        older SWORD `edit-media` endpoint is used instead. A native
+        404 for a file which no longer exists counts as a deletion.
+
+        Parameters
+        ----------
+        dvfid : str
+            Dataverse file ID number.
+        '''
+        session = getattr(self._local, 'session', self.session)
+        if self._native_delete:
+            headers = {'X-Dataverse-key': self.kwargs['api_key'], 'User-agent': USERAGENT}
+            try:
+                delme = session.delete(f'{self.kwargs["dv_url"]}/api/files/{dvfid}',
+                                            headers=headers)
+                if delme.ok:
+                    return {'status': 'OK', 'code': delme.status_code,
+                            'method': 'native'}
+                #Older installations don't have the native endpoint at all
+                if (delme.status_code in (404, 405, 501) and
+                        'endpoint does not exist' in delme.text.lower()):
+                    LOGGER.debug('Native file delete API unavailable; using SWORD')
+                    self._native_delete = False
+                elif delme.status_code == 404:
+                    #The file is already gone, eg. deleted by hand
+                    LOGGER.info('%s: Dataverse file %s not found; treating as deleted',
+                                self.doi, dvfid)
+                    return {'status': 'OK', 'code': 404, 'method': 'native'}
+                elif delme.status_code not in (405, 501):
+                    return {'status': f'Failure: Reason - {delme.status_code}: '
+                                      f'{delme.reason}',
+                            'code': delme.status_code, 'method': 'native'}
+            except requests.exceptions.ConnectionError as err:
+                LOGGER.exception(err)
+                return {'status': f'Failure: Reason - {err}', 'code': None,
+                        'method': 'native'}
         #WTAF curl -u $API_TOKEN: -X DELETE
         #https://$HOSTNAME/dvn/api/data-deposit/v1.1/swordv2/edit-media/file/123
+        try:
+            delme = session.delete(f'{self.kwargs["dv_url"]}/'
+                                   'dvn/api/data-deposit/v1.1/swordv2/edit-media'
+                                   f'/file/{dvfid}',
+                                   auth=(self.kwargs['api_key'], ''))
+        except requests.exceptions.ConnectionError as err:
+            LOGGER.exception(err)
+            return {'status': f'Failure: Reason - {err}', 'code': None,
+                    'method': 'sword'}
+        if delme.status_code == 204:
+            return {'status': 'OK', 'code': 204, 'method': 'sword'}
+        return {'status': f'Failure: Reason - {delme.status_code}: {delme.reason}',
+                'code': delme.status_code, 'method': 'sword'}
 
+    def delete_dv_file(self, dvfid)->bool:
         '''
         Deletes files from Dataverse target given a dataverse file ID.
         This information is unknowable unless discovered by
         dryad2dataverse.monitor.Monitor or by other methods.
 
-        Returns 1 on success (204 response), or 0 on other response.
+        Returns 1 on success, or 0 on failure. Details of the
+        outcome are stored in Transfer.fileDelStatus.
 
         Parameters
         ----------
         dvfid : str
             Dataverse file ID number.
         '''
-        delme = self.session.delete(f'{self.kwargs["dv_url"]}/'
-                                    'dvn/api/data-deposit/v1.1/swordv2/edit-media'
-                                    f'/file/{dvfid}',
-                                    auth=(self.kwargs['api_key'], ''))
-        if delme.status_code == 204:
+        result = self._delete_dv_file(dvfid)
+        self.fileDelStatus[dvfid] = result
+        if result['status'] == 'OK':
             self.fileDelRecord.append(dvfid)
             return 1
+        LOGGER.warning('%s: unable to delete Dataverse file %s. %s',
+                       self.doi, dvfid, result['status'])
         return 0
 
-    def delete_dv_files(self, dvfids=None):
+    def delete_dv_files(self, dvfids=None, max_workers=None)->dict:
         '''
         Deletes all files in list of Dataverse file ids from
-        a Dataverse installation.
+        a Dataverse installation, using a bounded pool of
+        concurrent requests.
+
+        Returns a dict of `{dvfid: {'status': str, 'code': int,
+        'method': str}}`, where status is 'OK' on success or begins
+        with 'Failure' otherwise.
 
         Parameters
         ----------
         dvfids : list
-            List of Dataverse file ids.
-            Defaults to dryad2dataverse.transfer.Transfer.fileDelRecord.
+            List of Dataverse file ids. `None` values (ie, files with
+            no known Dataverse file id) are skipped.
+        max_workers : int
+            Maximum number of simultaneous deletions.
+            Defaults to the `max_workers` configuration value, or 4.
+
+        Notes
+        -----
+        requests.Session is not documented as thread-safe, so each
+        worker thread has its own session.
         '''
-        #if not dvfids:
-        #   dvfids = self.fileDelRecord
-        for fid in dvfids:
-            self.delete_dv_file(fid)
+        if not dvfids:
+            return {}
+        if not max_workers:
+            max_workers = self.kwargs.get('max_workers', 4)
+        dvfids = [fid for fid in dict.fromkeys(dvfids) if fid is not None]
+        sessions = []
+        def _start_worker():
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(max_retries=config.RETRY_STRATEGY))
+            self._local.session = session
+            sessions.append(session)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                       initializer=_start_worker) as pool:
+                done = list(pool.map(self.delete_dv_file, dvfids))
+        finally:
+            for session in sessions:
+                session.close()
+        LOGGER.debug('%s: deleted %s of %s Dataverse files',
+                     self.doi, sum(done), len(dvfids))
+        return {fid: self.fileDelStatus[fid] for fid in dvfids}
@@ -0,0 +1,51 @@
+'''
+Offline stand-ins shared by the test modules
+'''
+import dryad2dataverse.transfer
+
+#Minimum Transfer configuration. No requests are made to dv_url
+TRANSFER_KWARGS = {'max_upload': 10**6, 'dv_url': 'https://dv.invalid',
+                   'api_key': 'KEY', 'dv_contact_email': 'a@b.invalid',
+                   'dv_contact_name': 'A', 'target': 'test'}
+
+class FakeSerial:
+    '''
+    Offline stand-in for dryad2dataverse.serializer.Serializer
+    '''
+    def __init__(self, doi='doi:10.5061/dryad.test', lastmod='2022-01-01',
+                 dvpid=None, **extra):
+        self.doi = doi
+        self.dvpid = dvpid
+        self.dryadJson = {'identifier': doi, 'lastModificationDate': lastmod,
+                          'versionChanges': 'metadata_changed', 'title': 'Test'}
+        self.dryadJson.update(extra)
+        self.fileJson = []
+        self.files = []
+        self.oversize = []
+
+class FakeResponse:
+    '''
+    Offline stand-in for requests.Response
+    '''
+    def __init__(self, status_code, text=''):
+        self.status_code = status_code
+        self.text = text
+        self.reason = 'test'
+        self.ok = status_code < 400
+
+def make_transfer(tmp, cls=dryad2dataverse.transfer.Transfer, **kwargs):
+    '''
+    Returns a transfer of a FakeSerial with an existing Dataverse study,
+    using tmp as tempfile_location.
+
+    Parameters
+    ----------
+    tmp : str
+        Temporary directory.
+    cls : type
+        Transfer class.
+    **kwargs
+        Overrides for TRANSFER_KWARGS.
+    '''
+    return cls(FakeSerial(dvpid='doi:10.80240/FK2/TEST'),
+               **{**TRANSFER_KWARGS, 'tempfile_location': tmp, **kwargs})
@@ -0,0 +1,81 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+import zlib
+
+import Crypto.Hash.MD2
+
+import dryad2dataverse.exceptions
+import dryad2dataverse.hashing as hashing
+import dryad2dataverse.transfer
+
+class TestHashing(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.data = bytes(range(256)) * 40000 #~10 MB, > 1 block
+        cls.fname = pathlib.Path(cls.tmp.name, 'testfile.bin')
+        with open(cls.fname, 'wb') as f:
+            f.write(cls.data)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_single_pass(self):
+        out = hashing.digest_file(self.fname, list(hashing.HASHTABLE), blocksize=2**20)
+        self.assertEqual(out['md5'], hashlib.md5(self.data).hexdigest())
+        self.assertEqual(out['sha-256'], hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(out['md2'], Crypto.Hash.MD2.new(self.data).hexdigest())
+        self.assertEqual(out['crc-32'], f'{zlib.crc32(self.data):08x}')
+        self.assertEqual(out['adler-32'], f'{zlib.adler32(self.data):08x}')
+        self.assertEqual(out, hashing.digest_bytes(self.data, list(hashing.HASHTABLE)))
+
+    def test_mmap(self):
+        types = list(hashing.HASHTABLE)
+        self.assertEqual(hashing.digest_file(self.fname, types, blocksize=2**20,
+                                             mmap_threshold=0),
+                         hashing.digest_file(self.fname, types, mmap_threshold=None))
+
+    def test_check_md5(self):
+        self.assertEqual(dryad2dataverse.transfer.Transfer._check_md5(self.fname, 'crc-32'),
+                         f'{zlib.crc32(self.data):08x}')
+        with self.assertRaises(dryad2dataverse.exceptions.HashError):
+            dryad2dataverse.transfer.Transfer._check_md5(self.fname, 'sha-3')
+
+    def test_pool(self):
+        out = hashing.digest_files([self.fname, self.fname], ['md5', 'sha-1'], processes=2)
+        self.assertEqual(out[self.fname]['sha-1'], hashlib.sha1(self.data).hexdigest())
+
+    def test_cache(self):
+        cache = hashing.DigestCache(pathlib.Path(self.tmp.name, 'cache.sqlite3'))
+        fname = pathlib.Path(self.tmp.name, 'cached.bin')
+        with open(fname, 'wb') as f:
+            f.write(self.data)
+        first = cache.digest_file(fname, ['md5', 'sha-256'])
+        with unittest.mock.patch.object(hashing, 'digest_file') as dig:
+            self.assertEqual(cache.digest_file(fname, 'md5'), {'md5': first['md5']})
+            self.assertEqual(dryad2dataverse.transfer.Transfer._check_md5(fname,
+                                                                         'sha-256',
+                                                                         cache),
+                             first['sha-256'])
+            dig.assert_not_called()
+        #Changed file is hashed again and stale entries are removed
+        with open(fname, 'ab') as f:
+            f.write(b'x')
+        os.utime(fname, ns=(0, 0))
+        self.assertEqual(cache.digest_file(fname, 'md5')['md5'],
+                         hashlib.md5(self.data + b'x').hexdigest())
+        with cache._connect() as conn:
+            self.assertEqual(conn.execute('SELECT count(*) FROM digests').fetchone()[0], 1)
+
+    def test_get_cache(self):
+        self.assertIsNone(hashing.get_cache(digest_cache=None,
+                                            tempfile_location=self.tmp.name))
+        cache = hashing.get_cache(tempfile_location=self.tmp.name)
+        self.assertEqual(cache.dbase, pathlib.Path(self.tmp.name,
+                                                   hashing.CACHE_NAME).absolute())
+        self.assertIs(cache, hashing.get_cache(tempfile_location=self.tmp.name))
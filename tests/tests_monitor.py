@@ -1,12 +1,22 @@
 import unittest
+import concurrent.futures
 import copy
+import datetime
+import gzip
 import json
 import os
+import pathlib
 import pickle
 import sqlite3
+import tempfile
+import threading
+import time
+import unittest.mock
+import  dryad2dataverse.exceptions
 import  dryad2dataverse.serializer
 import  dryad2dataverse.transfer
 import  dryad2dataverse.monitor
+from tests.fakes import FakeSerial
 
 class TestMonitor(unittest.TestCase):
     @classmethod
@@ -40,19 +50,19 @@ class TestMonitor(unittest.TestCase):
         self.assertEqual(diff['status'], 'identical', True)
 
     def test_03_lastmodsame(self):
-        visi = self.testCase.dryadJson['visibility']
-        self.testCase.dryadJson['visibility'] = 'VISIBILITY CHANGED'
+        orig = self.testCase.dryadJson
+        self.testCase.dryadJson = dict(orig, visibility='VISIBILITY CHANGED')
         diff = self.montest.status(self.testCase)
         self.assertEqual(diff['status'], 'lastmodsame', True)
         self.assertEqual(diff['notes'], 'metadata_changed', True)
-        self.testCase.dryadJson['visibility'] = visi
+        self.testCase.dryadJson = orig
     
     def test_04_changed_date(self):
-        ordate = self.testCase.dryadJson['lastModificationDate']
-        self.testCase.dryadJson['lastModificationDate'] = '1941-12-07'
+        orig = self.testCase.dryadJson
+        self.testCase.dryadJson = dict(orig, lastModificationDate='1941-12-07')
         diff = self.montest.status(self.testCase)
         self.assertEqual(diff['status'], 'updated', True)
-        self.testCase.dryadJson['lastModificationDate'] = ordate
+        self.testCase.dryadJson = orig
     
     def test_06_unchanged_files(self):
         doi = self.testCase.doi
@@ -136,3 +146,610 @@ class TestMonitor(unittest.TestCase):
         self.montest.conn.commit()
         self.assertEqual(self.montest.get_dv_fid('https://datadryad.org/api/v2/files/16247/download'), '258214')
 
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        for line in dryad2dataverse.monitor.SCHEMA:
+            self.conn.execute(line)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_migrate(self):
+        version = dryad2dataverse.monitor.migrate(self.conn)
+        self.assertEqual(version, len(dryad2dataverse.monitor.MIGRATIONS))
+        self.assertEqual(self.conn.execute('PRAGMA user_version').fetchone()[0], version)
+        #Already up to date
+        self.assertEqual(dryad2dataverse.monitor.migrate(self.conn), version)
+        plan = self.conn.execute('EXPLAIN QUERY PLAN SELECT dvfid FROM dvFiles '
+                                 'WHERE dryfid = ?', (1,)).fetchall()
+        self.assertIn('idx_dvFiles_dryfid', str(plan))
+
+    def test_backup(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'test.sqlite3')
+            conn = sqlite3.connect(path)
+            for line in dryad2dataverse.monitor.SCHEMA:
+                conn.execute(line)
+            #Nothing to back up
+            with unittest.mock.patch.object(dryad2dataverse.monitor, 'MIGRATIONS',
+                                            [['CREATE TABLE test (x);']]):
+                dryad2dataverse.monitor.migrate(conn)
+            self.assertEqual(list(pathlib.Path(tmp).glob('*premigration*')), [])
+            conn.execute("INSERT INTO dryadStudy (doi) VALUES ('doi:10.5061/dryad.x')")
+            conn.commit()
+            with unittest.mock.patch.object(dryad2dataverse.monitor, 'MIGRATIONS',
+                                            [['CREATE TABLE test (x);'],
+                                             ['UPDATE dryadStudy SET doi = NULL;']]):
+                dryad2dataverse.monitor.migrate(conn)
+            conn.close()
+            backups = list(pathlib.Path(tmp).glob('test-premigration-v1-*.sqlite3'))
+            self.assertEqual(len(backups), 1)
+            with sqlite3.connect(backups[0]) as old:
+                self.assertEqual(old.execute('PRAGMA user_version').fetchone()[0], 1)
+                self.assertEqual(old.execute('SELECT doi FROM dryadStudy').fetchall(),
+                                 [('doi:10.5061/dryad.x',)])
+            old.close()
+
+    def test_failed_migration(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'test.sqlite3')
+            conn = sqlite3.connect(path)
+            for line in dryad2dataverse.monitor.SCHEMA:
+                conn.execute(line)
+            rows = [(f'doi:10.5061/dryad.{x}', json.dumps({'x': x})) for x in 'ab']
+            conn.executemany('INSERT INTO dryadStudy (doi, dryadjson) VALUES (?, ?)', rows)
+            conn.commit()
+            pack = dryad2dataverse.monitor.pack
+            calls = []
+            def failing(text, codec='zlib'):
+                #Fails after the first value has been rewritten
+                calls.append(text)
+                if len(calls) > 1:
+                    raise ValueError('Unable to compress')
+                return pack(text, codec)
+            with (unittest.mock.patch.object(dryad2dataverse.monitor, 'MIGRATIONS',
+                                             [['CREATE TABLE test (x);',
+                                               dryad2dataverse.monitor._compress_json]]),
+                  unittest.mock.patch.object(dryad2dataverse.monitor, 'pack',
+                                             side_effect=failing),
+                  self.assertRaises(dryad2dataverse.exceptions.DatabaseError)):
+                dryad2dataverse.monitor.migrate(conn)
+            self.assertFalse(conn.in_transaction)
+            self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], 0)
+            self.assertEqual(conn.execute('SELECT doi, dryadjson FROM dryadStudy '
+                                          'ORDER BY uid').fetchall(), rows)
+            self.assertEqual(conn.execute("SELECT name FROM sqlite_master "
+                                          "WHERE name = 'test'").fetchall(), [])
+            conn.close()
+            self.assertEqual(len(list(pathlib.Path(tmp).glob('test-premigration-v0-*'))), 1)
+
+    def test_concurrent(self):
+        applied = []
+        def step(conn, **kwargs):
+            applied.append(threading.get_ident())
+            time.sleep(0.2)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.sqlite3')
+            conns = [sqlite3.connect(path, timeout=30, check_same_thread=False)
+                     for _ in range(2)]
+            with unittest.mock.patch.object(dryad2dataverse.monitor, 'MIGRATIONS',
+                                            [[step], ['CREATE TABLE test (x);']]):
+                threads = [threading.Thread(target=dryad2dataverse.monitor.migrate,
+                                            args=(c,)) for c in conns]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(len(applied), 1)
+            self.assertEqual([c.execute('PRAGMA user_version').fetchone()[0]
+                              for c in conns], [2, 2])
+            for conn in conns:
+                conn.close()
+
+class FakeTransfer:
+    '''
+    Offline stand-in for dryad2dataverse.transfer.Transfer
+    '''
+    def __init__(self, serial, uploads=(), deletes=(), json_fid=None):
+        self.dryad = serial
+        self.doi = serial.doi
+        self.dvpid = serial.dvpid
+        self.dvStudy = {}
+        self.fileUpRecord = [(fid, upload(dvfid)) for fid, dvfid in uploads]
+        self.fileDelRecord = list(deletes)
+        self.fileDelStatus = {d: {'status': 'OK'} for d in deletes}
+        self.jsonFlag = None
+        if json_fid:
+            self.jsonFlag = (0, upload(json_fid))
+            self.fileUpRecord.append(self.jsonFlag)
+
+def upload(dvfid):
+    return {'status': 'OK', 'data': {'files': [{'dataFile': {
+            'id': dvfid, 'checksum': {'type': 'MD5', 'value': f'md5{dvfid}'}}}]}}
+
+class TestOffline(unittest.TestCase):
+    '''
+    Monitor tests which don't require Dryad
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.mon = dryad2dataverse.monitor.Monitor(':memory:')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mon.close()
+
+    def setUp(self):
+        self.doi = 'doi:10.5061/dryad.offline'
+        like = (f'{self.doi}%',)
+        self.mon.cursor.execute('SELECT uid FROM dryadStudy WHERE doi LIKE ?', like)
+        for uid in [x[0] for x in self.mon.cursor.fetchall()]:
+            for table in ('dryadFiles', 'dvStudy', 'dvFiles', 'failed_uploads',
+                          'dryadFingerprint'):
+                self.mon.cursor.execute(f'DELETE FROM {table} WHERE dryaduid = ?', (uid,))
+        for table in ('dvFilesCurrent', 'dvFilesLog'):
+            self.mon.cursor.execute(f'DELETE FROM {table} WHERE doi LIKE ?', like)
+        self.mon.cursor.execute('DELETE FROM dryadStudy WHERE doi LIKE ?', like)
+        self.mon.conn.commit()
+
+    def add_version(self, serial):
+        self.mon.cursor.execute('INSERT INTO dryadStudy (doi, lastmoddate, dryadjson, dvjson) '
+                                'VALUES (?, ?, ?, ?)',
+                                (self.doi, serial.dryadJson['lastModificationDate'],
+                                 json.dumps(serial.dryadJson), '{}'))
+        uid = self.mon.cursor.lastrowid
+        self.mon.cursor.execute('INSERT INTO dryadFiles VALUES (?, ?)', (uid, '[]'))
+        self.mon.cursor.execute('INSERT INTO dvStudy VALUES (?, ?)', (uid, 'doi:10.80240/TEST'))
+        self.mon.conn.commit()
+        return uid
+
+    def test_latest_version(self):
+        self.assertEqual(self.mon.status(FakeSerial(self.doi))['status'], 'new')
+        self.add_version(FakeSerial(self.doi, '2020-01-01', title='Old'))
+        self.add_version(FakeSerial(self.doi))
+        self.assertEqual(self.mon.status(FakeSerial(self.doi))['status'], 'identical')
+        self.assertEqual(self.mon.status(FakeSerial(self.doi, title='New'))['status'],
+                         'lastmodsame')
+        self.assertEqual(self.mon.status(FakeSerial(self.doi, '2023-01-01'))['status'],
+                         'updated')
+        self.assertEqual(self.mon.diff_metadata(FakeSerial(self.doi, '2023-01-01',
+                                                           title='New')),
+                         [{'lastModificationDate': ('2022-01-01', '2023-01-01')},
+                          {'title': ('Test', 'New')}])
+
+    def test_fingerprint(self):
+        self.assertEqual(dryad2dataverse.monitor.fingerprint({'a': 1, 'b': [1, 2]}),
+                         dryad2dataverse.monitor.fingerprint({'b': [1, 2], 'a': 1}))
+        serial = FakeSerial(self.doi)
+        uid = self.add_version(serial)
+        self.mon.cursor.execute('INSERT INTO dryadFingerprint VALUES (?, ?, ?)',
+                                (uid, dryad2dataverse.monitor.fingerprint(serial.dryadJson),
+                                 json.dumps(dryad2dataverse.monitor.field_fingerprints(
+                                     serial.dryadJson))))
+        self.mon.conn.commit()
+        #Stored JSON is not parsed when fingerprints are available
+        with unittest.mock.patch('dryad2dataverse.monitor.json.loads',
+                                 side_effect=AssertionError('parsed')):
+            self.assertEqual(self.mon.status(FakeSerial(self.doi))['status'], 'identical')
+            self.assertEqual(self.mon.status(FakeSerial(self.doi, '2023-01-01'))['status'],
+                             'updated')
+        self.assertEqual(self.mon.diff_metadata(FakeSerial(self.doi, '2023-01-01')),
+                         [{'lastModificationDate': ('2022-01-01', '2023-01-01')}])
+
+    def test_memoized(self):
+        self.add_version(FakeSerial(self.doi))
+        with unittest.mock.patch.object(self.mon, '_status',
+                                        wraps=self.mon._status) as stat:
+            serial = FakeSerial(self.doi)
+            self.assertEqual(self.mon.status(serial)['status'], 'identical')
+            self.assertEqual(serial.dvpid, 'doi:10.80240/TEST')
+            self.mon.status(FakeSerial(self.doi))
+            self.mon.diff_files(serial)
+            self.assertEqual(stat.call_count, 1)
+            #Changed metadata
+            self.mon.status(FakeSerial(self.doi, '2023-01-01'))
+            self.assertEqual(stat.call_count, 2)
+            #Database changed
+            self.add_version(FakeSerial(self.doi, '2023-01-01'))
+            self.assertEqual(self.mon.status(FakeSerial(self.doi, '2023-01-01'))['status'],
+                             'identical')
+            self.assertEqual(stat.call_count, 3)
+            self.mon.clear_cache()
+            self.mon.status(FakeSerial(self.doi, '2023-01-01'))
+            self.assertEqual(stat.call_count, 4)
+            self.mon.update(FakeTransfer(FakeSerial(self.doi, '2024-01-01')))
+            self.assertEqual(self.mon._memo, {})
+
+    def test_bulk_status(self):
+        self.add_version(FakeSerial(self.doi))
+        serial = FakeSerial(f'{self.doi}.fp')
+        serial.dvpid = 'doi:10.80240/FP'
+        self.mon.update(FakeTransfer(serial))
+        for old, fresh in ((self.doi, f'{self.doi}.fp'), (f'{self.doi}.fp', self.doi)):
+            for extra in ({}, {'title': 'New'}, {'lastmod': '2023-01-01'}):
+                serials = [FakeSerial(old, **extra), FakeSerial(fresh),
+                           FakeSerial(f'{self.doi}.new')]
+                records = [(x.doi, x.dryadJson) for x in serials]
+                self.assertEqual(self.mon.bulk_status(records),
+                                 {x.doi: self.mon.status(x) for x in serials})
+        #A study without a Dataverse PID is left out. Small batches
+        self.mon.cursor.execute('INSERT INTO dryadStudy (doi, lastmoddate, dryadjson) '
+                                'VALUES (?, ?, ?)', (f'{self.doi}.nopid', '2022-01-01', '{}'))
+        self.mon.conn.commit()
+        statuses = self.mon.bulk_status([(self.doi, FakeSerial(self.doi, title='New').dryadJson),
+                                         (f'{self.doi}.nopid', {}),
+                                         (f'{self.doi}.new', {})], batch=2)
+        self.assertEqual(statuses, {self.doi: self.mon.status(FakeSerial(self.doi,
+                                                                         title='New')),
+                                    f'{self.doi}.new': {'status': 'new', 'dvpid': None,
+                                                        'notes': ''}})
+        #Nothing is written through the read connection
+        self.assertFalse(self.mon._reader().in_transaction)
+        self.assertEqual(self.mon._reader().execute(
+            'SELECT count(*) FROM sqlite_temp_master').fetchone()[0], 0)
+
+    def test_memo_fingerprint(self):
+        self.add_version(FakeSerial(self.doi))
+        serial = FakeSerial(self.doi)
+        with unittest.mock.patch.object(dryad2dataverse.monitor, 'fingerprint',
+                                        wraps=dryad2dataverse.monitor.fingerprint) as fing:
+            for _ in range(3):
+                self.assertEqual(self.mon.status(serial)['status'], 'identical')
+                self.mon.diff_metadata(serial)
+                self.mon.diff_files(serial)
+            self.assertEqual(fing.call_count, 1)
+            #A new value is fingerprinted again
+            serial.dryadJson = dict(serial.dryadJson, title='New')
+            self.assertEqual(self.mon.status(serial)['status'], 'lastmodsame')
+            self.assertEqual(fing.call_count, 2)
+
+    def test_compressed(self):
+        serial = FakeSerial(self.doi, abstract='x' * 1000)
+        text = json.dumps(serial.dryadJson)
+        packed = dryad2dataverse.monitor.pack(text)
+        self.assertIsInstance(packed, bytes)
+        self.assertLess(len(packed), len(text))
+        self.assertEqual(dryad2dataverse.monitor.unpack(packed), text)
+        self.assertEqual(dryad2dataverse.monitor.pack(text, 'none'), text)
+        self.mon.cursor.execute('INSERT INTO dryadStudy (doi, lastmoddate, dryadjson, dvjson) '
+                                'VALUES (?, ?, ?, ?)',
+                                (self.doi, '2022-01-01', packed, '{}'))
+        uid = self.mon.cursor.lastrowid
+        self.mon.cursor.execute('INSERT INTO dryadFiles VALUES (?, ?)',
+                                (uid, dryad2dataverse.monitor.pack('[]')))
+        self.mon.cursor.execute('INSERT INTO dvStudy VALUES (?, ?)', (uid, 'doi:10.80240/TEST'))
+        self.mon.conn.commit()
+        self.assertEqual(self.mon.status(serial)['status'], 'identical')
+        self.assertEqual(self.mon.diff_files(serial), {})
+
+    def test_recode(self):
+        conn = sqlite3.connect(':memory:')
+        for line in dryad2dataverse.monitor.SCHEMA:
+            conn.execute(line)
+        conn.execute('INSERT INTO dvFiles VALUES (1, 2, ?, ?, ?, ?)',
+                     ('md5', '3', 'md5', '{"a": 1}'))
+        self.assertEqual(dryad2dataverse.monitor.migrate(conn),
+                         len(dryad2dataverse.monitor.MIGRATIONS))
+        self.assertIsInstance(conn.execute('SELECT dvfilejson FROM dvFiles').fetchone()[0],
+                              bytes)
+        self.assertEqual(dryad2dataverse.monitor.recode(conn, 'none'), 1)
+        self.assertEqual(conn.execute('SELECT dvfilejson FROM dvFiles').fetchone()[0],
+                         '{"a": 1}')
+        conn.close()
+
+    def test_migrate_codec(self):
+        conn = sqlite3.connect(':memory:')
+        for line in dryad2dataverse.monitor.SCHEMA:
+            conn.execute(line)
+        conn.execute('INSERT INTO dvFiles VALUES (1, 2, ?, ?, ?, ?)',
+                     ('md5', '3', 'md5', '{"a": 1}'))
+        dryad2dataverse.monitor.migrate(conn, dbase_compression='none')
+        self.assertEqual(conn.execute('SELECT dvfilejson FROM dvFiles').fetchone()[0],
+                         '{"a": 1}')
+        conn.close()
+
+    def test_current_files(self):
+        url = 'https://datadryad.org/api/v2/files/{}/download'
+        serial = FakeSerial(self.doi)
+        serial.dvpid = 'doi:10.80240/TEST'
+        self.mon.update(FakeTransfer(serial, [(9001, 11), (9002, 12)], json_fid=13))
+        self.assertEqual(self.mon.get_dv_fid(url.format(9001)), '11')
+        self.assertEqual(self.mon.get_json_dvfids(serial), ['13'])
+        self.assertEqual(self.mon.status(serial)['status'], 'identical')
+        #New version: one file and the JSON replaced
+        serial = FakeSerial(self.doi, '2023-01-01')
+        serial.dvpid = 'doi:10.80240/TEST'
+        self.mon.update(FakeTransfer(serial, [(9003, 14)], deletes=['11', '13'],
+                                     json_fid=15))
+        self.assertIsNone(self.mon.get_dv_fid(url.format(9001)))
+        self.assertEqual(self.mon.get_dv_fid(url.format(9002)), '12')
+        self.assertEqual(self.mon.get_json_dvfids(serial), ['15'])
+        #Nothing copied forward
+        self.mon.cursor.execute('SELECT count(*) FROM dvFilesCurrent WHERE doi = ?',
+                                (self.doi,))
+        self.assertEqual(self.mon.cursor.fetchone()[0], 3)
+        self.mon.cursor.execute('SELECT action, dvfid FROM dvFilesLog WHERE doi = ? '
+                                'ORDER BY logid', (self.doi,))
+        self.assertEqual(self.mon.cursor.fetchall()[-4:],
+                         [('add', '14'), ('add', '15'), ('delete', '11'), ('delete', '13')])
+
+    def test_dv_fid_map(self):
+        url = 'https://datadryad.org/api/v2/files/{}/download'
+        serial = FakeSerial(self.doi)
+        serial.dvpid = 'doi:10.80240/TEST'
+        self.mon.update(FakeTransfer(serial, [(9011, 31), (9012, 32)]))
+        self.mon.update(FakeTransfer(FakeSerial(self.doi, '2023-01-01'), deletes=['32']))
+        self.mon.cursor.execute("INSERT INTO dvFiles VALUES (1, 9013, 'md5', '33', 'md5', '{}')")
+        self.mon.cursor.execute("INSERT INTO dvFiles VALUES (2, 9013, 'md5', '34', 'md5', '{}')")
+        urls = [url.format(n) for n in (9011, 9012, 9013, 9014, 9011)]
+        with unittest.mock.patch.object(self.mon, '_cursor', wraps=self.mon._cursor) as cur:
+            self.assertEqual(self.mon.get_dv_fids([(u,) for u in urls]),
+                             ['31', None, '34', None, '31'])
+            self.assertEqual(cur.call_count, 1)
+        self.assertEqual(self.mon.get_dv_fid_map(urls[:3], batch=1),
+                         dict(zip(urls[:3], ['31', None, '34'])))
+        self.mon.cursor.execute('DELETE FROM dvFiles WHERE dryfid = 9013')
+        self.mon.conn.commit()
+
+    def test_delete_legacy(self):
+        url = 'https://datadryad.org/api/v2/files/{}/download'
+        serial = FakeSerial(self.doi)
+        serial.dvpid = 'doi:10.80240/TEST'
+        self.mon.update(FakeTransfer(serial, [(9031, 51)]))
+        self.mon.cursor.execute("INSERT INTO dvFiles VALUES (1, 9032, 'md5', '52', 'md5', '{}')")
+        self.mon.conn.commit()
+        self.assertEqual(self.mon.get_dv_fid(url.format(9032)), '52')
+        #Both already gone from Dataverse; delete_dv_files reports OK
+        self.mon.update(FakeTransfer(FakeSerial(self.doi, '2023-01-01'),
+                                     deletes=['51', '52']))
+        self.assertEqual(self.mon.get_dv_fids([(url.format(9031),), (url.format(9032),)]),
+                         [None, None])
+        self.mon.cursor.execute('SELECT action, dryfid, dvfid FROM dvFilesLog WHERE '
+                                "doi = ? AND action = 'delete' ORDER BY logid", (self.doi,))
+        self.assertEqual(self.mon.cursor.fetchall(),
+                         [('delete', 9031, '51'), ('delete', 9032, '52')])
+        self.mon.cursor.execute('DELETE FROM dvFiles WHERE dryfid = 9032')
+        self.mon.conn.commit()
+
+    def test_failed_uploads(self):
+        url = 'https://datadryad.org/api/v2/files/{}/download'
+        serial = FakeSerial(self.doi)
+        serial.dvpid = 'doi:10.80240/TEST'
+        serial.fileJson = [{'_embedded': {'stash:files': []}}]
+        trans = FakeTransfer(serial, [(9041, 61)])
+        trans.fileUpRecord += [(9042, {'status': 'Failure: first'}),
+                               (9043, {'status': 'Failure: first'})]
+        self.mon.update(trans)
+        failed = [f for f in self.mon.get_failed_uploads() if f['doi'] == self.doi]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0]['dryfids'], [9042, 9043])
+        self.assertEqual(failed[0]['dvpid'], 'doi:10.80240/TEST')
+        self.assertEqual(failed[0]['dryadJson'], serial.dryadJson)
+        self.assertEqual(failed[0]['fileJson'], serial.fileJson)
+        #One succeeds and one fails again
+        trans = FakeTransfer(serial, [(9042, 62)])
+        trans.fileUpRecord.append((9043, {'status': 'Failure: again'}))
+        self.assertEqual(self.mon.record_retry(trans), {'resolved': 1, 'failed': 1})
+        self.assertEqual(self.mon.get_dv_fid(url.format(9042)), '62')
+        failed = [f for f in self.mon.get_failed_uploads() if f['doi'] == self.doi]
+        self.assertEqual(failed[0]['dryfids'], [9043])
+        self.mon.cursor.execute('SELECT status FROM failed_uploads WHERE dryfid = 9043')
+        self.assertIn('again', self.mon.cursor.fetchone()[0])
+        #No longer in Dryad
+        self.assertEqual(self.mon.record_retry(FakeTransfer(serial), gone=[9043]),
+                         {'resolved': 1, 'failed': 0})
+        self.assertFalse([f for f in self.mon.get_failed_uploads() if f['doi'] == self.doi])
+
+    def test_incremental(self):
+        url = 'https://datadryad.org/api/v2/files/{}/download'
+        serial = FakeSerial(self.doi)
+        serial.dvpid = 'doi:10.80240/TEST'
+        trans = FakeTransfer(serial)
+        self.assertEqual(self.mon.get_pending(self.doi), {'dvpid': None, 'files': {}})
+        self.mon.record_study(trans)
+        self.assertTrue(self.mon.record_upload(trans, (9051, upload(71))))
+        self.assertTrue(self.mon.record_upload(trans, (9051, upload(71))))
+        self.assertFalse(self.mon.record_upload(trans, (9052, {'status': 'Failure'})))
+        self.assertTrue(self.mon.record_upload(trans, (0, upload(73))))
+        #Interrupted here
+        self.assertEqual(self.mon.get_pending(self.doi),
+                         {'dvpid': 'doi:10.80240/TEST', 'files': {9051: '71', 0: '73'}})
+        self.assertEqual(self.mon.get_dv_fid(url.format(9051)), '71')
+        self.assertEqual(self.mon.get_json_dvfids(serial), [])
+        #The rerun uploads the rest and finalizes the study
+        trans = FakeTransfer(serial, [(9051, 71), (9053, 72)], json_fid=73)
+        self.mon.update(trans)
+        self.assertEqual(self.mon.get_pending(self.doi), {'dvpid': None, 'files': {}})
+        self.assertEqual(self.mon.get_json_dvfids(serial), ['73'])
+        uid = self.mon.cursor.execute('SELECT max(uid) FROM dryadStudy WHERE doi = ?',
+                                      (self.doi,)).fetchone()[0]
+        for table in ('dvFilesCurrent', 'dvFilesLog'):
+            self.mon.cursor.execute(f'SELECT dryfid, dryaduid FROM {table} WHERE doi = ? '
+                                    'ORDER BY dryfid', (self.doi,))
+            self.assertEqual(self.mon.cursor.fetchall(),
+                             [(0, uid), (9051, uid), (9053, uid)])
+
+    def test_configure(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(os.path.join(tmp, 'test.sqlite3'))
+            dryad2dataverse.monitor.configure(conn, dbase_synchronous='normal')
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+            dryad2dataverse.monitor.configure(conn, dbase_wal=False)
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            with self.assertRaises(dryad2dataverse.exceptions.DatabaseError):
+                dryad2dataverse.monitor.configure(conn, dbase_synchronous='x; DROP')
+            conn.close()
+
+    def test_writer(self):
+        serials = [FakeSerial(f'{self.doi}.{num}') for num in range(8)]
+        for num, serial in enumerate(serials):
+            serial.dvpid = f'doi:10.80240/TEST{num}'
+        started = threading.Event()
+        gate = threading.Event()
+        generation = self.mon._database.writer.generation
+        #Hold the writer so that the updates queue up behind it
+        self.mon._submit(lambda cursor: started.set() or gate.wait(5))
+        started.wait(5)
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            futs = list(pool.map(
+                lambda s: self.mon.update_async(FakeTransfer(s, [(int(s.doi[-1]) + 9100, 20)])),
+                serials))
+        bad = self.mon._submit(lambda cursor: cursor.execute('INSERT INTO nosuchtable VALUES (1)'))
+        gate.set()
+        uids = [f.result(5) for f in futs]
+        self.assertEqual(len(set(uids)), 8)
+        with self.assertRaises(sqlite3.OperationalError):
+            bad.result(5)
+        #One transaction for the held job, and one for everything queued behind it
+        self.assertEqual(self.mon._database.writer.generation, generation + 2)
+        #Reads from other threads see the committed updates
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            stats = list(pool.map(lambda s: self.mon.status(s)['status'], serials))
+        self.assertEqual(stats, ['identical'] * 8)
+        self.assertEqual(self.mon.get_dv_fid(
+            'https://datadryad.org/api/v2/files/9103/download'), '20')
+
+class TestInstances(unittest.TestCase):
+    '''
+    Independent and shared Monitor instances
+    '''
+    def test_memory(self):
+        with dryad2dataverse.monitor.Monitor(':memory:') as one, \
+                dryad2dataverse.monitor.Monitor(':memory:') as two:
+            one.set_timestamp('2022-01-01T00:00:00Z')
+            self.assertEqual(one.lastmod, '2022-01-01T00:00:00Z')
+            self.assertIsNone(two.lastmod)
+        with self.assertRaises(dryad2dataverse.exceptions.DatabaseError):
+            one.lastmod
+
+    def test_run_journal(self):
+        records = [(f'doi:10.5061/dryad.run{n}', {'identifier': f'doi:10.5061/dryad.run{n}',
+                                                   'title': f'Run {n}'}) for n in range(3)]
+        with dryad2dataverse.monitor.Monitor(':memory:') as mon:
+            self.assertIsNone(mon.resume_run())
+            mon.set_timestamp('2022-01-01T00:00:00Z')
+            old = mon.start_run(records[:1])
+            runid = mon.start_run(records, since=mon.lastmod,
+                                  started='2023-01-01T00:00:00Z')
+            self.assertGreater(runid, old)
+            mon.complete_study(runid, records[0][0], 'new')
+            mon.complete_study(runid, records[2][0], 'unchanged')
+            #Interrupted; the last check time has not moved
+            run = mon.resume_run()
+            self.assertEqual(run['runid'], runid)
+            self.assertEqual(run['records'], tuple(records))
+            self.assertEqual(run['completed'], {records[0][0], records[2][0]})
+            self.assertEqual(run['since'], '2022-01-01T00:00:00Z')
+            self.assertEqual(mon.lastmod, '2022-01-01T00:00:00Z')
+            mon.complete_study(runid, records[1][0], 'new')
+            self.assertEqual(mon.finish_run(runid), '2023-01-01T00:00:00Z')
+            self.assertEqual(mon.lastmod, '2023-01-01T00:00:00Z')
+            self.assertIsNone(mon.resume_run())
+            self.assertEqual(mon.cursor.execute('SELECT runid, status FROM runJournal')
+                             .fetchall(), [(old, 'abandoned'), (runid, 'complete')])
+            self.assertEqual(mon.cursor.execute('SELECT DISTINCT runid FROM '
+                                                'runJournalStudy').fetchall(), [(runid,)])
+
+    def test_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dbase = os.path.join(tmp, 'test.sqlite3')
+            one = dryad2dataverse.monitor.Monitor(dbase)
+            two = dryad2dataverse.monitor.Monitor(dbase=dbase)
+            self.assertIs(one._database, two._database)
+            one.set_timestamp('2022-01-01T00:00:00Z')
+            one.close()
+            self.assertEqual(two.lastmod, '2022-01-01T00:00:00Z')
+            two.close()
+            self.assertNotIn(pathlib.Path(dbase), dryad2dataverse.monitor._DATABASES)
+            with dryad2dataverse.monitor.Monitor(dbase) as three:
+                self.assertEqual(three.lastmod, '2022-01-01T00:00:00Z')
+
+    def test_backup(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dbase = os.path.join(tmp, 'test.sqlite3')
+            with dryad2dataverse.monitor.Monitor(dbase) as mon:
+                mon.set_timestamp('2022-01-01T00:00:00Z')
+                plain = mon.backup()
+                packed = mon.backup(os.path.join(tmp, 'copy.sqlite3'), compress=True,
+                                    pages=1)
+            self.assertRegex(plain.name, r'^test_\d{4}-\d\d-\d\d-\d{4}\.sqlite3$')
+            self.assertEqual(packed.name, 'copy.sqlite3.gz')
+            with gzip.open(packed) as fin, open(os.path.join(tmp, 'copy.sqlite3'), 'wb') as fout:
+                fout.write(fin.read())
+            for copy in (plain, os.path.join(tmp, 'copy.sqlite3')):
+                conn = sqlite3.connect(copy)
+                self.assertEqual(conn.execute('SELECT checkdate FROM lastcheck').fetchall(),
+                                 [('2022-01-01T00:00:00Z',)])
+                conn.close()
+            self.assertFalse([f for f in os.listdir(tmp) if f.endswith('.part')])
+
+    def test_prune(self):
+        url = 'https://datadryad.org/api/v2/files/{}/download'
+        with tempfile.TemporaryDirectory() as tmp, \
+                dryad2dataverse.monitor.Monitor(os.path.join(tmp, 'test.sqlite3')) as mon:
+            cur = mon.cursor
+            for num, lastmod in enumerate(['2001-01-01', '2002-01-01', '2003-01-01',
+                                           '2004-01-01'], start=1):
+                cur.execute('INSERT INTO dryadStudy VALUES (?, ?, ?, ?, ?)',
+                            (num, 'doi:1', lastmod, 'x' * 10000, '{}'))
+                cur.execute('INSERT INTO dryadFiles VALUES (?, ?)', (num, '[]'))
+                #Version 0 style rows, copied forward to every version
+                cur.execute('INSERT INTO dvFiles VALUES (?, 500, ?, ?, ?, ?)',
+                            (num, 'md5', f'500{num}', 'md5', '{}'))
+                cur.execute('INSERT INTO dvFiles VALUES (?, 501, ?, ?, ?, ?)',
+                            (num, 'md5', '5010', 'md5', '{}'))
+            cur.execute("INSERT INTO dvFilesCurrent VALUES ('doi:1', 501, 'md5', "
+                        "'5011', 'md5', '{}', 4)")
+            cur.execute("INSERT INTO failed_uploads (dryaduid, dryfid, status) "
+                        "VALUES (2, 502, 'failed')")
+            cur.execute("INSERT INTO failed_uploads VALUES (1, 503, 'failed', '2005-01-01')")
+            mon.conn.commit()
+            with self.assertRaises(ValueError):
+                mon.prune()
+            #Version 4 is latest and has the newest dvFiles row for
+            #file 500, and 2 has a failed upload
+            self.assertEqual(mon.get_dv_fid(url.format(500)), '5004')
+            self.assertEqual(mon.prune(keep_last=1, older_than=datetime.datetime(2020, 1, 1)),
+                             {'dryadStudy': 2, 'dvFiles': 4})
+            self.assertEqual(cur.execute('SELECT uid FROM dryadStudy').fetchall(),
+                             [(2,), (4,)])
+            #Resolved failures don't keep a version
+            self.assertEqual(cur.execute('SELECT dryaduid FROM failed_uploads').fetchall(),
+                             [(2,)])
+            self.assertEqual(mon.get_dv_fid(url.format(500)), '5004')
+            self.assertEqual(mon.get_dv_fid(url.format(501)), '5011')
+            self.assertEqual(mon.prune(older_than=10), {'dryadStudy': 0, 'dvFiles': 0})
+            self.assertGreater(mon.vacuum(), 0)
+            self.assertEqual(cur.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+
+class TestDiff(unittest.TestCase):
+    '''
+    File list comparison
+    '''
+    @staticmethod
+    def fil(num, name=None, digest='a', url=None):
+        return (url or f'https://datadryad.org/api/v2/files/{num}/download',
+                name or f'file{num}.csv', 'text/csv', 100, '', 'md5', digest)
+
+    def test_diff_file_lists(self):
+        diff = dryad2dataverse.monitor.diff_file_lists
+        old = [self.fil(n) for n in range(5)]
+        self.assertEqual(diff(old, list(reversed(old))), {})
+        #Download links change without warning
+        self.assertEqual(diff(old, [self.fil(n, url=f'x{n}') for n in range(5)]), {})
+        new = old[1:] + [self.fil(7), self.fil(6), self.fil(3, digest='b')]
+        new.remove(self.fil(3))
+        self.assertEqual(diff(old, new), {'add': [self.fil(7), self.fil(6)],
+                                          'delete': [self.fil(0)],
+                                          'hash_change': [self.fil(3, digest='b')]})
+
+    def test_duplicates(self):
+        diff = dryad2dataverse.monitor.diff_file_lists
+        old = [self.fil(1, 'same.csv')]
+        new = [self.fil(1, 'same.csv'), self.fil(2, 'same.csv')]
+        self.assertEqual(diff(old, new), {'add': [self.fil(2, 'same.csv')]})
+        self.assertEqual(diff(new, old), {'delete': [self.fil(2, 'same.csv')]})
+        self.assertEqual(diff(new + new, new + old), {'delete': [self.fil(2, 'same.csv')]})
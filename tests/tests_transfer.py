@@ -1,11 +1,22 @@
+import asyncio
 import unittest
+import unittest.mock
+import hashlib
+import tempfile
+import datetime
+import io
+import pathlib
+import requests
 import sqlite3
 import json
 import pickle
 import sys
+import  dryad2dataverse.exceptions
 import  dryad2dataverse.serializer
 import  dryad2dataverse.transfer
+import  dryad2dataverse.throttle
 import logging
+from tests.fakes import FakeResponse, make_transfer
 
 LOGGER = logging.getLogger('dryad2dataverse.transfer')
 
@@ -60,3 +71,302 @@ class TestTransfer(unittest.TestCase):
             logging.disable(logging.NOTSET)
             sys.tracebacklimit = None
             self.assertTrue('BAD API key', err)
+
+class TestDelete(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.trans = make_transfer(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_native_delete(self):
+        sessions = set()
+        def fake(session, url, **kwargs):
+            sessions.add(session)
+            return FakeResponse(500 if url.endswith('/2') else 200)
+        with unittest.mock.patch('requests.Session.delete', autospec=True,
+                                 side_effect=fake):
+            out = self.trans.delete_dv_files([1, 2, None, 3])
+        #Workers have their own sessions
+        self.assertNotIn(self.trans.session, sessions)
+        self.assertEqual(sorted(out), [1, 2, 3])
+        self.assertEqual(out[1]['method'], 'native')
+        self.assertTrue(out[2]['status'].startswith('Failure'))
+        self.assertEqual(sorted(self.trans.fileDelRecord), [1, 3])
+
+    def test_sword_fallback(self):
+        def fake(url, **kwargs):
+            if '/api/files/' in url:
+                return FakeResponse(404, 'API endpoint does not exist on this server')
+            return FakeResponse(204)
+        with unittest.mock.patch('requests.Session.delete', side_effect=fake):
+            out = self.trans.delete_dv_files([7])
+        self.assertEqual(out[7], {'status': 'OK', 'code': 204, 'method': 'sword'})
+        self.assertFalse(self.trans._native_delete)
+
+    def test_already_deleted(self):
+        with unittest.mock.patch('requests.Session.delete',
+                                 return_value=FakeResponse(404, 'File not found')) as fake:
+            out = self.trans.delete_dv_files([8])
+        self.assertEqual(out[8], {'status': 'OK', 'code': 404, 'method': 'native'})
+        self.assertEqual(self.trans.fileDelRecord, [8])
+        self.assertTrue(self.trans._native_delete)
+        self.assertEqual(fake.call_count, 1)
+
+class TestAsyncTransfer(unittest.IsolatedAsyncioTestCase):
+    '''
+    Uses a local aiohttp server, so no network access is required
+    '''
+    async def asyncSetUp(self):
+        try:
+            from aiohttp import web
+            import dryad2dataverse.asynctransfer
+        except ImportError:
+            self.skipTest('aiohttp not installed')
+        self.tmp = tempfile.TemporaryDirectory()
+        async def download(request):
+            return web.Response(body=b'dryad' * 1000)
+        async def download_other(request):
+            return web.Response(body=b'other' * 1000)
+        async def delete(request):
+            return web.json_response({'status': 'OK'})
+        self.received = []
+        async def add(request):
+            self.received.append(request.headers.get('Content-Length'))
+            form = await request.post()
+            body = form['file'].file.read()
+            return web.json_response({'status': 'OK', 'data': {'files': [{'dataFile': {
+                'id': 1, 'checksum': {'type': 'MD5',
+                                      'value': hashlib.md5(body).hexdigest()}}}]}})
+        async def locks(request):
+            return web.json_response({'data': []})
+        app = web.Application()
+        app.router.add_get('/files/1/download', download)
+        app.router.add_get('/files/2/download', download_other)
+        app.router.add_delete('/api/files/{fid}', delete)
+        app.router.add_post('/api/datasets/:persistentId/add', add)
+        app.router.add_get('/api/datasets/:persistentId/locks', locks)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f'http://127.0.0.1:{port}'
+        self.trans = make_transfer(self.tmp.name,
+                                   dryad2dataverse.asynctransfer.AsyncTransfer,
+                                   dv_url=self.url)
+
+    async def asyncTearDown(self):
+        await self.trans.close()
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def test_download_delete(self):
+        md5 = await self.trans.download_file(url=f'{self.url}/files/1/download',
+                                             filename='dl.txt', size=5000,
+                                             chk=hashlib.md5(b'dryad'*1000).hexdigest(),
+                                             digest_type='md5')
+        self.assertEqual(md5, hashlib.md5(b'dryad'*1000).hexdigest())
+        out = await self.trans.delete_dv_files([1, 2])
+        self.assertEqual([x['status'] for x in out.values()], ['OK', 'OK'])
+
+    async def test_throttled_upload(self):
+        trans = make_transfer(self.tmp.name, dryad2dataverse.asynctransfer.AsyncTransfer,
+                              dv_url=self.url, max_upload_rate=10**8)
+        self.assertTrue(trans.shaper.enabled)
+        data = b'dryad' * 1000
+        pathlib.Path(trans.tmpdir, 'data.txt').write_bytes(data)
+        out = await trans.upload_file('https://datadryad.org/api/v2/files/9/download',
+                                      'data.txt', 'text/plain', len(data), '', 'md5',
+                                      hashlib.md5(data).hexdigest())
+        await trans.close()
+        self.assertEqual(out[1]['status'], 'OK')
+        #The payload was sized, not sent in chunks
+        self.assertIsNotNone(self.received[0])
+
+    async def test_same_filename(self):
+        other = make_transfer(self.tmp.name, dryad2dataverse.asynctransfer.AsyncTransfer,
+                              dv_url=self.url)
+        bodies = (b'dryad' * 1000, b'other' * 1000)
+        md5s = await asyncio.gather(*[trans.download_file(url=f'{self.url}/files/{num}/download',
+                                                          filename='README.md', size=5000,
+                                                          chk=hashlib.md5(body).hexdigest(),
+                                                          digest_type='md5')
+                                      for trans, num, body in ((self.trans, 1, bodies[0]),
+                                                               (other, 2, bodies[1]))])
+        self.assertEqual(md5s, [hashlib.md5(body).hexdigest() for body in bodies])
+        self.assertNotEqual(self.trans.tmpdir, other.tmpdir)
+        self.assertEqual(pathlib.Path(other.tmpdir, 'README.md').read_bytes(), bodies[1])
+        tmpdir = other.tmpdir
+        await other.close()
+        self.assertFalse(tmpdir.exists())
+
+class TestThrottle(unittest.TestCase):
+    def test_profiles(self):
+        shaper = dryad2dataverse.throttle.Shaper(max_rate=100,
+                    rate_profiles=[{'start': '22:00', 'end': '06:00', 'max_rate': 0},
+                                   {'start': 480, 'end': '18:00', 'max_upload_rate': 5}])
+        self.assertEqual(shaper.limits(datetime.datetime(2026, 1, 1, 23, 0))['max_rate'], 0)
+        self.assertEqual(shaper.limits(datetime.datetime(2026, 1, 1, 5, 59))['max_rate'], 0)
+        noon = shaper.limits(datetime.datetime(2026, 1, 1, 12, 0))
+        self.assertEqual((noon['max_rate'], noon['max_upload_rate']), (100, 5))
+        self.assertFalse(dryad2dataverse.throttle.Shaper().enabled)
+
+    def test_reader_rate(self):
+        now = [0.0]
+        def sleep(secs):
+            now[0] += secs
+        shaper = dryad2dataverse.throttle.Shaper(clock=lambda: now[0],
+                                                 max_upload_rate=200000)
+        stream = io.BytesIO(b'x' * 300000)
+        stream.len = 300000
+        reader = dryad2dataverse.throttle.ThrottledReader(stream, shaper)
+        self.assertEqual(reader.len, 300000)
+        with unittest.mock.patch('dryad2dataverse.throttle.time.sleep', side_effect=sleep):
+            while reader.read(50000):
+                pass
+        #300 KB at 200 KB/s with no initial burst
+        self.assertAlmostEqual(now[0], 1.5)
+
+    def test_reader_file(self):
+        shaper = dryad2dataverse.throttle.Shaper(max_upload_rate=10**8)
+        with tempfile.TemporaryFile() as fil:
+            fil.write(b'x' * 1000)
+            fil.seek(0)
+            reader = dryad2dataverse.throttle.ThrottledReader(fil, shaper)
+            self.assertEqual((reader.len, reader.tell()), (1000, 0))
+            self.assertEqual(reader.fileno(), fil.fileno())
+            self.assertEqual(len(reader.read(400)), 400)
+            self.assertEqual(reader.tell(), 400)
+            reader.seek(0)
+            self.assertEqual(len(reader.read()), 1000)
+
+class TestIdempotentUpload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        with open(pathlib.Path(self.tmp.name, 'data.txt'), 'wb') as f:
+            f.write(b'some data')
+        self.md5 = hashlib.md5(b'some data').hexdigest()
+        self.trans = make_transfer(self.tmp.name)
+        self.listing = {'data': [{'label': 'data.txt',
+                                  'dataFile': {'id': 55,
+                                               'checksum': {'type': 'MD5',
+                                                            'value': self.md5}}}]}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_timeout_not_resent(self):
+        listing = unittest.mock.Mock(status_code=200)
+        listing.json.return_value = self.listing
+        post = unittest.mock.Mock(side_effect=requests.exceptions.ConnectionError('timed out'))
+        with (unittest.mock.patch.object(self.trans.upload_session, 'post', post),
+              unittest.mock.patch.object(self.trans.session, 'get', return_value=listing),
+              unittest.mock.patch.object(self.trans, 'file_lock_check', return_value=False),
+              unittest.mock.patch('time.sleep')):
+            out = self.trans.upload_file('https://datadryad.org/api/v2/files/9/download',
+                                         'data.txt', 'text/plain', 9, '', 'md5', self.md5)
+            #Second call with the same key does nothing
+            again = self.trans.upload_file('https://datadryad.org/api/v2/files/9/download',
+                                           'data.txt', 'text/plain', 9, '', 'md5', self.md5)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(out[1]['data']['files'][0]['dataFile']['id'], 55)
+        self.assertEqual(out, again)
+        self.assertIn('9:' + self.md5, self.trans.uploadKeys)
+
+    def test_timeout_renamed(self):
+        #Zip files are sent as data.zip.NOPROCESS but labelled data.zip
+        pathlib.Path(self.tmp.name, 'data.txt').rename(pathlib.Path(self.tmp.name, 'data.zip'))
+        self.listing['data'][0]['label'] = 'data.zip'
+        listing = unittest.mock.Mock(status_code=200)
+        listing.json.return_value = self.listing
+        post = unittest.mock.Mock(side_effect=requests.exceptions.ConnectionError('timed out'))
+        with (unittest.mock.patch.object(self.trans.upload_session, 'post', post),
+              unittest.mock.patch.object(self.trans.session, 'get', return_value=listing),
+              unittest.mock.patch.object(self.trans, 'file_lock_check', return_value=False),
+              unittest.mock.patch('time.sleep')):
+            out = self.trans.upload_file('https://datadryad.org/api/v2/files/9/download',
+                                         'data.zip', 'application/zip', 9, '', 'md5', self.md5)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(out[1]['data']['files'][0]['dataFile']['id'], 55)
+
+class TestMemoryBuffer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = b'a,b\n1,2\n'
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.trans = make_transfer(self.tmp.name, digest_cache=None)
+        self.url = 'https://datadryad.org/api/v2/files/9/download'
+
+    def tearDown(self):
+        self.trans.release_buffers()
+        self.tmp.cleanup()
+
+    def download(self):
+        down = unittest.mock.Mock()
+        down.iter_content.return_value = [self.data[:4], self.data[4:]]
+        with unittest.mock.patch.object(self.trans.session, 'get', return_value=down):
+            return self.trans.download_file(self.url, 'data.csv', len(self.data),
+                                            self.md5, digest_type='md5')
+
+    def test_in_memory(self):
+        self.assertEqual(self.download(), self.md5)
+        upfile = pathlib.Path(self.tmp.name, 'data.csv').absolute()
+        self.assertFalse(upfile.exists())
+        self.assertEqual(dryad2dataverse.transfer.BUFFER_BUDGET.used, len(self.data))
+        sent = []
+        def post(url, data=None, **kwargs):
+            sent.append(data.read())
+            resp = unittest.mock.Mock(status_code=200)
+            resp.json.return_value = {'status': 'OK', 'data': {'files': [
+                {'dataFile': {'id': 1, 'checksum': {'type': 'MD5', 'value': self.md5}}}]}}
+            return resp
+        with (unittest.mock.patch.object(self.trans.upload_session, 'post', post),
+              unittest.mock.patch.object(self.trans, 'file_lock_check', return_value=False)):
+            out = self.trans.upload_file(self.url, 'data.csv', 'text/csv',
+                                         len(self.data), '', 'md5', self.md5)
+        self.assertEqual(out[1]['status'], 'OK')
+        self.assertIn(self.data, sent[0])
+        self.assertEqual(self.trans.buffers, {})
+        self.assertEqual(dryad2dataverse.transfer.BUFFER_BUDGET.used, 0)
+
+    def test_failed_upload(self):
+        self.download()
+        upfile = pathlib.Path(self.tmp.name, 'data.csv').absolute()
+        def post(url, data=None, **kwargs):
+            data.read()
+            resp = unittest.mock.Mock(status_code=400, reason='Bad Request')
+            resp.raise_for_status.side_effect = requests.exceptions.HTTPError
+            return resp
+        with (unittest.mock.patch.object(self.trans.upload_session, 'post',
+                                         side_effect=post) as sent,
+              unittest.mock.patch.object(self.trans, 'find_upload', return_value=None)):
+            out = self.trans.upload_file(self.url, 'data.csv', 'text/csv',
+                                         len(self.data), '', 'md5', self.md5)
+            self.assertTrue(out[1]['status'].startswith('Failure'))
+            #Written to disk for the retry
+            self.assertEqual(self.trans.buffers, {})
+            self.assertEqual(dryad2dataverse.transfer.BUFFER_BUDGET.used, 0)
+            self.assertEqual(upfile.read_bytes(), self.data)
+            again = self.trans.upload_file(self.url, 'data.csv', 'text/csv',
+                                           len(self.data), '', 'md5', self.md5)
+        self.assertTrue(again[1]['status'].startswith('Failure'))
+        self.assertGreaterEqual(sent.call_count, 2)
+
+    def test_larger_than_reported(self):
+        down = unittest.mock.Mock()
+        down.iter_content.return_value = [self.data[:4], self.data[4:]]
+        with (unittest.mock.patch.object(self.trans.session, 'get', return_value=down),
+              self.assertRaises(dryad2dataverse.exceptions.DownloadSizeError)):
+            self.trans.download_file(self.url, 'data.csv', 4, self.md5, digest_type='md5')
+        #Only the reported size was ever held in memory
+        self.assertEqual(pathlib.Path(self.tmp.name, 'data.csv').read_bytes(), self.data)
+        self.assertEqual(self.trans.buffers, {})
+        self.assertEqual(dryad2dataverse.transfer.BUFFER_BUDGET.used, 0)
+
+    def test_cap(self):
+        self.trans.kwargs['max_memory_buffers'] = 4
+        self.download()
+        self.assertTrue(pathlib.Path(self.tmp.name, 'data.csv').exists())
+        self.assertEqual(self.trans.buffers, {})